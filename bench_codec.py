@@ -0,0 +1,136 @@
+import time
+import ctypes
+import socket
+import argparse
+import poll_message_api
+from poll_message_api import *
+
+#
+# Compares the version 1 message codecs (StructCodec, see poll_message_api.py) with building and
+# reading the messages via the ctypes structs, as the send/recv functions did before
+#
+# For every struct of the version 1 messages, the same field values are encoded both ways and the
+# bytes are checked to be identical, then the time to encode and decode one message is printed
+# in ns. The ctypes encode builds the struct, assigns the fields (htons for the integers) and
+# copies it to bytes; the ctypes decode reads the struct in place with from_buffer() and converts
+# the fields back (ntohs, decode()).
+#
+# The arrays of the listing responses are then packed and unpacked with --rows rows both row by
+# row and in bulk with numpy (see StructCodec.packArrayInto), when numpy is installed.
+#
+# usage: python bench_codec.py [--count N] [--rows N]
+#
+
+# returns the flattened sample values of the struct fields, in the order of StructCodec
+def SampleValues(ctypesStruct):
+   values = []
+   for name, fieldType in ctypesStruct._fields_:
+      if issubclass(fieldType, ctypes.Structure):
+         values += SampleValues(fieldType)
+      elif issubclass(fieldType, ctypes.Array) or fieldType is ctypes.c_char:
+         values.append('x' * max(1, ctypes.sizeof(fieldType) // 2))
+      else:
+         values.append(7)
+   return values
+
+# sets the fields of the ctypes struct from the values, returns the number of values used
+def CtypesSet(obj, values):
+   i = 0
+   for name, fieldType in obj._fields_:
+      if issubclass(fieldType, ctypes.Structure):
+         i += CtypesSet(getattr(obj, name), values[i:])
+         continue
+      value = values[i]
+      if isinstance(value, str):
+         value = value.encode()
+      else:
+         value = socket.htons(value)
+      setattr(obj, name, value)
+      i += 1
+   return i
+
+def CtypesGet(obj, values):
+   for name, fieldType in obj._fields_:
+      value = getattr(obj, name)
+      if issubclass(fieldType, ctypes.Structure):
+         CtypesGet(value, values)
+      elif isinstance(value, bytes):
+         values.append(value.decode())
+      else:
+         values.append(socket.ntohs(value))
+   return values
+
+def CtypesEncode(ctypesStruct, values):
+   obj = ctypesStruct()
+   CtypesSet(obj, values)
+   return bytes(obj)
+
+def CtypesDecode(ctypesStruct, msgBuf):
+   return tuple(CtypesGet(ctypesStruct.from_buffer(msgBuf), []))
+
+# packs and unpacks the rows one struct at a time, as done without numpy
+def PackRows(codec, rows):
+   msgBuf = bytearray(codec.size * len(rows))
+   offset = 0
+   for row in rows:
+      codec.struct.pack_into(msgBuf, offset, *codec.encode(row))
+      offset += codec.size
+   return bytes(msgBuf)
+
+def UnpackRows(codec, msgBuf):
+   return [codec.decode(row) for row in codec.struct.iter_unpack(msgBuf)]
+
+def Time(func, count):
+   t = time.perf_counter()
+   for i in range(count):
+      func()
+   return (time.perf_counter() - t) / count * 1e9
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Benchmark the version 1 message codecs')
+   parser.add_argument('--count', type=int, default=20000, help='number of messages encoded and decoded per struct')
+   parser.add_argument('--rows', type=int, default=20000, help='number of rows of the arrays packed in bulk')
+   args = parser.parse_args()
+
+   codecs = [(name[:-len('Codec')], codec) for name, codec in vars(poll_message_api).items()
+             if isinstance(codec, StructCodec)]
+
+   print(f"{'struct':>32} {'size':>5} | {'ctypes enc':>10} {'codec enc':>10} | {'ctypes dec':>10} {'codec dec':>10}  (ns/msg)")
+   for name, codec in codecs:
+      ctypesStruct = getattr(poll_message_api, name)
+      values = SampleValues(ctypesStruct)
+
+      msgBuf = codec.pack(*values)
+      if msgBuf != CtypesEncode(ctypesStruct, values):
+         raise SystemExit(f"{name}: encoded bytes differ")
+      recvBuf = bytearray(msgBuf)
+      if codec.unpack(recvBuf) != CtypesDecode(ctypesStruct, recvBuf) or codec.unpack(recvBuf) != tuple(values):
+         raise SystemExit(f"{name}: decoded values differ")
+
+      ctypesEnc = Time(lambda: CtypesEncode(ctypesStruct, values), args.count)
+      codecEnc = Time(lambda: codec.pack(*values), args.count)
+      ctypesDec = Time(lambda: CtypesDecode(ctypesStruct, recvBuf), args.count)
+      codecDec = Time(lambda: codec.unpack(recvBuf), args.count)
+      print(f"{name:>32} {codec.size:>5} | {ctypesEnc:>10.0f} {codecEnc:>10.0f} | {ctypesDec:>10.0f} {codecDec:>10.0f}")
+
+   if numpy is None:
+      raise SystemExit("numpy is not installed, the arrays are packed row by row")
+
+   arrays = [('ListUsersResponseData', [(f"u{i}", f"User {i}", f"u{i}@x.org") for i in range(args.rows)]),
+             ('ListPollsResponseData', [(f"p{i}", f"Poll {i}", '2024-01-01', '', 'O') for i in range(args.rows)]),
+             ('PollResultsResponseData', [(f"Choice {i}", i % 1000) for i in range(args.rows)])]
+
+   print(f"\n{'array':>32} {'rows':>6} | {'row pack':>10} {'bulk pack':>10} | {'row unpack':>10} {'bulk unpack':>11}  (ms)")
+   for name, rows in arrays:
+      codec = getattr(poll_message_api, name + 'Codec')
+      msgBuf = PackRows(codec, rows)
+      if codec.packArrayNumpy(rows) != msgBuf:
+         raise SystemExit(f"{name}: bulk packed bytes differ")
+      if codec.unpackArrayNumpy(msgBuf, len(rows), 0) != UnpackRows(codec, msgBuf):
+         raise SystemExit(f"{name}: bulk unpacked rows differ")
+
+      rowPack = Time(lambda: PackRows(codec, rows), 5) / 1e6
+      bulkPack = Time(lambda: codec.packArrayNumpy(rows), 5) / 1e6
+      rowUnpack = Time(lambda: UnpackRows(codec, msgBuf), 5) / 1e6
+      bulkUnpack = Time(lambda: codec.unpackArrayNumpy(msgBuf, len(rows), 0), 5) / 1e6
+      print(f"{name:>32} {len(rows):>6} | {rowPack:>10.1f} {bulkPack:>10.1f} | {rowUnpack:>10.1f} {bulkUnpack:>11.1f}")
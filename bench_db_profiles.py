@@ -0,0 +1,86 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+import poll_dbopsimpl
+from poll_message_api import *
+
+#
+# Benchmark of the database performance profiles (see POLLSERVER_DB_PROFILES in poll_dbopsimpl.py)
+#
+# For every profile, creates a scratch database and measures the operations per second of:
+#    vote        : PollMakeSelection, one vote per transaction, i.e one commit per vote
+#    vote batch  : PollMakeSelections with --batch votes per transaction, as done by the vote writer
+#    create poll : AddPoll with 4 choices, one poll per transaction
+#    results     : PollGetResults of a random poll
+#
+# The cost of a commit depends on the disk, the scratch databases are created in --dir (default
+# the current directory, which should be on the disk of the real database, not on a tmpfs).
+#
+# usage: python bench_db_profiles.py [--votes N] [--polls N] [--results N] [--batch N] [--dir DIR]
+#        [--profiles durable balanced ...]
+#
+
+def Setup(dbFile, profileName):
+   poll_dbopsimpl.POLLSERVER_DB = dbFile
+   # the poll cache holds the polls of the previous database
+   poll_dbopsimpl.pollCache = poll_dbopsimpl.PollCache()
+   conn = poll_dbopsimpl.ConnectDatabase(profileName)
+   poll_dbopsimpl.CreateTables(conn)
+   return conn
+
+def CreatePolls(conn, pollIDs):
+   for pollID in pollIDs:
+      poll_dbopsimpl.AddPoll(conn, 'owner', pollID, pollID, '', '', [('A', 'a'), ('B', 'b'), ('C', 'c'), ('D', 'd')])
+
+def Vote(conn, votes):
+   for vote in votes:
+      poll_dbopsimpl.PollMakeSelection(conn, *vote)
+
+def VoteBatch(conn, votes, batch):
+   for i in range(0, len(votes), batch):
+      poll_dbopsimpl.PollMakeSelections(conn, votes[i:i + batch])
+
+def GetResults(conn, pollIDs):
+   for pollID in pollIDs:
+      poll_dbopsimpl.PollGetResults(conn, pollID)
+
+def Time(func, *args):
+   t = time.perf_counter()
+   func(*args)
+   return time.perf_counter() - t
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Benchmark the database performance profiles')
+   parser.add_argument('--votes', type=int, default=2000, help='number of votes of the vote and vote batch runs')
+   parser.add_argument('--polls', type=int, default=500, help='number of polls created')
+   parser.add_argument('--results', type=int, default=20000, help='number of results read')
+   parser.add_argument('--batch', type=int, default=64, help='votes per transaction for the vote batch run')
+   parser.add_argument('--dir', default='.', help='directory of the scratch databases')
+   parser.add_argument('--profiles', nargs='+', default=list(poll_dbopsimpl.POLLSERVER_DB_PROFILES),
+                       choices=poll_dbopsimpl.POLLSERVER_DB_PROFILES)
+   args = parser.parse_args()
+
+   pollIDs = [f"poll{p}" for p in range(args.polls)]
+   votes = [(random.choice(pollIDs), f"user{i}", random.choice('ABCD')) for i in range(args.votes)]
+   batchVotes = [(pollID, 'b' + userID, choiceID) for (pollID, userID, choiceID) in votes]
+   reads = [random.choice(pollIDs) for i in range(args.results)]
+
+   print(f"{'profile':>10} {'journal':>8} {'sync':>6} | {'vote':>8} {'vote batch':>10} {'create poll':>11} {'results':>8}  (ops/s)")
+   for profileName in args.profiles:
+      with tempfile.TemporaryDirectory(dir=args.dir) as tmpDir:
+         conn = Setup(os.path.join(tmpDir, 'bench.sqldb'), profileName)
+         journalMode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+         synchronous = ['OFF', 'NORMAL', 'FULL', 'EXTRA'][conn.execute("PRAGMA synchronous").fetchone()[0]]
+
+         createPoll = Time(CreatePolls, conn, pollIDs)
+         for pollID in pollIDs:
+            poll_dbopsimpl.SetPollStatus(conn, pollID, 'owner', 'O')
+         vote = Time(Vote, conn, votes)
+         voteBatch = Time(VoteBatch, conn, batchVotes, args.batch)
+         results = Time(GetResults, conn, reads)
+         conn.close()
+
+      print(f"{profileName:>10} {journalMode:>8} {synchronous:>6} | {len(votes) / vote:>8.0f} {len(batchVotes) / voteBatch:>10.0f} "
+            f"{len(pollIDs) / createPoll:>11.0f} {len(reads) / results:>8.0f}")
@@ -0,0 +1,119 @@
+import sys
+import ssl
+import time
+import socket
+import argparse
+import resource
+import threading
+import subprocess
+from poll_message_api import *
+
+#
+# Benchmark comparing the server modes (see POLLSERVER_MODES in poll_server.py)
+#
+# For every mode, the benchmark starts poll_server.py in the current directory, opens
+# a number of idle client connections, and measures the memory and the threads used by
+# the server. Then a few active clients send LIST_USERS requests over their own
+# connections (while the idle connections stay open) and the request rate and latency
+# is reported.
+#
+# Must be run from the directory containing the certificates (see gen_ssl_cert.sh).
+#
+# usage: python bench_server_modes.py [--idle N] [--clients N] [--requests N] [--modes thread asyncio]
+#
+
+POLLSERVER_HOST_PORT = ('127.0.0.1', 10000)
+
+def GetClientSSLContext():
+   ssl_context                 = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+   ssl_context.check_hostname  = False
+   ssl_context.load_verify_locations("certificates/ca-cert.pem")
+   ssl_context.load_cert_chain(certfile="certificates/client-cert.pem", keyfile="certificates/client-key.pem")
+   return ssl_context
+
+def Connect(ssl_context):
+   ssl_c_sock = ssl_context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+   ssl_c_sock.connect(POLLSERVER_HOST_PORT)
+   return FramedSocket(ssl_c_sock)
+
+def GetProcStatus(pid):
+   status = {}
+   with open(f"/proc/{pid}/status") as f:
+      for line in f:
+         key, value = line.split(':', 1)
+         status[key] = value.strip()
+   return int(status['VmRSS'].split()[0]), int(status['Threads'])
+
+def StartServer(mode, ssl_context):
+   server = subprocess.Popen([sys.executable, 'poll_server.py', '--mode', mode],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   for i in range(100):
+      try:
+         Connect(ssl_context).close()
+         return server
+      except ConnectionRefusedError:
+         time.sleep(0.1)
+   server.kill()
+   raise Exception("Server did not start")
+
+def ActiveClient(ssl_context, numRequests, latencies):
+   ssl_c_sock = Connect(ssl_context)
+   for i in range(numRequests):
+      t = time.perf_counter()
+      sendListUsersReq(ssl_c_sock)
+      recvListUsersResponse(ssl_c_sock)
+      latencies.append(time.perf_counter() - t)
+   ssl_c_sock.close()
+
+def RunMode(mode, args, ssl_context):
+   server = StartServer(mode, ssl_context)
+   try:
+      time.sleep(0.5)
+      baseRss, baseThreads = GetProcStatus(server.pid)
+
+      idle = []
+      t = time.perf_counter()
+      for i in range(args.idle):
+         idle.append(Connect(ssl_context))
+      connectTime = time.perf_counter() - t
+      time.sleep(1)
+      idleRss, idleThreads = GetProcStatus(server.pid)
+
+      latencies = []
+      clients = [threading.Thread(target=ActiveClient, args=(ssl_context, args.requests, latencies))
+                 for i in range(args.clients)]
+      t = time.perf_counter()
+      for c in clients:
+         c.start()
+      for c in clients:
+         c.join()
+      elapsed = time.perf_counter() - t
+
+      for s in idle:
+         s.close()
+   finally:
+      server.terminate()
+      server.wait()
+
+   latencies.sort()
+   print(f"{mode:>8}: {args.idle} idle connections opened in {connectTime:.1f}s, "
+         f"server rss {baseRss} -> {idleRss} kB ({(idleRss - baseRss) / max(args.idle, 1):.1f} kB/conn), "
+         f"threads {baseThreads} -> {idleThreads}")
+   print(f"{'':>8}  {len(latencies)} requests from {args.clients} clients: {len(latencies) / elapsed:.0f} req/s, "
+         f"p50 {latencies[len(latencies) // 2] * 1e3:.2f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f} ms")
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Compare the poll server modes')
+   parser.add_argument('--idle', type=int, default=1000, help='number of idle connections')
+   parser.add_argument('--clients', type=int, default=8, help='number of active clients')
+   parser.add_argument('--requests', type=int, default=500, help='number of requests per active client')
+   parser.add_argument('--modes', nargs='+', default=['thread', 'asyncio'])
+   args = parser.parse_args()
+
+   soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+   resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+   ssl_context = GetClientSSLContext()
+   for mode in args.modes:
+      RunMode(mode, args, ssl_context)
+      time.sleep(1)
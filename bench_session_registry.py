@@ -0,0 +1,88 @@
+import time
+import argparse
+import poll_dbopsimpl
+
+#
+# Benchmark of the session registry (poll_dbopsimpl.SessionRegistry)
+#
+# Simulates a number of live sessions (default 50000), half of them logged in, and
+# measures the time per connect, lookup, login check, login, logout and disconnect.
+# For comparison, the same operations are timed on a list of contexts scanned linearly,
+# which is how the sessions were kept before the registry (a sample of the operations
+# only, as each of them scans the whole list).
+#
+# usage: python bench_session_registry.py [--sessions N]
+#
+
+class LinearRegistry:
+   def __init__(self):
+      self.contexts = []
+
+   def add(self, cl_sock, cl_address):
+      cntxt = {'socket': cl_sock, 'address': cl_address, 'userID': None, 'logged_in': False}
+      self.contexts.append(cntxt)
+      return cntxt
+
+   def get(self, cl_sock):
+      found = [c for c in self.contexts if c['socket'] == cl_sock]
+      return found[0] if found else None
+
+   def remove(self, cl_sock):
+      self.contexts.remove(self.get(cl_sock))
+
+   def isLoggedIn(self, userID):
+      return bool([c for c in self.contexts if c['userID'] == userID and c['logged_in']])
+
+   def login(self, userID, cntxt):
+      if self.isLoggedIn(userID):
+         return False
+      cntxt['userID'] = userID
+      cntxt['logged_in'] = True
+      return True
+
+   def logout(self, cntxt):
+      cntxt['userID'] = None
+      cntxt['logged_in'] = False
+
+# returns the time per operation in micro seconds
+def Timed(func, items):
+   t = time.perf_counter()
+   for i in items:
+      func(i)
+   return (time.perf_counter() - t) / max(len(items), 1) * 1e6
+
+def Run(name, registry, numSessions, numOps):
+   socks = [object() for i in range(numSessions)]
+   users = ['user%d' % i for i in range(numSessions)]
+   sample = list(range(0, numSessions, max(numSessions // numOps, 1)))
+
+   results = {}
+   cntxts = []
+   results['connect'] = Timed(lambda i: cntxts.append(registry.add(socks[i], ('127.0.0.1', i))), range(numSessions))
+   for i in range(0, numSessions, 2):
+      if isinstance(registry, LinearRegistry):
+         # same as login(), without scanning the list for every session
+         cntxts[i]['userID'] = users[i]
+         cntxts[i]['logged_in'] = True
+      else:
+         registry.login(users[i], cntxts[i])
+
+   results['lookup'] = Timed(lambda i: registry.get(socks[i]), sample)
+   results['is_logged_in'] = Timed(lambda i: registry.isLoggedIn(users[i]), sample)
+   # the sessions with odd index are not logged in
+   loginSample = [i + 1 for i in sample if i + 1 < numSessions]
+   results['login'] = Timed(lambda i: registry.login(users[i], registry.get(socks[i])), loginSample)
+   results['logout'] = Timed(lambda i: registry.logout(registry.get(socks[i])), loginSample)
+   results['disconnect'] = Timed(lambda i: registry.remove(socks[i]), sample)
+
+   print(f"{name:>8}: " + ", ".join(f"{op} {us:.2f} us" for op, us in results.items()))
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Benchmark the session registry')
+   parser.add_argument('--sessions', type=int, default=50000, help='number of live sessions')
+   parser.add_argument('--linear-ops', type=int, default=200, help='number of operations timed on the linear list')
+   args = parser.parse_args()
+
+   print(f"{args.sessions} sessions")
+   Run('registry', poll_dbopsimpl.SessionRegistry(), args.sessions, args.sessions)
+   Run('linear', LinearRegistry(), args.sessions, args.linear_ops)
@@ -0,0 +1,181 @@
+import sys
+import ssl
+import time
+import socket
+import hashlib
+import argparse
+import threading
+import subprocess
+import poll_dbopsimpl
+from poll_message_api import *
+
+#
+# Benchmark of the vote latency while the full user list is exported (see poll_scheduler.py)
+#
+# For every server mode, the benchmark starts poll_server.py in the current directory. The voters
+# vote in a loop over their own connections, first alone, then while --bulk clients ask LIST_USERS
+# (LIST_USERS_PAGE with --paged) in a loop, and the p50/p99 latency of the votes is reported for
+# both runs. With --load login, the --bulk clients log out and in again in a loop instead (a login
+# storm, see poll_passwords.py).
+#
+# The user list is made big by adding --users users (benchuserN) to the database in the current
+# directory, once. Must be run from the directory containing the certificates (see gen_ssl_cert.sh).
+#
+# usage: python bench_vote_latency.py [--users N] [--voters N] [--bulk N] [--duration S] [--paged]
+#        [--load bulk|login] [--modes thread pool]
+#
+
+POLLSERVER_HOST_PORT = ('127.0.0.1', 10000)
+BENCH_PWD = 'benchpwd'
+BENCH_POLL_ID = 'benchpoll'
+# largest page of LIST_USERS_PAGE
+BENCH_PAGE_SIZE = 65535
+
+def GetClientSSLContext():
+   ssl_context                 = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+   ssl_context.check_hostname  = False
+   ssl_context.load_verify_locations("certificates/ca-cert.pem")
+   ssl_context.load_cert_chain(certfile="certificates/client-cert.pem", keyfile="certificates/client-key.pem")
+   return ssl_context
+
+def Connect(ssl_context, userID):
+   ssl_c_sock = ssl_context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+   ssl_c_sock.connect(POLLSERVER_HOST_PORT)
+   sock = FramedSocket(ssl_c_sock)
+   NegotiateWireVersion(sock, POLL_WIRE_VERSION_2)
+   sendLoginUserReqMsg(sock, userID, BENCH_PWD)
+   if recvResponseMessage(sock)[2] != OP_SUCCESS:
+      raise Exception(f"login of {userID} failed")
+   return sock
+
+# adds the bench users and the open poll the voters vote on
+def SetupDatabase(numUsers):
+   conn = poll_dbopsimpl.ConnectDatabase()
+   poll_dbopsimpl.CreateTables(conn)
+   pwdHash = hashlib.sha256(BENCH_PWD.encode()).hexdigest()
+   if not conn.execute("SELECT userID from user_table WHERE userID=?", (f"benchuser{numUsers - 1}",)).fetchall():
+      conn.executemany("INSERT OR IGNORE INTO user_table VALUES(?, ?, ?, ?)",
+                       ((f"benchuser{i}", f"Bench User {i}", "bench@poll", pwdHash) for i in range(numUsers)))
+      conn.commit()
+   poll_dbopsimpl.AddPoll(conn, 'benchuser0', BENCH_POLL_ID, 'Bench Poll', '', '', [('A', 'a'), ('B', 'b')])
+   poll_dbopsimpl.SetPollStatus(conn, BENCH_POLL_ID, 'benchuser0', 'O')
+   conn.close()
+
+def StartServer(mode, ssl_context):
+   server = subprocess.Popen([sys.executable, 'poll_server.py', '--mode', mode],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   for i in range(100):
+      try:
+         ssl_context.wrap_socket(socket.create_connection(POLLSERVER_HOST_PORT)).close()
+         return server
+      except ConnectionRefusedError:
+         time.sleep(0.1)
+   server.kill()
+   raise Exception("Server did not start")
+
+def Voter(sock, stop, latencies):
+   choices = 'AB'
+   i = 0
+   while not stop.is_set():
+      t = time.perf_counter()
+      sendPollMakeSelectionReq(sock, BENCH_POLL_ID, choices[i % 2])
+      recvResponseMessage(sock)
+      latencies.append(time.perf_counter() - t)
+      i += 1
+
+# exports the user list with LIST_USERS, or with LIST_USERS_PAGE when paged
+def BulkClient(sock, stop, counts, paged):
+   while not stop.is_set():
+      if paged:
+         afterUserID = ""
+         while True:
+            sendListUsersPageReq(sock, afterUserID=afterUserID, pageSize=BENCH_PAGE_SIZE)
+            while True:
+               msgType, flags, status, reason, (users, endOfPage, nextUserID) = recvListUsersPageResponse(sock)
+               if status != OP_SUCCESS or endOfPage:
+                  break
+            if status != OP_SUCCESS or not nextUserID:
+               break
+            afterUserID = nextUserID
+      else:
+         sendListUsersReq(sock)
+         reason = recvListUsersResponse(sock)[3]
+
+      if reason == REASON_SERVER_OVERLOADED:
+         # asks again a bit later, as a client should
+         time.sleep(0.1)
+         continue
+      counts.append(1)
+
+# logs out and in again in a loop
+def LoginClient(sock, stop, counts, userID):
+   while not stop.is_set():
+      sendLogoutUserReqMsg(sock)
+      recvResponseMessage(sock)
+      sendLoginUserReqMsg(sock, userID, BENCH_PWD)
+      reason = recvResponseMessage(sock)[3]
+      if reason == REASON_SERVER_OVERLOADED:
+         time.sleep(0.1)
+         continue
+      counts.append(1)
+
+# runs the voters, and the bulk (login) clients if any, for the duration, returns the vote
+# latencies and the number of user lists exported (logins)
+def Run(voters, bulkClients, duration, paged=False, load='bulk'):
+   stop = threading.Event()
+   latencies = []
+   counts = []
+   threads = [threading.Thread(target=Voter, args=(sock, stop, latencies)) for sock in voters]
+   if load == 'login':
+      threads += [threading.Thread(target=LoginClient, args=(sock, stop, counts, userID)) for (sock, userID) in bulkClients]
+   else:
+      threads += [threading.Thread(target=BulkClient, args=(sock, stop, counts, paged)) for (sock, userID) in bulkClients]
+   for t in threads:
+      t.start()
+   time.sleep(duration)
+   stop.set()
+   for t in threads:
+      t.join()
+   latencies.sort()
+   return latencies, len(counts)
+
+def Percentile(latencies, p):
+   return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1e3
+
+def RunMode(mode, args, ssl_context):
+   server = StartServer(mode, ssl_context)
+   try:
+      voters = [Connect(ssl_context, f"benchuser{i + 1}") for i in range(args.voters)]
+      bulkUserIDs = [f"benchuser{args.voters + i + 1}" for i in range(args.bulk)]
+      bulkClients = [(Connect(ssl_context, userID), userID) for userID in bulkUserIDs]
+
+      alone, numLists = Run(voters, [], args.duration)
+      loaded, numLists = Run(voters, bulkClients, args.duration, args.paged, args.load)
+
+      for sock in voters + [sock for (sock, userID) in bulkClients]:
+         sock.close()
+   finally:
+      server.terminate()
+      server.wait()
+
+   print(f"{mode:>8}: votes alone  {len(alone) / args.duration:>6.0f}/s p50 {Percentile(alone, 0.5):6.2f} ms p99 {Percentile(alone, 0.99):6.2f} ms")
+   print(f"{'':>8}  with {args.bulk} bulk {len(loaded) / args.duration:>6.0f}/s p50 {Percentile(loaded, 0.5):6.2f} ms "
+         f"p99 {Percentile(loaded, 0.99):6.2f} ms, {numLists} {'logins' if args.load == 'login' else 'user lists exported'}")
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Vote latency while the user list is exported')
+   parser.add_argument('--users', type=int, default=50000, help='number of bench users in the database')
+   parser.add_argument('--voters', type=int, default=8, help='number of voting clients')
+   parser.add_argument('--bulk', type=int, default=16, help='number of clients exporting the user list')
+   parser.add_argument('--duration', type=float, default=5, help='seconds of every run')
+   parser.add_argument('--paged', action='store_true', help='export the user list with LIST_USERS_PAGE')
+   parser.add_argument('--load', choices=['bulk', 'login'], default='bulk',
+                       help='bulk: the clients export the user list, login: they log out and in again')
+   parser.add_argument('--modes', nargs='+', default=['thread', 'pool'])
+   args = parser.parse_args()
+
+   SetupDatabase(args.users)
+   ssl_context = GetClientSSLContext()
+   for mode in args.modes:
+      RunMode(mode, args, ssl_context)
+      time.sleep(1)
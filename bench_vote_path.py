@@ -0,0 +1,91 @@
+import os
+import time
+import sqlite3
+import argparse
+import tempfile
+import poll_dbopsimpl
+from poll_message_api import *
+
+#
+# Benchmark of the vote path (poll_dbopsimpl.PollMakeSelection / PollMakeSelections)
+#
+# Creates a scratch database with a few open polls and measures the votes per second of:
+#    legacy : the vote path before the UPSERT, i.e SELECT status, SELECT choice, UPDATE, commit,
+#             INSERT if no row was updated and commit again, for every vote
+#    upsert : PollMakeSelection, one vote per transaction, validated against the poll cache
+#    batch  : PollMakeSelections with --batch votes per transaction, as done by the vote writer
+#
+# Half of the votes are new and half change an earlier vote, so both the INSERT and the
+# UPDATE branch are timed.
+#
+# usage: python bench_vote_path.py [--votes N] [--users N] [--polls N] [--batch N]
+#
+
+def LegacyMakeSelection(conn, pollID, userID, choiceID):
+   try:
+      cur = conn.cursor()
+      polStatus = cur.execute("SELECT status from poll_master_table where (pollID=?)", (pollID,)).fetchall()
+      choiceList = cur.execute("SELECT choiceID from poll_choices_table where (pollID=? and choiceID=?)", (pollID,choiceID)).fetchall()
+      if len(polStatus) == 0 or len(choiceList) == 0:
+         status, reason = OP_FAILURE, REASON_NOSUCH_POLL_ID
+      elif polStatus[0][0] != 'O':
+         status, reason = OP_FAILURE, REASON_POLL_NOT_OPENED
+      else:
+         count = cur.execute("UPDATE user_poll_selection_table SET choiceID=? WHERE " +
+                          "(pollID=? and userID=?)", (choiceID, pollID, userID)).rowcount
+         conn.commit()
+         if count == 0:
+            cur.execute("INSERT INTO user_poll_selection_table VALUES(?, ?, ?)", (pollID, userID, choiceID))
+            conn.commit()
+         status, reason = OP_SUCCESS, REASON_SUCCESS
+   except sqlite3.IntegrityError as opErr:
+      conn.rollback()
+      status, reason = OP_FAILURE, REASON_DATABASE_ERROR
+
+   return status, reason
+
+def Setup(dbFile, numPolls):
+   poll_dbopsimpl.POLLSERVER_DB = dbFile
+   conn = poll_dbopsimpl.ConnectDatabase()
+   poll_dbopsimpl.CreateTables(conn)
+   for p in range(numPolls):
+      pollID = f"poll{p}"
+      poll_dbopsimpl.AddPoll(conn, 'owner', pollID, pollID, '', '', [('A', 'a'), ('B', 'b'), ('C', 'c')])
+      poll_dbopsimpl.SetPollStatus(conn, pollID, 'owner', 'O')
+   return conn
+
+# the first half of the votes are new, the second half change them
+def Votes(numVotes, numUsers, numPolls):
+   votes = []
+   for i in range(numVotes // 2):
+      votes.append((f"poll{(i // numUsers) % numPolls}", f"user{i % numUsers}", 'ABC'[i % 3]))
+   return votes + [(pollID, userID, 'ABC'[('ABC'.index(c) + 1) % 3]) for (pollID, userID, c) in votes]
+
+def Run(name, func, conn, votes, batch):
+   conn.execute("DELETE FROM user_poll_selection_table")
+   conn.commit()
+
+   t = time.perf_counter()
+   for i in range(0, len(votes), batch):
+      func(conn, votes[i:i + batch])
+   elapsed = time.perf_counter() - t
+
+   count = conn.execute("SELECT count(*) from user_poll_selection_table").fetchall()[0][0]
+   print(f"{name:>8}: {len(votes)} votes in {elapsed:.2f}s, {len(votes) / elapsed:.0f} votes/s ({count} rows)")
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Benchmark the vote path')
+   parser.add_argument('--votes', type=int, default=20000, help='number of votes')
+   parser.add_argument('--users', type=int, default=2000, help='number of users voting')
+   parser.add_argument('--polls', type=int, default=10, help='number of open polls')
+   parser.add_argument('--batch', type=int, default=64, help='votes per transaction for the batch run')
+   args = parser.parse_args()
+
+   with tempfile.TemporaryDirectory() as tmpDir:
+      conn = Setup(os.path.join(tmpDir, 'bench.sqldb'), args.polls)
+      votes = Votes(args.votes, args.users, args.polls)
+
+      Run('legacy', lambda conn, v: LegacyMakeSelection(conn, *v[0]), conn, votes, 1)
+      Run('upsert', lambda conn, v: poll_dbopsimpl.PollMakeSelection(conn, *v[0]), conn, votes, 1)
+      Run('batch', poll_dbopsimpl.PollMakeSelections, conn, votes, args.batch)
+      conn.close()
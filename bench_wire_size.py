@@ -0,0 +1,67 @@
+import time
+import argparse
+from poll_message_api import *
+
+#
+# Compares the size on the wire of the version 1 (ctypes) and the version 2 (length-prefixed)
+# formats (see NEGOTIATE_VERSION in poll_message_api.py), and the time to encode and decode them
+#
+# The LIST_USERS, LIST_POLLS and USER_POLL_GET_RESULTS responses are encoded for a number of
+# rows with short IDs and names, as is typical, and decoded back.
+#
+# usage: python bench_wire_size.py [--rows N]
+#
+
+# Socket like object keeping the bytes sent, and returning them to recv_into()
+class MemorySocket:
+   def __init__(self, wireVersion):
+      self.wireVersion = wireVersion
+      self.data = bytearray()
+      self.pos = 0
+
+   def send(self, data):
+      data = bytes(data)
+      self.data += data
+      return len(data)
+
+   def recv_into(self, buffer, nbytes=0):
+      size = min(nbytes or len(buffer), len(buffer), len(self.data) - self.pos)
+      buffer[:size] = self.data[self.pos:self.pos + size]
+      self.pos += size
+      return size
+
+def Run(name, numRows, send, recv):
+   results = []
+   for wireVersion in (POLL_WIRE_VERSION_1, POLL_WIRE_VERSION_2):
+      sock = MemorySocket(wireVersion)
+      t = time.perf_counter()
+      send(sock)
+      encodeTime = time.perf_counter() - t
+
+      framedSock = FramedSocket(sock)
+      framedSock.wireVersion = wireVersion
+      t = time.perf_counter()
+      recv(framedSock)
+      decodeTime = time.perf_counter() - t
+      results.append((len(sock.data), encodeTime, decodeTime))
+
+   (v1Size, v1Enc, v1Dec), (v2Size, v2Enc, v2Dec) = results
+   print(f"{name:>12}: {numRows} rows, v1 {v1Size} bytes, v2 {v2Size} bytes ({v1Size / v2Size:.1f}x smaller), "
+         f"encode {v1Enc * 1e3:.1f} -> {v2Enc * 1e3:.1f} ms, decode {v1Dec * 1e3:.1f} -> {v2Dec * 1e3:.1f} ms")
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Compare the wire formats')
+   parser.add_argument('--rows', type=int, default=10000, help='number of rows in the responses (max 65535 for v1)')
+   args = parser.parse_args()
+
+   userList = [{'userID': f"u{i}", 'userName': f"User {i}", 'userEmail': f"u{i}@x.org"} for i in range(args.rows)]
+   pollList = [{'pollId': f"p{i}", 'pollName': f"Poll {i}", 'startDate': '', 'endDate': '', 'pollStatus': 'O'}
+               for i in range(args.rows)]
+   pollResults = [{'choiceName': f"Choice {i}", 'count': i % 1000} for i in range(args.rows)]
+
+   Run('list_users', args.rows, lambda sock: sendListUsersResponse(sock, OP_SUCCESS, REASON_SUCCESS, userList),
+       recvListUsersResponse)
+   Run('list_polls', args.rows, lambda sock: sendListPollsResponse(sock, OP_SUCCESS, REASON_SUCCESS, pollList),
+       recvListPollsResponse)
+   Run('poll_results', args.rows, lambda sock: sendPollGetResultsResponse(sock, OP_SUCCESS, REASON_SUCCESS, 'Poll', pollResults),
+       recvPollGetResultsResponse)
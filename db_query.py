@@ -6,6 +6,7 @@ pprint.pprint(conn.execute("select * from sqlite_schema where name = 'user_table
 pprint.pprint(conn.execute("select * from sqlite_schema where name = 'poll_master_table'").fetchall())
 pprint.pprint(conn.execute("select * from sqlite_schema where name = 'poll_choices_table'").fetchall())
 pprint.pprint(conn.execute("select * from sqlite_schema where name = 'user_poll_selection_table'").fetchall())
+pprint.pprint(conn.execute("select * from sqlite_schema where name = 'poll_tally_table'").fetchall())
 
 print('user_table : ')
 pprint.pprint(conn.execute('select * from user_table').fetchall())
@@ -18,3 +19,6 @@ pprint.pprint(conn.execute('select * from poll_choices_table').fetchall())
 
 print('user_poll_selection_table : ')
 pprint.pprint(conn.execute('select * from user_poll_selection_table').fetchall())
+
+print('poll_tally_table : ')
+pprint.pprint(conn.execute('select * from poll_tally_table').fetchall())
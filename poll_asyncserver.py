@@ -0,0 +1,203 @@
+import sys
+import asyncio
+import asyncio.sslproto
+import concurrent.futures
+import poll_dbopsimpl
+import poll_publisher
+import poll_scheduler
+from poll_message_api import *
+from poll_logging import log
+
+#
+# Implements the asyncio server mode
+#
+# In the threaded mode, the server creates one thread for every client connection and
+# the thread lives as long as the connection, even when the client is idle. In the asyncio
+# mode all the connections are owned by a single event loop. An idle connection costs only a
+# coroutine, its stream reader/writer and the SSL object, so the server can hold tens of
+# thousands of connections.
+#
+# When data arrives on a connection, the coroutine of the connection hands the request over
+# to a fixed pool of handler threads. The handler thread runs the same msgType2CBMap classes as
+# the threaded mode. The handler classes expect a blocking socket, so the connection is given to
+# them wrapped in AsyncStreamSocket, which implements recv_into() and send() on top of the asyncio
+# reader/writer streams of the connection.
+#
+# At most POLLSERVER_SCHED_MAX_RUNNING requests of a priority class are handed over at a time (see
+# poll_scheduler), the bulk listings beyond it wait in their coroutine, not holding a handler thread.
+# The requests are handed over one at a time, also the ones already buffered, so every request
+# takes the semaphore of its own class.
+#
+
+# number of threads processing the requests
+POLLSERVER_ASYNC_NUM_WORKERS = 32
+
+# number of bytes read from the connection in one go by the event loop
+POLLSERVER_ASYNC_READ_SIZE = 4096
+
+# max number of pending connections not yet accepted by the event loop
+POLLSERVER_ASYNC_NUM_WAIT_REQS = 1024
+
+# time allowed for a client to finish the TLS handshake
+POLLSERVER_ASYNC_HANDSHAKE_TIMEOUT = 10
+
+# Opt-in (poll_server.py --async-ssl-buffer-size): asyncio preallocates a 256KB receive buffer
+# for every SSL connection, which is most of the memory of an idle connection. The poll requests
+# are small, reading them in 4KB chunks costs nothing. The size is the undocumented class
+# attribute SSLProtocol.max_size of asyncio, shared by the whole process, so it is only changed
+# on the Python versions where it was measured and if the attribute is there. Whether it was
+# changed is logged at startup. None leaves the asyncio default
+POLLSERVER_ASYNC_SSL_BUFFER_SIZE = None
+POLLSERVER_ASYNC_SSL_BUFFER_PYTHONS = {(3, 11)}
+
+#
+# Socket like object for the handler classes
+#
+# The handler thread reads the requests via a FramedSocket wrapping this object. The event loop
+# reads the first bytes of a request and feeds them to the FramedSocket (see FramedSocket.feed())
+# before the request is handed over to the handler thread, and recv_into() asks the event loop to
+# read more from the connection only when the buffered bytes are not enough. send() asks the event
+# loop to write the data and waits until it is written.
+#
+class AsyncStreamSocket:
+   def __init__(self, loop, reader, writer):
+      self.loop = loop
+      self.reader = reader
+      self.writer = writer
+
+   def __repr__(self):
+      return f"<AsyncStreamSocket raddr={self.writer.get_extra_info('peername')}>"
+
+   # called in the handler thread
+   def recv_into(self, buffer, nbytes=0):
+      data = asyncio.run_coroutine_threadsafe(self.reader.read(nbytes or len(buffer)), self.loop).result()
+      buffer[:len(data)] = data
+      return len(data)
+
+   async def write(self, data):
+      self.writer.write(data)
+      await self.writer.drain()
+
+   # called in the handler thread
+   def send(self, data):
+      data = bytes(data)
+      asyncio.run_coroutine_threadsafe(self.write(data), self.loop).result()
+      return len(data)
+
+   # called in the other threads (see poll_publisher), closes the connection at once
+   def shutdown(self, how):
+      self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+   def getpeercert(self):
+      return self.writer.get_extra_info('peercert')
+
+   def close(self):
+      self.writer.close()
+
+class AsyncPollServer:
+   def __init__(self, checkCertificate, serveRequest):
+      self.checkCertificate = checkCertificate
+      self.serveRequest = serveRequest
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=POLLSERVER_ASYNC_NUM_WORKERS,
+                                                            thread_name_prefix='poll-handler')
+      # priority class -> semaphore of the requests handed over (see serve())
+      self.running = {}
+
+   # runs in the handler thread, processes one request
+   def serveOneRequest(self, cl_sock, cntxt):
+      # database connection of the handler thread
+      return self.serveRequest(cl_sock, cntxt, poll_dbopsimpl.GetConnection())
+
+   # runs in the handler thread, drops the session and the subscriptions of a closed connection.
+   # Dropping a login commits to user_session_table in the pre-fork mode, so not in the event loop
+   def closeSession(self, cl_sock):
+      try:
+         poll_dbopsimpl.RemoveThreadContext(cl_sock)
+      finally:
+         poll_publisher.UnsubscribeAll(cl_sock)
+
+   # coroutine for each client connection
+   async def handleConnection(self, reader, writer):
+      loop = asyncio.get_running_loop()
+      cl_address = writer.get_extra_info('peername')
+
+      # validate the client's certificate
+      ssl_object = writer.get_extra_info('ssl_object')
+      if ssl_object:
+         try:
+            self.checkCertificate(ssl_object)
+         except Exception as ex:
+            log.warning("%s client certificate: %s", cl_address, ex)
+            writer.close()
+            return
+
+      cl_sock = FramedSocket(AsyncStreamSocket(loop, reader, writer))
+      poll_dbopsimpl.AddThreadContext(cl_sock, cl_address)
+      cntxt = poll_dbopsimpl.GetThreadContext(cl_sock)
+      log.debug("%s connected", cl_address)
+
+      try:
+         while True:
+            # wait for the header of the next request without holding a handler thread
+            msgType, size = PeekRequest(cl_sock)
+            while msgType is None:
+               data = await reader.read(POLLSERVER_ASYNC_READ_SIZE)
+               if not data:
+                  return
+               cl_sock.feed(data)
+               msgType, size = PeekRequest(cl_sock)
+
+            # every request takes the semaphore of its own class, also the ones already buffered
+            running = self.running.get(poll_scheduler.GetSchedClass(msgType))
+            if running is None:
+               if await loop.run_in_executor(self.executor, self.serveOneRequest, cl_sock, cntxt):
+                  break
+               continue
+            async with running:
+               if await loop.run_in_executor(self.executor, self.serveOneRequest, cl_sock, cntxt):
+                  break
+      except (ConnectionError, OSError) as ex:
+         log.info("%s %s", cl_address, ex)
+      except Exception:
+         log.exception("%s error processing request", cl_address)
+      finally:
+         try:
+            await loop.run_in_executor(self.executor, self.closeSession, cl_sock)
+         except Exception:
+            log.exception("%s error closing the session", cl_address)
+         finally:
+            writer.close()
+
+   async def serve(self, hostPort, sslContext, reusePort):
+      self.running = {schedClass: asyncio.Semaphore(limit)
+                      for schedClass, limit in poll_scheduler.POLLSERVER_SCHED_MAX_RUNNING.items()}
+      server = await asyncio.start_server(self.handleConnection, hostPort[0], hostPort[1],
+                                          ssl=sslContext, backlog=POLLSERVER_ASYNC_NUM_WAIT_REQS, reuse_port=reusePort,
+                                          ssl_handshake_timeout=POLLSERVER_ASYNC_HANDSHAKE_TIMEOUT if sslContext else None)
+      async with server:
+         await server.serve_forever()
+
+# Sets the receive buffer size of the SSL connections, see POLLSERVER_ASYNC_SSL_BUFFER_SIZE
+def SetSSLBufferSize(size):
+   if size is None:
+      log.info("SSL buffer size left at the asyncio default")
+      return
+   version = sys.version_info[:2]
+   if version not in POLLSERVER_ASYNC_SSL_BUFFER_PYTHONS or not hasattr(asyncio.sslproto.SSLProtocol, 'max_size'):
+      log.warning("SSL buffer size of %d not applied, not supported on Python %d.%d", size, *version)
+      return
+   asyncio.sslproto.SSLProtocol.max_size = size
+   log.info("SSL buffer size set to %d", size)
+
+#
+# Starts the asyncio server, never returns
+#
+#   hostPort         : address to listen on
+#   sslContext       : server SSL context, None when SSL is disabled
+#   checkCertificate : function validating the client certificate
+#   serveRequest     : function processing one request from the client (see poll_server.ServeRequest)
+#   reusePort        : listen with SO_REUSEPORT, set by the worker processes of the pre-fork mode
+#
+def RunAsyncServer(hostPort, sslContext, checkCertificate, serveRequest, reusePort=False):
+   SetSSLBufferSize(POLLSERVER_ASYNC_SSL_BUFFER_SIZE)
+   asyncio.run(AsyncPollServer(checkCertificate, serveRequest).serve(hostPort, sslContext, reusePort or None))
@@ -33,19 +33,33 @@ allCommands = {
    "remove_poll_choices": "Remove poll choices from existing poll",
    "set_poll_status": "Open or Close existing poll",
    "make_poll_choice": "Make poll choice by user",
+   "make_poll_choices": "Make choices in many polls in one request",
    "get_poll_results": "Print results for a poll",
+   "watch_poll_results": "Print the changes of the results of a poll as the server pushes them",
    "list_users": "Print list of users in the system",
    "list_polls": "Print list of polls in the system",
    "print_poll": "Print poll data for a given poll",
    "print_user": "Print user data for a given user",
+   "reconnect": "Close the connection to the server and connect again",
+   "tls_stats": "Print the number of full and resumed TLS handshakes",
+   "wire_version": "Print or change the wire format version of the connection",
+   "pipeline": "Send many list/results commands at once and print the responses as they arrive",
    "quit": "Exit the program",
 }
 
 c_sock = None
 ssl_c_sock = None
+framed_c_sock = None
 ssl_context = None
+ssl_session = None
 use_ssl = True
 
+# wire format version asked for when connecting (see NEGOTIATE_VERSION in poll_message_api)
+wire_version = POLL_WIRE_VERSION_MAX
+
+# Counters of the full and the resumed TLS handshakes done by the client
+tlsHandshakeStats = {'full': 0, 'resumed': 0}
+
 def CheckServerCertificate(ssl_c_sock):
    if use_ssl:
       ssl_server_cert = ssl_c_sock.getpeercert();
@@ -70,31 +84,116 @@ def CheckServerCertificate(ssl_c_sock):
              raise Exception("Server certificate not yet active");
    return
 
+#
+# The TLS session of the last connection is cached (ssl_session) and offered to the
+# server on reconnect. If the server accepts the session ticket, the TLS session is
+# resumed without the full certificate-authenticated handshake.
+#
+def getSSLContext():
+   global ssl_context
+
+   if ssl_context is None:
+      ssl_context                     = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+      ssl_context.verify_mode         = ssl.CERT_REQUIRED;
+      ssl_context.check_hostname      = False
+      ssl_context.load_verify_locations("certificates/ca-cert.pem")
+      ssl_context.load_cert_chain(certfile="certificates/client-cert.pem", keyfile="certificates/client-key.pem")
+      #ssl_context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+
+   return ssl_context
+
 def getSocket():
    global c_sock
    global ssl_c_sock
-   global ssl_context
+   global framed_c_sock
+   global wire_version
 
    if c_sock is None:
       c_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
       if use_ssl:
-         ssl_context                     = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-         ssl_context.verify_mode         = ssl.CERT_REQUIRED;
-         ssl_context.check_hostname      = False
-         ssl_context.load_verify_locations("certificates/ca-cert.pem")
-         ssl_context.load_cert_chain(certfile="certificates/client-cert.pem", keyfile="certificates/client-key.pem")
-         #ssl_context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
-         ssl_c_sock  = ssl_context.wrap_socket(c_sock)
+         ssl_c_sock  = getSSLContext().wrap_socket(c_sock, session=ssl_session)
       else:
          ssl_c_sock = c_sock
 
       ssl_c_sock.connect(POLLSERVER_HOST_PORT)
 
+      if use_ssl:
+         if ssl_c_sock.session_reused:
+            tlsHandshakeStats['resumed'] += 1
+         else:
+            tlsHandshakeStats['full'] += 1
+
       CheckServerCertificate(ssl_c_sock)
 
-   return ssl_c_sock
+      # the responses are read via the framed reader
+      framed_c_sock = FramedSocket(ssl_c_sock)
+
+      if wire_version > POLL_WIRE_VERSION_1 and NegotiateWireVersion(framed_c_sock, wire_version) is None:
+         # the server does not support the negotiation, connect again with the version 1 format
+         closeSocket()
+         wire_version = POLL_WIRE_VERSION_1
+         return getSocket()
+
+   return framed_c_sock
+
+def closeSocket():
+   global c_sock
+   global ssl_c_sock
+   global framed_c_sock
+   global ssl_session
+
+   if c_sock is not None:
+      # TLS 1.3 session tickets arrive after the handshake, so the session
+      # is saved when the connection is closed
+      if use_ssl and ssl_c_sock.session is not None:
+         ssl_session = ssl_c_sock.session
+      ssl_c_sock.close()
+      c_sock = None
+      ssl_c_sock = None
+      framed_c_sock = None
    
+def printUsers(usersData):
+    for i in usersData:
+       print('\tuserID: %s, userName: %s, userEmail: %s' %(i['userID'], i['userName'], i['userEmail']))
+
+def printPolls(pollList):
+    for i in pollList:
+       print('\tpollID: %s, pollName: %s, pollStatus: %s' %(i['pollID'], i['pollName'], i['pollStatus']))
+       for j in i['choices']:
+          print('\t\tchoiceID: %s, choiceName: %s, pollCount: %s' %(j['choiceID'], i['choiceName'], i['pollCount']))
+
+def parseListArgs(args, filters, command):
+    """
+    Parses the arguments name=value of the list commands into filters, the dict of the
+    arguments with their default values. A plain argument is the value of 'prefix'.
+    Returns None if an argument is invalid.
+    """
+    filters = dict(filters)
+    for arg in args:
+       name, sep, value = arg.partition('=')
+       if not sep:
+          name, value = 'prefix', arg
+       if name not in filters:
+          print('Invalid argument %s. Type help %s' %(arg, command))
+          return None
+       filters[name] = value
+    return filters
+
+def printPollResults(pollResults):
+    pollName, pollResults = pollResults
+    print("\tpollName: %s" %(pollName))
+    for i in pollResults:
+       print('\t\tchoicename: %s, count: %s' %(i['choiceName'], i['count']))
+
+# Commands accepted by the pipeline command: number of arguments, send and recv functions of the
+# request and the function printing the data of the response
+pipelineCommands = {
+   "list_users": (0, sendListUsersReq, recvListUsersResponse, printUsers),
+   "list_polls": (0, sendListPollsReq, recvListPollsResponse, printPolls),
+   "get_poll_results": (1, sendPollGetResultsReq, recvPollGetResultsResponse, printPollResults),
+}
+
 def setupLogging(logLevel, logFile=None, logDir=None):
     """
     Create Logging Infrastructure to be used by various applications
@@ -225,6 +324,10 @@ class Shell(Cmd):
             except ValueError as ex:
                print(ex)
                pass
+            except OSError as ex:
+               # connection to the server is broken, next command reconnects
+               print(ex)
+               closeSocket()
 
             return None
 
@@ -252,6 +355,37 @@ class Shell(Cmd):
         """
         return True
 
+    @staticmethod
+    def do_reconnect(args):
+        """ usage: reconnect
+        Close the connection to the server and connect again, resuming the TLS session if possible.
+
+        The server forgets the login of a closed connection, so login_user is needed after reconnect.
+        """
+        closeSocket()
+        getSocket()
+        print("Reconnected, TLS session %s" %("resumed" if use_ssl and ssl_c_sock.session_reused else "not resumed"))
+
+    @staticmethod
+    def do_tls_stats(args):
+        """ usage: tls_stats
+        Print the number of full and resumed TLS handshakes done by this client
+        """
+        print("TLS handshakes: full %d, resumed %d" %(tlsHandshakeStats['full'], tlsHandshakeStats['resumed']))
+
+    @staticmethod
+    def do_wire_version(args):
+        """ usage: wire_version [version]
+        Print the wire format version of the connection, or connect again asking for the given version
+        """
+        global wire_version
+
+        if args:
+           wire_version = int(args[0])
+           closeSocket()
+        sock = getSocket()
+        print("Wire format version %d" %(sock.wireVersion))
+
     def do_create_user(self, args):
         """ usage: create_user userID userName userEmail [password]
         Create a new user ID.
@@ -389,35 +523,108 @@ class Shell(Cmd):
         msgType, flags, status, reason = recvResponseMessage(sock)
         print(GetMsgTypeString(msgType), args, status, GetReasonString(reason))
 
-    def do_list_users(self, args):
-        """ usage: list_users
-        List the users in the system
+    @staticmethod
+    def do_pipeline(args):
+        """ usage: pipeline command [args] [; command [args] ...]
+        Send the commands in one go, without waiting for the responses, and print the responses in
+        the order the server sends them. The server processes these commands concurrently:
+            list_users
+            list_polls
+            get_poll_results pollID
+
+        Needs the wire format version 3 (see wire_version).
         """
+        # split the arguments into the commands
+        commands = [[]]
+        for arg in args:
+           if arg == ';':
+              commands.append([])
+           else:
+              commands[-1].append(arg)
+        commands = [c for c in commands if c]
+
+        for c in commands:
+           if c[0] not in pipelineCommands or len(c) - 1 != pipelineCommands[c[0]][0]:
+              print('Invalid command %s. Type help pipeline' %(' '.join(c)))
+              return
 
         sock = getSocket()
-        r = sendListUsersReq(sock)
-        msgType, flags, status, reason, usersData = recvListUsersResponse(sock)
-        if status is not None:
-           print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
+        if sock.wireVersion < POLL_WIRE_VERSION_3:
+           print("Pipelining needs the wire format version %d, see wire_version" %(POLL_WIRE_VERSION_3))
+           return
+
+        pipeline = RequestPipeline(sock)
+        sent = {}
+        for c in commands:
+           numArgs, sendFunc, recvFunc, printFunc = pipelineCommands[c[0]]
+           sent[pipeline.send(sendFunc, recvFunc, *c[1:])] = c
+
+        while pipeline.pending:
+           requestID, (msgType, flags, status, reason, data) = pipeline.recv()
+           c = sent[requestID]
+           print("Request %d %s finished with status %s" %(requestID, ' '.join(c), GetReasonString(reason)))
            if status == 0:
-              for i in usersData:
-                 print('\tuserID: %s, userName: %s, userEmail: %s' %(i['userID'], i['userName'], i['userEmail']))
+              pipelineCommands[c[0]][3](data)
+
+    def do_list_users(self, args):
+        """ usage: list_users [userIDPrefix] [name=userNamePrefix] [page=N]
+        List the users in the system, or only the users whose userID starts with userIDPrefix
+        and whose name starts with userNamePrefix. The users are asked for a page of N users at
+        a time (default: the server's page size) and printed as they arrive.
+        """
+
+        filters = parseListArgs(args, {'prefix': '', 'name': '', 'page': '0'}, 'list_users')
+        if filters is None:
+           return
+
+        sock = getSocket()
+        nextUserID = ""
+        while True:
+           r = sendListUsersPageReq(sock, filters['prefix'], filters['name'], nextUserID, int(filters['page']))
+           # the responses of the page till endOfPage
+           while True:
+              msgType, flags, status, reason, (users, endOfPage, nextUserID) = recvListUsersPageResponse(sock)
+              if status != 0:
+                 if status is not None:
+                    print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
+                 return
+              for (userID, userName, userEmail) in users:
+                 print('\tuserID: %s, userName: %s, userEmail: %s' %(userID, userName, userEmail))
+              if endOfPage:
+                 break
+           if not nextUserID:
+              print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
+              return
 
     def do_list_polls(self, args):
-        """ usage: list_polls
-        List the polls created by the currently logged in user in the system
+        """ usage: list_polls [pollIDPrefix] [owner=userID] [status=O|C] [page=N]
+        List the polls in the system, or only the polls whose pollID starts with pollIDPrefix,
+        owned by a user or with a status. The polls are asked for a page of N polls at a time
+        (default: the server's page size) and printed as they arrive.
         """
 
+        filters = parseListArgs(args, {'prefix': '', 'owner': '', 'status': '', 'page': '0'}, 'list_polls')
+        if filters is None:
+           return
+
         sock = getSocket()
-        r = sendListPollsReq(sock)
-        msgType, flags, status, reason, pollList = recvListPollsResponse(sock)
-        if status is not None:
-           print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
-           if status == 0:
-              for i in pollList:
-                 print('\tpollID: %s, pollName: %s, pollStatus: %s' %(i['pollID'], i['pollName'], i['pollStatus']))
-                 for j in i['choices']:
-                    print('\t\tchoiceID: %s, choiceName: %s, pollCount: %s' %(j['choiceID'], i['choiceName'], i['pollCount']))
+        nextPollID = ""
+        while True:
+           r = sendListPollsPageReq(sock, filters['prefix'], filters['owner'], filters['status'], nextPollID, int(filters['page']))
+           # the responses of the page till endOfPage
+           while True:
+              msgType, flags, status, reason, (polls, endOfPage, nextPollID) = recvListPollsPageResponse(sock)
+              if status != 0:
+                 if status is not None:
+                    print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
+                 return
+              for (pollID, pollName, startDate, endDate, pollStatus) in polls:
+                 print('\tpollID: %s, pollName: %s, pollStatus: %s' %(pollID, pollName, pollStatus))
+              if endOfPage:
+                 break
+           if not nextPollID:
+              print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
+              return
 
     def do_get_poll_results(self, args):
         """ usage: get_poll_results pollID
@@ -435,9 +642,7 @@ class Shell(Cmd):
         if status is not None:
            print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
            if status == 0:
-              print("\tpollName: %s" %(pollName))
-              for i in pollResults:
-                 print('\t\tchoicename: %s, count: %s' %(i['choiceName'], i['count']))
+              printPollResults((pollName, pollResults))
 
         if len(pollResults) > 0 and len(args) > 1 and args[1] == 'pie':
            values = [i['count'] for i in pollResults]
@@ -447,6 +652,45 @@ class Shell(Cmd):
            plt.legend(title = pollName)
            plt.show()
 
+    def do_watch_poll_results(self, args):
+        """ usage: watch_poll_results pollID [numUpdates]
+        Subscribe to the results of a poll and print the counts of the choices as the server pushes
+        them: all the choices first, then the choices whose count changed. Stops after numUpdates
+        updates (default 10).
+        """
+
+        sock = getSocket()
+
+        if len(args) < 1:
+           print('Not enough arguments given. Type help <command>')
+           return
+        numUpdates = int(args[1]) if len(args) > 1 else 10
+
+        r = sendSubscribePollResultsReq(sock, args[0])
+        subscribed = True
+        while True:
+           msgType, flags = recvMsgHdr(sock)
+           if msgType is None:
+              print("Connection closed by the server")
+              return
+
+           if msgType == POLL_RESULTS_UPDATE:
+              pollID, updates = recvPollResultsUpdateData(sock)
+              print("\tpollID: %s" %(pollID))
+              for choiceID, count in updates:
+                 print('\t\tchoiceID: %s, count: %s' %(choiceID, count))
+              numUpdates -= 1
+              if numUpdates <= 0 and subscribed:
+                 # no update follows the response to the unsubscription
+                 r = sendSubscribePollResultsReq(sock, args[0], 0)
+                 subscribed = False
+              continue
+
+           status, reason = recvResponseMessageData(sock)
+           print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
+           if status != 0 or not subscribed:
+              return
+
     def do_make_poll_choice(self, args):
         """ usage: make_poll_choice pollID choiceID
         Make choice selection for a poll. User must be logged in.
@@ -461,6 +705,25 @@ class Shell(Cmd):
         msgType, flags, status, reason = recvResponseMessage(sock)
         print(GetMsgTypeString(msgType), args, status, GetReasonString(reason))
 
+    def do_make_poll_choices(self, args):
+        """ usage: make_poll_choices pollID choiceID [pollID choiceID ...]
+        Make choice selections for many polls in one request. User must be logged in.
+        """
+
+        if len(args) < 2 or len(args) % 2:
+           print('Not enough arguments given. Type help <command>')
+           return
+
+        sock = getSocket()
+        it = iter(args)
+        selections = [*zip(it, it)]
+        r = sendPollMakeSelectionBatchReq(sock, selections)
+        msgType, flags, status, reason, results = recvPollMakeSelectionBatchResponse(sock)
+        if status is not None:
+           print(GetMsgTypeString(msgType), "finished with status", GetReasonString(reason))
+           for (pollID, choiceID), (status, reason) in zip(selections, results):
+              print('\tpollID: %s, choiceID: %s, status: %s, %s' %(pollID, choiceID, status, GetReasonString(reason)))
+
 if __name__ == '__main__':
    plt.set_loglevel (level = 'warning')
    if len(sys.argv) > 1:
@@ -471,3 +734,4 @@ if __name__ == '__main__':
          input.close()
    else:
       Shell().cmdloop()
+   closeSocket()
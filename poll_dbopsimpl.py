@@ -1,7 +1,16 @@
+import os
 import sys
+import hmac
+import time
 import sqlite3
+import hashlib
 import threading
+import collections
+import poll_generations
+import poll_passwords
+import poll_scheduler
 from poll_message_api import *
+from poll_logging import log
 
 # Implements all the database operations (i.e adding/modifying/fetch data to/from database)
 #
@@ -9,9 +18,10 @@ from poll_message_api import *
 # any other way, just need to replace this file with new implementation and implement all the
 # API's in this file.
 #
-# There are 4 tables used to store the data
+# There are 5 tables used to store the data
 #    user_table : This table stores the user details. Primary key is userID
 #                 The fields are: userID, userName, userEmail, password
+#                 The password is stored salted and hashed (see poll_passwords)
 #
 #    poll_master_table: This is the master table that stores the poll data. The primary key is pollID
 #                 The fields are: pollID, pollName, status, ownerID, startDate, endDate
@@ -22,88 +32,583 @@ from poll_message_api import *
 #    user_poll_selection_table: For each of the poll, the choice made by individual users are stored in this table. The primary key is pollID + userID
 #                 The fields are: pollID, userID, choiceID
 #
+#    poll_tally_table: The number of votes for each choice of each poll. The primary key is pollID + choiceID
+#                 The fields are: pollID, choiceID, count
+#                 The counts are kept up to date by triggers on user_poll_selection_table (see POLL_TALLY_TRIGGERS)
+#
+# The tables and their indexes are created and upgraded by the schema migrations (see MigrateDatabase)
+#
 
 # this is the database file name
 POLLSERVER_DB = "poll_database.sqldb"
 
-cl_contexts = []
-contextLock = threading.Lock()
+# seconds a connection waits for the database write lock held by another connection
+POLLSERVER_DB_BUSY_TIMEOUT = 30
+
+#
+# Performance profiles of the database connections (see ConnectDatabase)
+#
+#   durable  : every commit is synced to the disk (synchronous=FULL) before it is acknowledged,
+#              so an acknowledged vote survives a power loss
+#   balanced : the WAL is synced at the checkpoints only (synchronous=NORMAL). A commit is one
+#              write to the WAL without fsync, an acknowledged vote survives a crash of the
+#              server but the last ones may be lost on a power loss or an OS crash. The
+#              database itself is never corrupted
+#   fast     : nothing is synced (synchronous=OFF). Survives a crash of the server, but a power
+#              loss or an OS crash may corrupt the database
+#   rollback : the rollback journal and synchronous=FULL (the SQLite defaults), for the file
+#              systems where WAL does not work (e.g. network file systems). The readers and the
+#              writer block each other
+#
+# Every thread has its own connection, so the settings below are paid once per connection:
+#
+#   mmap_size         : lets the readers read the pages from the page cache of the OS without
+#                       copying them. It costs address space per connection, not memory: the
+#                       mapped pages are the ones of the OS page cache, shared by all the
+#                       connections and processes
+#   cache_budget      : page cache (in KB) of all the connections of the server together. Every
+#                       connection gets its share as its cache_size, see
+#                       POLLSERVER_DB_NUM_CONNECTIONS
+#   temp_store=MEMORY : keeps the temporary tables and indexes of the queries (sorting, GROUP BY)
+#                       in memory
+#   cached_statements : number of prepared statements kept by every connection
+#
+POLLSERVER_DB_PROFILES = {
+   'durable':  {'journal_mode': 'WAL', 'synchronous': 'FULL', 'mmap_size': 0,
+                'cache_budget': 64000, 'temp_store': 'DEFAULT', 'cached_statements': 128},
+   'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 256 * 1024 * 1024,
+                'cache_budget': 256000, 'temp_store': 'MEMORY', 'cached_statements': 256},
+   'fast':     {'journal_mode': 'WAL', 'synchronous': 'OFF', 'mmap_size': 1024 * 1024 * 1024,
+                'cache_budget': 1024000, 'temp_store': 'MEMORY', 'cached_statements': 512},
+   'rollback': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'mmap_size': 0,
+                'cache_budget': 64000, 'temp_store': 'DEFAULT', 'cached_statements': 128},
+}
+
+# profile of the connections (see poll_server.py --db-profile)
+POLLSERVER_DB_PROFILE = 'balanced'
+
+# number of connections sharing the cache_budget of the profile, set by poll_server for its mode
+# and number of processes. None when it is not bounded (the thread mode has a connection per
+# client), every connection then gets POLLSERVER_DB_MIN_CACHE_SIZE
+POLLSERVER_DB_NUM_CONNECTIONS = 1
+
+# min page cache (in KB) of a connection, the SQLite default
+POLLSERVER_DB_MIN_CACHE_SIZE = 2000
+
+# number of polls (users) of a LIST_POLLS_PAGE (LIST_USERS_PAGE) page when the client does not
+# ask for a page size, and number of rows read from the database and sent to the client in one go
+POLLSERVER_LIST_PAGE_SIZE = 1000
+POLLSERVER_LIST_CHUNK_SIZE = 256
+
+# max number of rows of a LIST_POLLS or LIST_USERS response in the version 1 wire format, the
+# most its count can hold. A longer list is truncated and the response has the reason
+# REASON_LIST_TRUNCATED. The later versions have no limit
+POLLSERVER_LIST_MAX_ROWS = 65535
+
+# max number of users whose last successful login is cached, and seconds it is trusted (see
+# LoginCache)
+POLLSERVER_LOGIN_CACHE_SIZE = 100000
+POLLSERVER_LOGIN_CACHE_TTL = 300
+
+# max number of unknown userIDs cached, and seconds they are
+POLLSERVER_LOGIN_CACHE_UNKNOWN_SIZE = 10000
+POLLSERVER_LOGIN_CACHE_UNKNOWN_TTL = 30
+
+#
+# Registry of the client sessions (thread-contexts)
+#
+# The context of every connected client is indexed by its socket object and the contexts of
+# the logged in users are indexed by the userID, so adding, finding and removing a session and
+# checking if a user is logged in are O(1) irrespective of the number of live sessions.
+#
+# In the pre-fork mode (see poll_prefork) the worker processes share the logins: a login is also
+# claimed in user_session_table, whose primary key is the userID, so a user logged in via one
+# worker can not log in via another one. The rows of a worker are deleted when it exits.
+# The dicts are changed under the lock and user_session_table outside of it, so a commit never
+# holds up the other sessions: a login reserves the userID in byUserID, then claims it in the
+# table, and drops the reservation if the claim fails.
+#
+class SessionRegistry:
+   def __init__(self):
+      self.bySocket = {}
+      self.byUserID = {}
+      self.shared = False
+      self.lock = threading.Lock()
+
+   def __len__(self):
+      return len(self.bySocket)
+
+   def add(self, cl_sock, cl_address):
+      cntxt = {'socket': cl_sock,
+               'address': cl_address,
+               'userID': None,
+               'logged_in': False}
+      with self.lock:
+         self.bySocket[cl_sock] = cntxt
+      return cntxt
+
+   def get(self, cl_sock):
+      return self.bySocket.get(cl_sock)
+
+   def remove(self, cl_sock):
+      with self.lock:
+         cntxt = self.bySocket.pop(cl_sock, None)
+         released = cntxt is not None and cntxt['logged_in'] and self.unsetLogin(cntxt)
+      if released:
+         self.releaseLogin(cntxt['userID'])
+
+   def isLoggedIn(self, userID):
+      if userID in self.byUserID:
+         return True
+      if self.shared:
+         return bool(GetConnection().execute("SELECT userID from user_session_table WHERE userID=?", (userID,)).fetchall())
+      return False
+
+   # marks the user logged in the session, fails if the user is logged in any session
+   def login(self, userID, cntxt):
+      with self.lock:
+         if userID in self.byUserID:
+            return False
+         self.byUserID[userID] = cntxt
+
+      if self.shared and not self.claimLogin(userID):
+         with self.lock:
+            if self.byUserID.get(userID) is cntxt:
+               del self.byUserID[userID]
+         return False
+
+      with self.lock:
+         oldUserID = cntxt['userID']
+         released = cntxt['logged_in'] and self.unsetLogin(cntxt)
+         cntxt['userID'] = userID
+         cntxt['logged_in'] = True
+      if released:
+         self.releaseLogin(oldUserID)
+      return True
+
+   def logout(self, cntxt):
+      with self.lock:
+         userID = cntxt['userID']
+         released = cntxt['logged_in'] and self.unsetLogin(cntxt)
+         cntxt['userID'] = None
+         cntxt['logged_in'] = False
+      if released:
+         self.releaseLogin(userID)
+
+   # must be called with the lock held. Drops the login of the session from byUserID, returns
+   # whether the caller must then release it in user_session_table (see releaseLogin)
+   def unsetLogin(self, cntxt):
+      if self.byUserID.get(cntxt['userID']) is cntxt:
+         del self.byUserID[cntxt['userID']]
+         return self.shared
+      return False
+
+   # claims the login of the user for this process in user_session_table
+   def claimLogin(self, userID):
+      conn = GetConnection()
+      try:
+         conn.execute("INSERT INTO user_session_table VALUES(?, ?)", (userID, os.getpid()))
+         conn.commit()
+      except sqlite3.IntegrityError:
+         conn.rollback()
+         return False
+      return True
+
+   def releaseLogin(self, userID):
+      conn = GetConnection()
+      conn.execute("DELETE FROM user_session_table WHERE (userID=? and pid=?)", (userID, os.getpid()))
+      conn.commit()
+
+cl_sessions = SessionRegistry()
 
 def GetThreadContext(cl_sock):
-   # CONTEXT LOCK
-   contextLock.acquire()
-   cntxt = [c for c in cl_contexts if c['socket'] == cl_sock]
-   # CONTEXT UNLOCK
-   contextLock.release()
-
-   if cntxt:
-      return cntxt[0]
-   else:
-      return None
+   return cl_sessions.get(cl_sock)
 
 def RemoveThreadContext(cl_sock):
-   # CONTEXT LOCK
-   contextLock.acquire()
-   cntxt = [i for i in cl_contexts if i['socket'] == cl_sock]
-   cl_contexts.remove(cntxt[0])
-   contextLock.release()
-   # CONTEXT UNLOCK
-
-def AddThreadContext(cl_sock, cl_address, conn, lock):
-   # CONTEXT LOCK
-   contextLock.acquire()
-   cl_contexts.append({'socket': cl_sock,
-                       'address': cl_address,
-                       'conn': conn,
-                       'lock': lock,
-                       'userID': None,
-                       'logged_in': False})
-   # CONTEXT UNLOCK
-   contextLock.release()
-
-def ConnectDatabase():
-   return sqlite3.connect(POLLSERVER_DB, check_same_thread=False)
-
-def CreateTable(cur, tableName, fields):
-   sqlCmd = f"CREATE TABLE {tableName} ({fields})"
-   try:
+   cl_sessions.remove(cl_sock)
+
+def AddThreadContext(cl_sock, cl_address):
+   return cl_sessions.add(cl_sock, cl_address)
+
+# Shares the logins with the other processes via user_session_table (see SessionRegistry)
+def EnableSharedSessions():
+   cl_sessions.shared = True
+
+# Drops the logins of the process pid, of all the processes if pid is None (see poll_prefork)
+def RemoveProcessSessions(conn, pid=None):
+   if pid is None:
+      conn.execute("DELETE FROM user_session_table")
+   else:
+      conn.execute("DELETE FROM user_session_table WHERE pid=?", (pid,))
+   conn.commit()
+
+#
+# Every thread gets its own database connection (see GetConnection()). The database is
+# in WAL mode (except in the rollback profile), so the readers never block the writer and each
+# other, and the writers are serialized by SQLite's own write lock: a writer waits for the lock
+# up to POLLSERVER_DB_BUSY_TIMEOUT seconds.
+#
+# The pragmas of the profile POLLSERVER_DB_PROFILE are set on every connection, with its share
+# of the cache budget.
+#
+def ConnectDatabase(profileName=None):
+   profile = dict(POLLSERVER_DB_PROFILES[profileName or POLLSERVER_DB_PROFILE])
+   conn = sqlite3.connect(POLLSERVER_DB, timeout=POLLSERVER_DB_BUSY_TIMEOUT,
+                          cached_statements=profile.pop('cached_statements'))
+   # negative: in KB
+   profile['cache_size'] = -GetCacheSize(profile.pop('cache_budget'))
+   for pragma, value in profile.items():
+      conn.execute(f"PRAGMA {pragma}={value}")
+   return conn
+
+# Returns the page cache (in KB) of a connection, its share of the cache budget
+def GetCacheSize(cacheBudget):
+   if POLLSERVER_DB_NUM_CONNECTIONS is None:
+      return POLLSERVER_DB_MIN_CACHE_SIZE
+   return max(POLLSERVER_DB_MIN_CACHE_SIZE, cacheBudget // POLLSERVER_DB_NUM_CONNECTIONS)
+
+dbLocal = threading.local()
+
+# Returns the database connection of the calling thread, connecting on first use.
+# The connection is closed when the thread exits.
+def GetConnection():
+   conn = getattr(dbLocal, 'conn', None)
+   if conn is None:
+      conn = ConnectDatabase()
+      dbLocal.conn = conn
+   return conn
+
+#
+# Cache of the poll data needed to validate a vote: the status and the choiceIDs of every poll
+#
+# A vote is validated against the cache instead of reading the poll and choice tables for
+# every vote. The entry of a poll is loaded on first use (None if the poll does not exist)
+# and dropped by every operation changing the poll (AddPoll, AddPollChoices, RemovePollChoices,
+# SetPollStatus) after it commits. An entry loaded while the poll was being changed is not
+# kept, so the cache never holds data older than the last change. The changes committed by
+# the other worker processes are seen via the generation of the poll (see poll_generations).
+#
+class PollCache:
+   def __init__(self):
+      # pollID -> (poll, generation of the poll when it was read)
+      self.polls = {}
+      self.version = 0
+      self.lock = threading.Lock()
+
+   # returns (status, set of choiceIDs) of the poll, None if there is no such poll
+   def get(self, conn, pollID):
+      generation = poll_generations.GetGeneration(pollID)
+      entry = self.polls.get(pollID)
+      if entry is not None and entry[1] == generation:
+         return entry[0]
+
+      version = self.version
+      status = conn.execute("SELECT status from poll_master_table where (pollID=?)", (pollID,)).fetchall()
+      if status:
+         choices = conn.execute("SELECT choiceID from poll_choices_table where (pollID=?)", (pollID,)).fetchall()
+         poll = (status[0][0], frozenset(r[0] for r in choices))
+      else:
+         poll = None
+
+      with self.lock:
+         if version == self.version:
+            self.polls[pollID] = (poll, generation)
+      return poll
+
+   def invalidate(self, pollID):
+      with self.lock:
+         self.version += 1
+         self.polls.pop(pollID, None)
+      poll_generations.BumpGeneration(pollID)
+
+pollCache = PollCache()
+
+#
+# Cache of the recent login verifications (see ValidateUser)
+#
+# A client reconnecting after a dropped connection logs in again with the same password, and
+# every login reads user_table and computes the KDF of the password (see poll_passwords). The
+# cache keeps, for the last POLLSERVER_LOGIN_CACHE_SIZE users logged in, a digest of the password
+# verified: an HMAC-SHA256 with a random key of the process, so the cache holds neither the
+# password nor a hash of it usable outside the process. A login with the same password within
+# POLLSERVER_LOGIN_CACHE_TTL seconds succeeds without the database and the KDF. A login with
+# another password is verified in full, so the cache does not speed up guessing passwords.
+#
+# The userIDs not found are also cached, for POLLSERVER_LOGIN_CACHE_UNKNOWN_TTL seconds and
+# apart from the users, so a flood of logins with unknown userIDs neither reads the database
+# nor evicts the users.
+#
+# The entry of a user is dropped by ChangeUser and AddUser after they commit, and an entry loaded
+# meanwhile is not kept. The changes committed by the other worker processes of the pre-fork mode
+# are seen via the generation of the user (see GetUserGenerationKey).
+#
+class LoginCache:
+   def __init__(self):
+      # userID -> (expiry, generation of the user when it was read, digest of the password)
+      self.users = collections.OrderedDict()
+      # userID -> (expiry, generation of the user when it was read)
+      self.unknown = collections.OrderedDict()
+      self.key = os.urandom(32)
+      self.version = 0
+      self.lock = threading.Lock()
+
+   def digest(self, userPwd):
+      return hmac.new(self.key, userPwd, hashlib.sha256).digest()
+
+   # returns (status, reason) of the login, like ValidateUser
+   def validate(self, conn, userID, userPwd):
+      generation = poll_generations.GetGeneration(GetUserGenerationKey(userID))
+      digest = self.digest(userPwd)
+      now = time.monotonic()
+      with self.lock:
+         entry = self.unknown.get(userID)
+         if entry is not None:
+            if entry[0] > now and entry[1] == generation:
+               return (OP_FAILURE, REASON_USER_ID_NOT_FOUND)
+            del self.unknown[userID]
+
+         entry = self.users.get(userID)
+         if entry is not None:
+            if entry[0] <= now or entry[1] != generation:
+               del self.users[userID]
+            elif hmac.compare_digest(entry[2], digest):
+               self.users.move_to_end(userID)
+               return (OP_SUCCESS, REASON_SUCCESS)
+         version = self.version
+
+      status, reason = VerifyUser(conn, userID, userPwd)
+
+      with self.lock:
+         if version == self.version:
+            if status == OP_SUCCESS:
+               self.add(self.users, userID, (now + POLLSERVER_LOGIN_CACHE_TTL, generation, digest),
+                        POLLSERVER_LOGIN_CACHE_SIZE)
+            elif reason == REASON_USER_ID_NOT_FOUND:
+               self.add(self.unknown, userID, (now + POLLSERVER_LOGIN_CACHE_UNKNOWN_TTL, generation),
+                        POLLSERVER_LOGIN_CACHE_UNKNOWN_SIZE)
+      return (status, reason)
+
+   # must be called with the lock held
+   def add(self, entries, userID, entry, maxSize):
+      entries[userID] = entry
+      entries.move_to_end(userID)
+      if len(entries) > maxSize:
+         entries.popitem(last=False)
+
+   def invalidate(self, userID):
+      with self.lock:
+         self.version += 1
+         self.users.pop(userID, None)
+         self.unknown.pop(userID, None)
+      poll_generations.BumpGeneration(GetUserGenerationKey(userID))
+
+# the users share the generation counters with the polls
+def GetUserGenerationKey(userID):
+   return f"user:{userID}"
+
+loginCache = LoginCache()
+
+#
+# The tally table holds the vote count of every (pollID, choiceID), so the results of a poll
+# are read in O(number of choices) instead of counting the votes on every request.
+#
+# The counts are maintained by triggers in the same transaction as the vote: a new vote
+# increments its choice, a changed vote decrements the old choice and increments the new one
+# (the UPSERT in PollMakeSelections fires the UPDATE trigger), and a removed vote decrements
+# its choice. When the table is added to an existing database, it is filled from the votes.
+#
+POLL_TALLY_TRIGGERS = [
+   """CREATE TRIGGER IF NOT EXISTS poll_tally_insert AFTER INSERT ON user_poll_selection_table
+      BEGIN
+         INSERT INTO poll_tally_table VALUES(NEW.pollID, NEW.choiceID, 1)
+            ON CONFLICT(pollID, choiceID) DO UPDATE SET count=count+1;
+      END""",
+   """CREATE TRIGGER IF NOT EXISTS poll_tally_update AFTER UPDATE OF choiceID ON user_poll_selection_table
+      WHEN OLD.choiceID IS NOT NEW.choiceID
+      BEGIN
+         UPDATE poll_tally_table SET count=count-1 WHERE (pollID=OLD.pollID and choiceID=OLD.choiceID);
+         INSERT INTO poll_tally_table VALUES(NEW.pollID, NEW.choiceID, 1)
+            ON CONFLICT(pollID, choiceID) DO UPDATE SET count=count+1;
+      END""",
+   """CREATE TRIGGER IF NOT EXISTS poll_tally_delete AFTER DELETE ON user_poll_selection_table
+      BEGIN
+         UPDATE poll_tally_table SET count=count-1 WHERE (pollID=OLD.pollID and choiceID=OLD.choiceID);
+      END""",
+]
+
+#
+# Typed columns of the tables
+#
+# The tables are WITHOUT ROWID: their primary keys are text and their rows are small, so a row
+# is stored in the b-tree of its primary key and a lookup by the key is one b-tree search
+# instead of two (the primary key index, then the rowid table).
+#
+POLL_DB_TABLES = {
+   "user_table": "userID TEXT NOT NULL, userName TEXT, userEmail TEXT, password TEXT, " +
+                 "PRIMARY KEY (userID)",
+   "poll_master_table": "pollID TEXT NOT NULL, pollName TEXT, status TEXT, ownerID TEXT, " +
+                        "startDate TEXT, endDate TEXT, PRIMARY KEY (pollID)",
+   "poll_choices_table": "pollID TEXT NOT NULL, choiceID TEXT NOT NULL, choiceName TEXT, " +
+                         "PRIMARY KEY (pollID, choiceID)",
+   "user_poll_selection_table": "pollID TEXT NOT NULL, userID TEXT NOT NULL, choiceID TEXT, " +
+                                "PRIMARY KEY (pollID, userID)",
+   "poll_tally_table": "pollID TEXT NOT NULL, choiceID TEXT NOT NULL, count INTEGER NOT NULL, " +
+                       "PRIMARY KEY (pollID, choiceID)",
+}
+
+# the logged in users and the process they are logged in via (see SessionRegistry)
+POLL_DB_SESSION_TABLE = ("CREATE TABLE IF NOT EXISTS user_session_table (userID TEXT NOT NULL, pid INTEGER NOT NULL, " +
+                         "PRIMARY KEY (userID)) WITHOUT ROWID")
+
+#
+# Secondary indexes. Every index of a WITHOUT ROWID table also holds the primary key of the
+# table, so the indexes cover the queries below without reading the table. The results are read
+# from the tally table by its primary key and need no index of their own.
+#
+POLL_DB_INDEXES = [
+   # the polls owned by a user (SetPollStatus, the polls of the logged in user)
+   "CREATE INDEX IF NOT EXISTS poll_master_owner_idx ON poll_master_table (ownerID)",
+   # counting the votes of every choice of a poll (filling the tally table)
+   "CREATE INDEX IF NOT EXISTS user_poll_selection_choice_idx ON user_poll_selection_table (pollID, choiceID)",
+   # the votes of a user: (userID, choiceID) and the pollID of the primary key
+   "CREATE INDEX IF NOT EXISTS user_poll_selection_user_idx ON user_poll_selection_table (userID, choiceID)",
+]
+
+def TableExists(cur, tableName):
+   return bool(cur.execute("SELECT name from sqlite_master WHERE (type='table' and name=?)", (tableName,)).fetchall())
+
+#
+# Schema migrations
+#
+# The database records the number of migrations applied to it in PRAGMA user_version: 0 for a
+# new database and for the databases of the servers without migrations, which may or may not
+# have the tally table. On startup the missing migrations are applied in order (see
+# MigrateDatabase), each in its own transaction together with the new user_version, so a
+# database is never left half migrated and the old databases are upgraded in place.
+#
+# Every migration works on the database as left by the ones before it and checks what it
+# creates. To change the schema, add a migration at the end of POLL_DB_MIGRATIONS, never change
+# the ones already applied to the databases out there.
+#
+
+# version 1: the untyped tables and the tally table, as created by the servers without migrations
+def MigrateInitialTables(cur):
+   cur.execute("CREATE TABLE IF NOT EXISTS user_table (userID, userName, userEmail, password, primary key (userID))")
+   cur.execute("CREATE TABLE IF NOT EXISTS poll_master_table (pollID, pollName, status, ownerID, startDate, endDate, primary key (pollID))")
+   cur.execute("CREATE TABLE IF NOT EXISTS poll_choices_table (pollID, choiceID, choiceName, primary key (pollID, choiceID))")
+   cur.execute("CREATE TABLE IF NOT EXISTS user_poll_selection_table (pollID, userID, choiceID, primary key(pollID, userID))")
+   if not TableExists(cur, "poll_tally_table"):
+      cur.execute("CREATE TABLE poll_tally_table (pollID, choiceID, count, primary key (pollID, choiceID))")
+      cur.execute("INSERT INTO poll_tally_table SELECT pollID, choiceID, count(*) " +
+                  "from user_poll_selection_table GROUP BY pollID, choiceID")
+   for sqlCmd in POLL_TALLY_TRIGGERS:
       cur.execute(sqlCmd)
-   except sqlite3.OperationalError as opErr:
-      print(opErr)
 
-def CreateTables(conn):
-   cur = conn.cursor()
-   CreateTable(cur, "user_table", "userID, userName, userEmail, password, primary key (userID)")
-   CreateTable(cur, "poll_master_table", "pollID, pollName, status, ownerID, startDate, endDate, primary key (pollID)")
-   CreateTable(cur, "poll_choices_table", "pollID, choiceID, choiceName, primary key (pollID, choiceID)")
-   CreateTable(cur, "user_poll_selection_table", "pollID, userID, choiceID, primary key(pollID, userID)")
+# version 2: the typed WITHOUT ROWID tables (POLL_DB_TABLES). SQLite can not change the columns
+# of a table, so every table is copied to a new one replacing it.
+def MigrateTypedTables(cur):
+   # the triggers refer to the tally table, which is replaced
+   for (triggerName,) in cur.execute("SELECT name from sqlite_master WHERE (type='trigger' and name like 'poll_tally_%')").fetchall():
+      cur.execute(f"DROP TRIGGER {triggerName}")
+
+   droppedVotes = False
+   for tableName, columns in POLL_DB_TABLES.items():
+      cur.execute(f"CREATE TABLE {tableName}_new ({columns}) WITHOUT ROWID")
+      # the rows with a NULL key, which the rowid tables accept, can not be copied: they are
+      # logged and dropped. Any other row failing to copy fails the migration
+      keyColumns = [column[1] for column in cur.execute(f"PRAGMA table_info({tableName}_new)").fetchall() if column[5]]
+      nullKey = ' or '.join(f"{column} IS NULL" for column in keyColumns)
+      droppedRows = cur.execute(f"SELECT * from {tableName} WHERE ({nullKey})").fetchall()
+      for row in droppedRows:
+         log.warning("%s: dropping the row %r, its primary key is NULL", tableName, row)
+      cur.execute(f"INSERT INTO {tableName}_new SELECT * from {tableName} WHERE NOT ({nullKey})")
+      cur.execute(f"DROP TABLE {tableName}")
+      cur.execute(f"ALTER TABLE {tableName}_new RENAME TO {tableName}")
+      droppedVotes = droppedVotes or (tableName == "user_poll_selection_table" and droppedRows)
+
+   # the tally table still counts the dropped votes
+   if droppedVotes:
+      cur.execute("DELETE FROM poll_tally_table")
+      cur.execute("INSERT INTO poll_tally_table SELECT pollID, choiceID, count(*) " +
+                  "from user_poll_selection_table GROUP BY pollID, choiceID")
+
+   for sqlCmd in POLL_TALLY_TRIGGERS:
+      cur.execute(sqlCmd)
+
+# version 3: the secondary indexes (POLL_DB_INDEXES)
+def MigrateIndexes(cur):
+   for sqlCmd in POLL_DB_INDEXES:
+      cur.execute(sqlCmd)
+   cur.execute("ANALYZE")
+
+# version 4: the index searching the users by the prefix of their name (see ListUsersPage)
+def MigrateUserNameIndex(cur):
+   cur.execute("CREATE INDEX IF NOT EXISTS user_name_idx ON user_table (userName)")
+   cur.execute("ANALYZE user_table")
+
+# version 5: the login sessions shared by the worker processes (POLL_DB_SESSION_TABLE)
+def MigrateSessionTable(cur):
+   cur.execute(POLL_DB_SESSION_TABLE)
+
+POLL_DB_MIGRATIONS = [
+   MigrateInitialTables,
+   MigrateTypedTables,
+   MigrateIndexes,
+   MigrateUserNameIndex,
+   MigrateSessionTable,
+]
+
+def GetSchemaVersion(conn):
+   return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Applies the migrations missing in the database
+def MigrateDatabase(conn):
+   if GetSchemaVersion(conn) > len(POLL_DB_MIGRATIONS):
+      log.warning("database schema version %d is newer than this server (%d)", GetSchemaVersion(conn), len(POLL_DB_MIGRATIONS))
+      return
+
+   for version, migration in enumerate(POLL_DB_MIGRATIONS, 1):
+      # the version is read holding the write lock, so a migration is applied once even if
+      # many servers start together
+      conn.execute("BEGIN IMMEDIATE")
+      try:
+         if GetSchemaVersion(conn) < version:
+            log.info("migrating the database to schema version %d (%s)", version, migration.__name__)
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version={version}")
+         conn.commit()
+      except sqlite3.Error:
+         conn.rollback()
+         raise
 
-   return cur
+def CreateTables(conn):
+   MigrateDatabase(conn)
+   return conn.cursor()
 
 def AddUser(conn, userID, userName, userEmail, userPwd):
-   print(userID, userName, userEmail, userPwd)
-   print(len(userID), len(userName), len(userEmail), len(userPwd))
-
    ### Add duplicate userID, valid userID checks
    if IsUserIDAlreadyExists(conn, userID):
       return (OP_FAILURE, REASON_DUPLICATE_USER_ID)
 
-   status = conn.execute("INSERT INTO user_table VALUES(?, ?, ?, ?)", (userID, userName, userEmail, userPwd))
-   print(status)
-   status = conn.execute("commit")
-   print(status)
+   pwdHash = poll_passwords.HashPassword(userPwd)
+   try:
+      status = conn.execute("INSERT INTO user_table VALUES(?, ?, ?, ?)", (userID, userName, userEmail, pwdHash))
+   except sqlite3.IntegrityError as opErr:
+      # another session added the same userID after the check above
+      conn.rollback()
+      return (OP_FAILURE, REASON_DUPLICATE_USER_ID)
+   conn.commit()
+   # the userID may be cached as unknown
+   loginCache.invalidate(userID)
    return (OP_SUCCESS, REASON_SUCCESS)
 
 def ChangeUser(conn, userID, userName, userEmail, userPwd):
-   print(userID, userName, userEmail, userPwd)
-   print(len(userID), len(userName), len(userEmail), len(userPwd))
-
    ### Add valid user ID check
 
-   status = conn.execute("UPDATE user_table SET userName=?, userEmail=?, password=? WHERE userID=?", (userName, userEmail, userPwd, userID))
-   print(status)
-   status = conn.execute("commit")
-   print(status)
+   pwdHash = poll_passwords.HashPassword(userPwd)
+   status = conn.execute("UPDATE user_table SET userName=?, userEmail=?, password=? WHERE userID=?", (userName, userEmail, pwdHash, userID))
+   conn.commit()
+   loginCache.invalidate(userID)
    return (OP_SUCCESS, REASON_SUCCESS)
 
 def IsUserIDAlreadyExists(conn, userID):
@@ -114,18 +619,27 @@ def IsUserIDAlreadyExists(conn, userID):
    return False
 
 def ValidateUser(conn, userID, userPwd):
+   return loginCache.validate(conn, userID, userPwd)
+
+# validates the login against user_table, without the cache
+def VerifyUser(conn, userID, userPwd):
    cur = conn.execute("SELECT password from user_table WHERE userID=?", (userID,))
    data = cur.fetchall()
-   print(userID, userPwd, data)
    if not data:
-      status = OP_FAILURE
-      reason = REASON_USER_ID_NOT_FOUND
-   elif data[0][0] != userPwd:
+      return (OP_FAILURE, REASON_USER_ID_NOT_FOUND)
+
+   pwdHash = data[0][0]
+   valid, newHash = poll_passwords.VerifyPassword(userPwd, pwdHash)
+   if not valid:
       status = OP_FAILURE
       reason = REASON_INCORRECT_PWD
    else:
       status = OP_SUCCESS
       reason = REASON_SUCCESS
+      if newHash is not None:
+         # legacy SHA-256 hash or older KDF parameters, unless the password was changed meanwhile
+         conn.execute("UPDATE user_table SET password=? WHERE (userID=? and password=?)", (newHash, userID, pwdHash))
+         conn.commit()
 
    return (status, reason)
 
@@ -133,40 +647,94 @@ def AmILoggedIn(userID, cntxt):
    return cntxt['userID'] == userID and cntxt['logged_in']
 
 def IsUserLoggedIn(userID):
-   found = [c for c in cl_contexts if c['userID'] == userID and c['logged_in']]
-   if found:
-      return True
-   return False
+   return cl_sessions.isLoggedIn(userID)
 
 def SetUserLoggedIn(userID, cntxt):
-   if IsUserLoggedIn(userID):
-      ret = (OP_FAILURE, REASON_ALREADY_LOGGED_IN)
-   else:
-      cntxt['userID'] = userID
-      cntxt['logged_in'] = True
+   if cl_sessions.login(userID, cntxt):
       ret = (OP_SUCCESS, REASON_SUCCESS)
+   else:
+      ret = (OP_FAILURE, REASON_ALREADY_LOGGED_IN)
    return ret
 
 def SetUserLoggedOut(cntxt):
-   # CONTEXT LOCK
-   contextLock.acquire()
-   cntxt['userID'] = None
-   cntxt['logged_in'] = False
-   contextLock.release()
-   # CONTEXT UNLOCK
-
-def ListUsers(cntxt):
-   conn = cntxt['conn']
-   cur = conn.execute("SELECT * from user_table")
-   data = cur.fetchall()
+   cl_sessions.logout(cntxt)
+
+#
+# Reads a page of at most pageSize rows from the cursor of a query ordered by the key of the
+# rows, its first column, and limited to pageSize + 1 rows (the extra row tells if there is a
+# next page)
+#
+# The rows are yielded in chunks of at most chunkSize rows as they are read, so the memory used
+# does not depend on the page size: (rows, None) for every chunk but the last one, and
+# (rows, nextKey) for the last one, where nextKey is the key to list the next page after, "" if
+# there are no more rows.
+#
+def FetchPage(cur, pageSize, chunkSize):
+   try:
+      remaining = pageSize
+      rows = cur.fetchmany(min(chunkSize, remaining))
+      while True:
+         remaining -= len(rows)
+         if remaining == 0:
+            yield rows, (rows[-1][0] if cur.fetchone() is not None else "")
+            return
+         nextRows = cur.fetchmany(min(chunkSize, remaining))
+         if not nextRows:
+            yield rows, ""
+            return
+         yield rows, None
+         rows = nextRows
+         # the votes go first (see poll_scheduler)
+         poll_scheduler.YieldToWrites()
+   finally:
+      cur.close()
+
+# the condition and the parameters selecting the strings starting with prefix, as a range
+# search that can use an index
+def PrefixRange(column, prefix):
+   return f" and {column} >= ? and {column} < ?", [prefix, prefix + '\U0010ffff']
+
+#
+# Lists a page of the users (see LIST_USERS_PAGE), pageSize users at most, ordered by userID,
+# after the user afterUserID. The users are filtered by the prefix of their userID and of their
+# userName ("" for any). Yields the users (userID, userName, userEmail) in chunks, as
+# FetchPage().
+#
+def ListUsersPage(conn, userIDPrefix, userNamePrefix, afterUserID, pageSize, chunkSize):
+   sqlCmd = "SELECT userID, ifnull(userName, ''), ifnull(userEmail, '') from user_table WHERE (1"
+   params = []
+   if afterUserID:
+      sqlCmd += " and userID > ?"
+      params.append(afterUserID)
+   for column, prefix in [('userID', userIDPrefix), ('userName', userNamePrefix)]:
+      if prefix:
+         condition, values = PrefixRange(column, prefix)
+         sqlCmd += condition
+         params += values
+   sqlCmd += ") ORDER BY userID LIMIT ?"
+   params.append(pageSize + 1)
+
+   return FetchPage(conn.execute(sqlCmd, params), pageSize, chunkSize)
+
+# Lists the users, page by page (see ListUsersPage). With maxRows, at most maxRows users are
+# listed and the reason is REASON_LIST_TRUNCATED if there are more
+def ListUsers(conn, maxRows=None):
    userList = []
-   for r in data:
-      userList.append({
-            'userID': r[0],
-            'userName': r[1],
-            'userEmail': r[2],
-         })
-   return OP_SUCCESS, REASON_SUCCESS, userList
+   afterUserID = ""
+   while True:
+      pageSize = POLLSERVER_LIST_MAX_ROWS if maxRows is None else maxRows - len(userList)
+      for users, nextUserID in ListUsersPage(conn, "", "", afterUserID, pageSize, POLLSERVER_LIST_CHUNK_SIZE):
+         for r in users:
+            userList.append({
+                  'userID': r[0],
+                  'userName': r[1],
+                  'userEmail': r[2],
+               })
+      if not nextUserID:
+         return OP_SUCCESS, REASON_SUCCESS, userList
+      if maxRows is not None:
+         return OP_SUCCESS, REASON_LIST_TRUNCATED, userList
+      afterUserID = nextUserID
    
 
 def AddPoll(conn, userID, pollID, pollName, openDateTime, closeDateTime, pollChoices):
@@ -174,14 +742,13 @@ def AddPoll(conn, userID, pollID, pollName, openDateTime, closeDateTime, pollCho
       return OP_FAILURE, REASON_NOT_ENOUCH_CHOICES
 
    pollChoices = list(map(lambda c: (pollID,)+c, pollChoices))
-   print(conn, userID, pollID, pollName, openDateTime, closeDateTime, pollChoices)
-   
    try:
       cur = conn.cursor()
       cur.execute("INSERT INTO poll_master_table VALUES(?, ?, ?, ?, ?, ?)", (pollID, pollName, 'C', userID, openDateTime, closeDateTime))
       if pollChoices:
          cur.executemany("INSERT INTO poll_choices_table VALUES(?, ?, ?)", pollChoices)
       conn.commit()
+      pollCache.invalidate(pollID)
       status, reason = OP_SUCCESS, REASON_SUCCESS
    except sqlite3.IntegrityError as opErr:
       if opErr.sqlite_errorcode == sqlite3.SQLITE_CONSTRAINT_PRIMARYKEY:
@@ -207,7 +774,6 @@ def IsPollIDExists(conn, pollID):
 
 def AddPollChoices(conn, pollID, userID, pollChoices):
    pollChoices = list(map(lambda c: (pollID,)+c, pollChoices))
-   print(conn, userID, pollID, pollChoices)
 
    if not IsPollIDExists(conn, pollID):
       return (OP_FAILURE, REASON_NOSUCH_POLL_ID)
@@ -216,6 +782,7 @@ def AddPollChoices(conn, pollID, userID, pollChoices):
       cur = conn.cursor()
       cur.executemany("INSERT INTO poll_choices_table VALUES(?, ?, ?)", pollChoices)
       conn.commit()
+      pollCache.invalidate(pollID)
       status, reason = OP_SUCCESS, REASON_SUCCESS
    except sqlite3.IntegrityError as opErr:
       if opErr.sqlite_errorcode == sqlite3.SQLITE_CONSTRAINT_PRIMARYKEY:
@@ -229,12 +796,12 @@ def AddPollChoices(conn, pollID, userID, pollChoices):
 def RemovePollChoices(conn, pollID, userID, pollChoices):
 
    pollChoices = list(map(lambda c: (pollID, c), pollChoices))
-   print(conn, userID, pollID, pollChoices)
 
    try:
       cur = conn.cursor()
       count = cur.executemany("DELETE FROM poll_choices_table WHERE (pollID=? and choiceID=?)", pollChoices).rowcount
       conn.commit()
+      pollCache.invalidate(pollID)
       if count == 0:
          status, reason = OP_SUCCESS, REASON_NOSUCH_POLL_ID
       else:
@@ -246,8 +813,6 @@ def RemovePollChoices(conn, pollID, userID, pollChoices):
    return status, reason
 
 def SetPollStatus(conn, pollID, userID, pollStatus):
-   print(conn, userID, pollID, pollStatus)
-
    if pollStatus not in ['C', 'O']:
       status, reason = OP_FAILURE, REASON_INVALID_POLL_STATUS
    elif not IsPollIDExists(conn, pollID):
@@ -260,6 +825,7 @@ def SetPollStatus(conn, pollID, userID, pollStatus):
          count = cur.execute("UPDATE poll_master_table SET status=? WHERE " +
                              "(pollID=? and ownerID=?)", (pollStatus, pollID, userID)).rowcount
          conn.commit()
+         pollCache.invalidate(pollID)
          if count != 1:
             status, reason = OP_FAILURE, REASON_NOSUCH_POLL_ID
          else:
@@ -270,30 +836,48 @@ def SetPollStatus(conn, pollID, userID, pollStatus):
 
    return status, reason
 
-def PollMakeSelection(conn, pollID, userID, choiceID):
-   print(conn, userID, pollID, choiceID)
+# writes the vote of the user, replacing the earlier vote of the user in the poll if any
+POLL_UPSERT_SELECTION_SQL = ("INSERT INTO user_poll_selection_table VALUES(?, ?, ?) " +
+                             "ON CONFLICT(pollID, userID) DO UPDATE SET choiceID=excluded.choiceID")
+
+# Validates one vote against the poll cache, returns (status, reason)
+def ValidateSelection(conn, pollID, choiceID):
+   poll = pollCache.get(conn, pollID)
+   if poll is None or choiceID not in poll[1]:
+      return OP_FAILURE, REASON_NOSUCH_POLL_ID
+   if poll[0] != 'O':
+      return OP_FAILURE, REASON_POLL_NOT_OPENED
+   return OP_SUCCESS, REASON_SUCCESS
+
+#
+# Writes a batch of votes in one transaction (see poll_votewriter)
+#
+#   selections : list of (pollID, userID, choiceID)
+#
+# The votes are validated against the poll cache, and the valid ones are written
+# with one UPSERT statement each. sqlite3 keeps the statement prepared in the
+# statement cache of the connection, so it is compiled once per connection.
+#
+# Returns the list of (status, reason), one for each vote
+#
+def PollMakeSelections(conn, selections):
+   results = [ValidateSelection(conn, pollID, choiceID) for (pollID, userID, choiceID) in selections]
+   votes = [s for (s, r) in zip(selections, results) if r[0] == OP_SUCCESS]
+   if not votes:
+      return results
 
    try:
-      cur = conn.cursor()
-      polStatus = cur.execute("SELECT status from poll_master_table where (pollID=?)", (pollID,)).fetchall()
-      choiceList = cur.execute("SELECT choiceID from poll_choices_table where (pollID=? and choiceID=?)", (pollID,choiceID)).fetchall()
-      if len(polStatus) == 0 or len(choiceList) == 0:
-         status, reason = OP_FAILURE, REASON_NOSUCH_POLL_ID
-      elif polStatus[0][0] != 'O':
-         status, reason = OP_FAILURE, REASON_POLL_NOT_OPENED
-      else:
-         count = cur.execute("UPDATE user_poll_selection_table SET choiceID=? WHERE " +
-                          "(pollID=? and userID=?)", (choiceID, pollID, userID)).rowcount
-         conn.commit()
-         if count == 0:
-            cur.execute("INSERT INTO user_poll_selection_table VALUES(?, ?, ?)", (pollID, userID, choiceID))
-            conn.commit()
-         status, reason = OP_SUCCESS, REASON_SUCCESS
-   except sqlite3.IntegrityError as opErr:
+      conn.executemany(POLL_UPSERT_SELECTION_SQL, votes)
+      conn.commit()
+   except sqlite3.Error as opErr:
+      log.error("failed to write %d votes: %s", len(votes), opErr)
       conn.rollback()
-      status, reason = OP_FAILURE, REASON_DATABASE_ERROR
+      results = [(OP_FAILURE, REASON_DATABASE_ERROR) if r[0] == OP_SUCCESS else r for r in results]
 
-   return status, reason
+   return results
+
+def PollMakeSelection(conn, pollID, userID, choiceID):
+   return PollMakeSelections(conn, [(pollID, userID, choiceID)])[0]
 
 def PollGetResults(conn, pollID):
    pollResults = []
@@ -303,16 +887,15 @@ def PollGetResults(conn, pollID):
       pollName = None
    else:
       pollName = pollName[0][0]
-      cur = conn.execute("SELECT user_poll_selection_table.choiceID, " +
-                      "choiceName, count(user_poll_selection_table.choiceID) " +
-                      "from user_poll_selection_table INNER " +
-                      "JOIN poll_choices_table on (user_poll_selection_table.choiceID == " +
-                      "poll_choices_table.choiceID and user_poll_selection_table.pollID == " +
-                      "poll_choices_table.pollID) where (user_poll_selection_table.pollID=?) " +
-                      "GROUP BY (user_poll_selection_table.choiceID)", (pollID,))
+      # the counts of the choices with votes, the votes for removed choices are not reported
+      cur = conn.execute("SELECT poll_tally_table.choiceID, choiceName, count " +
+                      "from poll_tally_table INNER JOIN poll_choices_table on " +
+                      "(poll_tally_table.pollID == poll_choices_table.pollID and " +
+                      "poll_tally_table.choiceID == poll_choices_table.choiceID) " +
+                      "where (poll_tally_table.pollID=? and count > 0) " +
+                      "ORDER BY poll_tally_table.choiceID", (pollID,))
 
       data = cur.fetchall()
-      print(data)
       for r in data:
          pollResults.append({
                'choiceName': r[1],
@@ -322,17 +905,68 @@ def PollGetResults(conn, pollID):
 
    return status, reason, pollName, pollResults
 
-def ListPolls(cntxt, pollID):
-   conn = cntxt['conn']
-   cur = conn.execute("SELECT * from poll_master_table")
-   data = cur.fetchall()
+# Returns {choiceID: count} for every choice of the poll, 0 for the choices without votes
+# (see poll_publisher)
+def PollGetCounts(conn, pollID):
+   cur = conn.execute("SELECT poll_choices_table.choiceID, coalesce(count, 0) " +
+                      "from poll_choices_table LEFT JOIN poll_tally_table on " +
+                      "(poll_tally_table.pollID == poll_choices_table.pollID and " +
+                      "poll_tally_table.choiceID == poll_choices_table.choiceID) " +
+                      "where (poll_choices_table.pollID=?)", (pollID,))
+   return dict(cur.fetchall())
+
+#
+# Lists a page of the polls (see LIST_POLLS_PAGE), pageSize polls at most, ordered by pollID
+#
+# Keyset pagination: the page starts after the poll afterPollID, so every page is read with an
+# index search on (ownerID,) pollID instead of skipping the polls of the earlier pages. The
+# filters are optional ("" for any), the prefix of the pollID is searched as a range of the
+# primary key.
+#
+# Yields the polls (pollID, pollName, startDate, endDate, status) in chunks, as FetchPage().
+#
+def ListPollsPage(conn, pollIDPrefix, ownerID, pollStatus, afterPollID, pageSize, chunkSize):
+   sqlCmd = ("SELECT pollID, ifnull(pollName, ''), ifnull(startDate, ''), ifnull(endDate, ''), ifnull(status, '') " +
+             "from poll_master_table WHERE (1")
+   params = []
+   if afterPollID:
+      sqlCmd += " and pollID > ?"
+      params.append(afterPollID)
+   if pollIDPrefix:
+      condition, values = PrefixRange('pollID', pollIDPrefix)
+      sqlCmd += condition
+      params += values
+   if ownerID:
+      sqlCmd += " and ownerID = ?"
+      params.append(ownerID)
+   if pollStatus:
+      sqlCmd += " and status = ?"
+      params.append(pollStatus)
+   # one more poll tells if there is a next page
+   sqlCmd += ") ORDER BY pollID LIMIT ?"
+   params.append(pageSize + 1)
+
+   return FetchPage(conn.execute(sqlCmd, params), pageSize, chunkSize)
+
+# Lists the polls whose pollID starts with pollID, all the polls if pollID is "". The polls are
+# read page by page (see ListPollsPage). With maxRows, at most maxRows polls are listed and the
+# reason is REASON_LIST_TRUNCATED if there are more
+def ListPolls(conn, pollID, maxRows=None):
    pollList = []
-   for r in data:
-      pollList.append({
-            'pollId': r[0],
-            'pollName': r[1],
-            'startDate': r[2],
-            'endDate': r[2],
-            'pollStatus': r[2],
-         })
-   return OP_SUCCESS, REASON_SUCCESS, pollList
+   afterPollID = ""
+   while True:
+      pageSize = POLLSERVER_LIST_MAX_ROWS if maxRows is None else maxRows - len(pollList)
+      for polls, nextPollID in ListPollsPage(conn, pollID, "", "", afterPollID, pageSize, POLLSERVER_LIST_CHUNK_SIZE):
+         for r in polls:
+            pollList.append({
+                  'pollId': r[0],
+                  'pollName': r[1],
+                  'startDate': r[2],
+                  'endDate': r[3],
+                  'pollStatus': r[4],
+               })
+      if not nextPollID:
+         return OP_SUCCESS, REASON_SUCCESS, pollList
+      if maxRows is not None:
+         return OP_SUCCESS, REASON_LIST_TRUNCATED, pollList
+      afterPollID = nextPollID
@@ -0,0 +1,52 @@
+import zlib
+import multiprocessing
+
+#
+# Implements the generation counters of the polls, shared by the worker processes of the
+# pre-fork mode (see poll_prefork)
+#
+# Every worker process has its own poll cache, results cache and publisher, and a change to a
+# poll is committed by one of them. The worker committing the change bumps the generation of the
+# poll in shared memory. The caches remember the generation of a poll when they read it from the
+# database and read it again when the generation changed, and the publisher pushes the polls
+# whose generation changed. The polls are hashed onto POLLSERVER_NUM_GENERATIONS counters, so a
+# change to a poll also drops the cached entries of the polls sharing its counter.
+#
+# The login cache also keeps a generation for every user (see LoginCache in poll_dbopsimpl).
+#
+# In the single process modes there are no shared counters: GetGeneration() is always 0 and the
+# caches are only invalidated by the process itself, as before.
+#
+
+# number of shared counters
+POLLSERVER_NUM_GENERATIONS = 4096
+
+generations = None
+
+# Creates the shared counters, called before the worker processes are forked
+def EnableSharedGenerations(numGenerations=POLLSERVER_NUM_GENERATIONS):
+   global generations
+   generations = multiprocessing.Array('Q', numGenerations)
+
+def IsShared():
+   return generations is not None
+
+def GetSlot(pollID):
+   return zlib.crc32(pollID.encode()) % len(generations.get_obj())
+
+# Returns the generation of the poll. To see the changes committed by the other processes, a
+# cache reads the generation before reading the poll from the database
+def GetGeneration(pollID):
+   if generations is None:
+      return 0
+   # reading one counter needs no lock
+   return generations.get_obj()[GetSlot(pollID)]
+
+# Bumps the generations of the polls, called after a change to the polls is committed
+def BumpGeneration(*pollIDs):
+   if generations is None:
+      return
+   with generations.get_lock():
+      counters = generations.get_obj()
+      for pollID in pollIDs:
+         counters[GetSlot(pollID)] += 1
@@ -1,5 +1,6 @@
 import sys
 import socket
+from poll_logging import log
 
 class InvalidMsgReqImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
@@ -8,5 +9,5 @@ class InvalidMsgReqImpl:
       self.conn = conn
 
    def invoke(self):
-      print("InvalidMsgReqImpl")
+      log.warning("Unsupported request from %s, closing the connection", self.cntxt['address'])
       return 0
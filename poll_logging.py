@@ -0,0 +1,139 @@
+import sys
+import queue
+import atexit
+import logging
+import itertools
+import threading
+import logging.handlers
+
+#
+# Implements logging for the poll server
+#
+# All the server modules log via the 'poll' logger. The records are put on a queue by a
+# QueueHandler and a background thread (QueueListener) writes them to the console or a file,
+# so the threads processing the requests never wait for the terminal or a pipe.
+#
+# Server level events (connections, handshake failures, errors) are logged at INFO and above.
+# Per request logging (ENTER/EXIT of the handlers and the request data) is done via TraceRequest()
+# at DEBUG level, which is off by default. When it is turned on, it can be sampled per message type:
+# with a sample rate of N, only one in N requests of that message type is traced.
+#
+# Never log passwords or password hashes.
+#
+
+POLL_LOG_FORMAT = "%(asctime)s %(threadName)s %(levelname)s %(message)s"
+POLL_PREFORK_LOG_FORMAT = "%(asctime)s %(process)d %(threadName)s %(levelname)s %(message)s"
+
+log = logging.getLogger('poll')
+
+# message type -> sample rate. Message types not in the dict use the default rate
+traceSampleRates = {}
+traceDefaultSampleRate = 1
+traceCounters = {}
+
+traceLocal = threading.local()
+
+queueListener = None
+
+#
+# QueueHandler formats the message in the logging thread before putting the record on the
+# queue. This one puts the record as is, so the formatting is also done by the background
+# thread. The arguments of a log call must not be modified after the call.
+#
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+   def prepare(self, record):
+      return record
+
+#
+# Sets up the logging. Called once at the start of the server
+#
+#   level       : log level of the 'poll' logger, DEBUG turns on request tracing
+#   logFile     : log file name, console if not given
+#   sampleRates : dict of message type -> sample rate for request tracing
+#   defaultRate : sample rate for the message types not in sampleRates
+#
+def SetupLogging(level=logging.INFO, logFile=None, sampleRates=None, defaultRate=1):
+   global queueListener
+   global traceDefaultSampleRate
+
+   if logFile:
+      handler = logging.FileHandler(logFile)
+   else:
+      handler = logging.StreamHandler(sys.stdout)
+   handler.setFormatter(logging.Formatter(POLL_LOG_FORMAT))
+
+   logQueue = queue.SimpleQueue()
+   log.addHandler(DeferredQueueHandler(logQueue))
+   log.setLevel(level)
+   log.propagate = False
+
+   traceSampleRates.update(sampleRates or {})
+   traceDefaultSampleRate = max(defaultRate, 1)
+
+   queueListener = logging.handlers.QueueListener(logQueue, handler)
+   queueListener.start()
+
+   # write out the queued records at exit
+   atexit.register(queueListener.stop)
+
+#
+# Restarts the logging in a forked worker process (see poll_prefork)
+#
+# The background thread is not copied to the child, and the queue may have been locked by it
+# at the time of the fork, so the child gets a new queue and its own background thread. The
+# records of the worker are tagged with its pid.
+#
+def RestartLogging():
+   global queueListener
+
+   if queueListener is None:
+      return
+   atexit.unregister(queueListener.stop)
+
+   handlers = queueListener.handlers
+   for handler in handlers:
+      handler.setFormatter(logging.Formatter(POLL_PREFORK_LOG_FORMAT))
+
+   logQueue = queue.SimpleQueue()
+   for handler in log.handlers:
+      if isinstance(handler, DeferredQueueHandler):
+         handler.queue = logQueue
+
+   queueListener = logging.handlers.QueueListener(logQueue, *handlers)
+   queueListener.start()
+   atexit.register(queueListener.stop)
+
+# Writes out the queued records, for the processes exiting without running the atexit functions
+def StopLogging():
+   if queueListener is not None:
+      atexit.unregister(queueListener.stop)
+      queueListener.stop()
+
+#
+# Called at the start of every request, decides whether the request is traced
+#
+# The decision is stashed in a thread-local, as a request is processed by a single thread
+#
+def BeginRequest(msgType):
+   traced = False
+   if log.isEnabledFor(logging.DEBUG):
+      rate = traceSampleRates.get(msgType, traceDefaultSampleRate)
+      if rate == 1:
+         traced = True
+      elif rate > 1:
+         counter = traceCounters.get(msgType)
+         if counter is None:
+            counter = traceCounters.setdefault(msgType, itertools.count())
+         traced = next(counter) % rate == 0
+
+   traceLocal.traced = traced
+   return traced
+
+def IsRequestTraced():
+   return getattr(traceLocal, 'traced', False)
+
+# Logs at DEBUG level if the current request is traced. The message is formatted
+# by the background thread, so pass the values as arguments instead of formatting them
+def TraceRequest(msg, *args):
+   if getattr(traceLocal, 'traced', False):
+      log.debug(msg, *args)
@@ -2,7 +2,14 @@ import sys
 import socket
 import struct
 import ctypes
-import hashlib
+import operator
+import threading
+
+# numpy is optional, it is used for encoding and decoding the large arrays in bulk
+try:
+   import numpy
+except ImportError:
+   numpy = None
 
 #
 # Implements transport API's sending, receiving request and responses between client and server via socket
@@ -46,6 +53,10 @@ import hashlib
 # All send* functions return O_SUCCESS or OP_FAILURE as the return value
 # All recv* functions return tuple of data items received from the socket, type of None of failure
 #
+# The recv* functions must be given a FramedSocket (see below), which reads exactly the number
+# of bytes asked for. A plain socket's recv() may return part of a struct, e.g. when the struct
+# spans two TCP segments or TLS records, and the rest of the stream would be misread.
+#
 
 # Status codes
 OP_SUCCESS = 0
@@ -65,6 +76,8 @@ REASON_NOT_ENOUCH_CHOICES = 9
 REASON_POLL_NOT_OPENED = 10
 REASON_INVALID_POLL_STATUS = 11
 REASON_NOT_OWNER = 12
+REASON_SERVER_OVERLOADED = 13
+REASON_LIST_TRUNCATED = 14
 REASON_UNKNOWN = 99
 
 # Reason strings
@@ -82,6 +95,8 @@ reason2stringMap = {
    REASON_POLL_NOT_OPENED: "Can not make selection. Poll is closed",
    REASON_INVALID_POLL_STATUS: "Invalid poll status. Should be C or O",
    REASON_NOT_OWNER: "Permission denied. Not the owner",
+   REASON_SERVER_OVERLOADED: "Server is overloaded. Try again later",
+   REASON_LIST_TRUNCATED: "The list is truncated. Use the paged listing for the rest",
    REASON_UNKNOWN: "Unknown reason",
 }
 
@@ -103,6 +118,16 @@ USER_POLL_GET_RESULTS = 10
 LIST_USERS = 11
 LIST_POLLS = 12
 
+USER_POLL_MAKE_SELECTION_BATCH = 13
+
+NEGOTIATE_VERSION = 14
+
+SUBSCRIBE_POLL_RESULTS = 15
+POLL_RESULTS_UPDATE = 16
+
+LIST_POLLS_PAGE = 17
+LIST_USERS_PAGE = 18
+
 # msg type strings
 msgtype2stringMap = {
    CREATE_USER: "Create User Operation",
@@ -117,6 +142,12 @@ msgtype2stringMap = {
    USER_POLL_MAKE_SELECTION: "Make Poll Section Operation",
    USER_POLL_GET_RESULTS: "Get Poll Results Operation",
    LIST_POLLS: "Get a list of polls",
+   USER_POLL_MAKE_SELECTION_BATCH: "Make Poll Selections Operation",
+   NEGOTIATE_VERSION: "Negotiate Wire Format Version",
+   SUBSCRIBE_POLL_RESULTS: "Subscribe Poll Results Operation",
+   POLL_RESULTS_UPDATE: "Poll Results Update",
+   LIST_POLLS_PAGE: "Get a page of polls",
+   LIST_USERS_PAGE: "Get a page of users",
 }
 
 def GetMsgTypeString(msgType):
@@ -131,6 +162,444 @@ def GetReasonString(reason):
    else:
       return 'Unknown'
 
+# initial size of the receive buffer of a FramedSocket, grows as needed for larger messages
+POLL_RECV_BUFFER_SIZE = 4096
+
+#
+# Wraps a connected socket and reads exact lengths from it
+#
+# Every connection has a preallocated buffer. recv(size) fills the buffer with recv_into()
+# until it holds at least size bytes and returns a memoryview of the next size bytes, so
+# the messages are decoded in place (StructCodec.unpack) without copying. The buffer is
+# filled with whatever the socket has, so the requests pipelined by a client are read with
+# one call and served from the buffer.
+#
+# The memoryview returned by recv() is valid only till the next recv() call, the data must
+# be decoded before reading more.
+#
+# All the other socket methods (send, close, getpeercert ...) go to the wrapped socket.
+#
+class FramedSocket:
+   def __init__(self, sock, bufSize=POLL_RECV_BUFFER_SIZE):
+      self.sock = sock
+      self.buf = bytearray(bufSize)
+      self.view = memoryview(self.buf)
+      self.start = 0
+      self.end = 0
+      # wire format of the connection (see NEGOTIATE_VERSION), the last v2 frame read and
+      # the request ID of the frames sent (version 3)
+      self.wireVersion = POLL_WIRE_VERSION_1
+      self.frame = None
+      self.requestID = 0
+      # the server pushes messages (see SUBSCRIBE_POLL_RESULTS) from other threads
+      self.sendLock = threading.RLock()
+      # frame to be returned again by the next recvFrame() (see RequestPipeline)
+      self.pushedFrame = None
+
+   def __getattr__(self, name):
+      return getattr(self.sock, name)
+
+   def __repr__(self):
+      return f"<FramedSocket {self.sock!r}>"
+
+   # True if the buffer holds data not yet read, e.g. a pipelined request
+   def hasPending(self):
+      return self.start < self.end
+
+   # makes room in the buffer for size bytes from self.start
+   def reserve(self, size):
+      if self.start + size <= len(self.buf):
+         return
+
+      pending = self.end - self.start
+      if size > len(self.buf):
+         # the memoryviews returned earlier may still refer to the old buffer, so a new one
+         # is allocated instead of resizing it
+         buf = bytearray(max(size, 2 * len(self.buf)))
+         buf[:pending] = self.buf[self.start:self.end]
+         self.buf = buf
+         self.view = memoryview(buf)
+      else:
+         self.buf[:pending] = self.buf[self.start:self.end]
+      self.start = 0
+      self.end = pending
+
+   # Returns a memoryview of the next size bytes, empty if the peer closed the connection
+   def recv(self, size):
+      self.reserve(size)
+      while self.end - self.start < size:
+         numBytes = self.sock.recv_into(self.view[self.end:])
+         if numBytes == 0:
+            if self.start == self.end:
+               return self.view[:0]
+            raise ConnectionResetError("connection closed in the middle of a message")
+         self.end += numBytes
+
+      data = self.view[self.start:self.start + size]
+      self.start += size
+      if self.start == self.end:
+         self.start = self.end = 0
+      return data
+
+   # Adds data read by someone else (see poll_asyncserver) to the buffer
+   def feed(self, data):
+      self.reserve(self.end - self.start + len(data))
+      self.buf[self.end:self.end + len(data)] = data
+      self.end += len(data)
+
+   def send(self, data):
+      with self.sendLock:
+         return self.sock.send(data)
+
+#
+# Wire format versions
+#
+# Version 1 (legacy) is the ctypes format described above, every connection starts with it.
+#
+# Version 2 is used on a connection after the client sends NEGOTIATE_VERSION (in the current
+# format of the connection) and the server accepts it. Every message is a frame:
+#
+#   frame   : varint length of the rest of the frame, msgType, flags, fields
+#   varint  : unsigned integer in 7-bit groups, least significant group first, the high bit
+#             set on all but the last byte (LEB128). Numbers, status/reason and counts
+#   string  : varint length followed by that many UTF-8 bytes, no padding
+#   list    : varint count followed by the elements
+#
+# The fields of every message are in the same order as in the version 1 structs. The strings
+# in the requests are limited to the sizes of the version 1 fields, so everything stored can
+# still be sent to the version 1 clients. The counts are not limited to 65535.
+#
+# Version 3 adds a request ID to the frames, a varint after msgType and flags:
+#
+#   frame   : varint length of the rest of the frame, msgType, flags, requestID, fields
+#
+# The client chooses the request ID of every request and the server sends it back in the
+# response. So a client can send many requests without waiting for the responses (see
+# RequestPipeline), and the server can answer the read-only requests out of order (see
+# poll_pipeline).
+#
+POLL_WIRE_VERSION_1 = 1
+POLL_WIRE_VERSION_2 = 2
+POLL_WIRE_VERSION_3 = 3
+POLL_WIRE_VERSION_MAX = POLL_WIRE_VERSION_3
+
+# largest v2 frame accepted
+POLL_MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+def GetWireVersion(sock):
+   return getattr(sock, 'wireVersion', POLL_WIRE_VERSION_1)
+
+def GetRequestID(sock):
+   return getattr(sock, 'requestID', 0)
+
+def EncodeVarint(buf, n):
+   while n >= 0x80:
+      buf.append((n & 0x7f) | 0x80)
+      n >>= 7
+   buf.append(n)
+
+# Builds a v2 frame, the put* methods return the writer so the fields can be chained
+class FrameWriter:
+   def __init__(self, msgType, flags):
+      self.buf = bytearray()
+      self.putUint(msgType).putUint(flags)
+      self.hdrSize = len(self.buf)
+
+   def putUint(self, n):
+      EncodeVarint(self.buf, n)
+      return self
+
+   def putStr(self, s, maxSize=None):
+      data = s.encode()
+      if maxSize is not None and len(data) > maxSize:
+         raise ValueError(f"string too long ({len(data)} > {maxSize} bytes)")
+      EncodeVarint(self.buf, len(data))
+      self.buf += data
+      return self
+
+   # Returns the frame, prefixed by its length. The request ID is put after msgType and flags
+   # when given (version 3)
+   def frame(self, requestID=None):
+      if requestID is None:
+         msgBuf = bytearray()
+         EncodeVarint(msgBuf, len(self.buf))
+         return bytes(msgBuf + self.buf)
+
+      hdr = self.buf[:self.hdrSize]
+      EncodeVarint(hdr, requestID)
+      msgBuf = bytearray()
+      EncodeVarint(msgBuf, len(hdr) + len(self.buf) - self.hdrSize)
+      return bytes(msgBuf + hdr + memoryview(self.buf)[self.hdrSize:])
+
+# Reads the fields of a v2 frame in order, raises ValueError if the frame is malformed
+class FrameReader:
+   def __init__(self, data, wireVersion=POLL_WIRE_VERSION_2):
+      self.data = data
+      self.pos = 0
+      self.msgType = self.getUint()
+      self.flags = self.getUint()
+      self.requestID = self.getUint() if wireVersion >= POLL_WIRE_VERSION_3 else 0
+
+   def getUint(self):
+      # most numbers fit in one byte
+      if self.pos < len(self.data) and self.data[self.pos] < 0x80:
+         self.pos += 1
+         return self.data[self.pos - 1]
+
+      n = 0
+      shift = 0
+      while True:
+         if self.pos >= len(self.data) or shift > 63:
+            raise ValueError("malformed frame")
+         b = self.data[self.pos]
+         self.pos += 1
+         n |= (b & 0x7f) << shift
+         if b < 0x80:
+            return n
+         shift += 7
+
+   # returns a memoryview of the next string field
+   def getField(self, maxSize):
+      size = self.getUint()
+      if self.pos + size > len(self.data):
+         raise ValueError("malformed frame")
+      if maxSize is not None and size > maxSize:
+         raise ValueError(f"string too long ({size} > {maxSize} bytes)")
+      self.pos += size
+      return self.data[self.pos - size:self.pos]
+
+   def getBytes(self, maxSize=None):
+      return bytes(self.getField(maxSize))
+
+   def getStr(self, maxSize=None):
+      return str(self.getField(maxSize), 'utf-8')
+
+def sendFrame(sock, frameWriter):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_3:
+      msgBuf = frameWriter.frame(GetRequestID(sock))
+   else:
+      msgBuf = frameWriter.frame()
+   if sock.send(msgBuf) == len(msgBuf):
+      return OP_SUCCESS
+   else:
+      return OP_FAILURE
+
+#
+# Reads the next v2 frame from the FramedSocket, None if the peer closed the connection
+#
+# The frame is kept in sock.frame too, the server reads the header of the request via
+# recvMsgHdr() and the recv*Data functions read the fields from sock.frame.
+#
+def recvFrame(sock):
+   if sock.pushedFrame is not None:
+      sock.frame, sock.pushedFrame = sock.pushedFrame, None
+      return sock.frame
+
+   size = 0
+   shift = 0
+   while True:
+      msgBuf = sock.recv(1)
+      if not msgBuf:
+         if shift == 0:
+            return None
+         raise ConnectionResetError("connection closed in the middle of a message")
+      size |= (msgBuf[0] & 0x7f) << shift
+      if msgBuf[0] < 0x80:
+         break
+      shift += 7
+      if shift > 28:
+         raise ValueError("malformed frame length")
+
+   if size > POLL_MAX_FRAME_SIZE:
+      raise ValueError(f"frame too large ({size} bytes)")
+   msgBuf = sock.recv(size)
+   if len(msgBuf) != size:
+      raise ConnectionResetError("connection closed in the middle of a message")
+
+   sock.frame = FrameReader(msgBuf, GetWireVersion(sock))
+   return sock.frame
+
+# min number of rows of an array for packing and unpacking it with numpy
+POLL_BULK_CODEC_MIN_ROWS = 64
+
+#
+# Codecs of the version 1 structs
+#
+# The ctypes structs below define the version 1 messages. The messages are not built and read
+# via ctypes objects though: every struct has a StructCodec, a precompiled struct.Struct with the
+# same layout in network byte order, derived from the ctypes fields. Its pack_into() writes a
+# message straight into the send buffer of the thread and unpack_from() reads the fields straight
+# from the receive buffer of the FramedSocket, so the bytes on the wire are the same as with the
+# ctypes structs.
+#
+# The string fields are given and returned as str. As with the ctypes char arrays, a string
+# longer than its field raises ValueError, and the received strings end at the first NUL byte.
+#
+# The arrays of the LIST_USERS, LIST_POLLS and USER_POLL_GET_RESULTS responses can hold tens of
+# thousands of rows. When numpy is installed, the arrays of POLL_BULK_CODEC_MIN_ROWS rows or more
+# are packed and unpacked a whole column at a time instead of one struct per row: the strings of
+# a column are encoded (decoded) with one call and numpy copies their bytes to (from) the fixed
+# size fields of all the rows.
+#
+class StructCodec:
+   def __init__(self, ctypesStruct):
+      fmt, fields = self.layout(ctypesStruct)
+      self.struct = struct.Struct('!' + fmt)
+      self.size = self.struct.size
+      if self.size != ctypes.sizeof(ctypesStruct):
+         raise TypeError(f"{ctypesStruct.__name__}: codec size {self.size} != {ctypes.sizeof(ctypesStruct)}")
+      # (offset, size) of the fields, and (index, size) of the string fields
+      self.fields = fields
+      self.strFields = [(i, size) for i, (offset, size) in enumerate(fields) if size is not None]
+      self.strIndexes = [i for i, size in self.strFields]
+
+   # returns the struct format and, for every field, its (offset, size if it is a string or None)
+   @staticmethod
+   def layout(ctypesStruct, baseOffset=0):
+      fmt = ''
+      fields = []
+      offset = 0
+      for name, fieldType in ctypesStruct._fields_:
+         fieldOffset = getattr(ctypesStruct, name).offset
+         if fieldOffset > offset:
+            fmt += f'{fieldOffset - offset}x'
+         if issubclass(fieldType, ctypes.Structure):
+            subFmt, subFields = StructCodec.layout(fieldType, baseOffset + fieldOffset)
+            fmt += subFmt
+            fields += subFields
+         elif issubclass(fieldType, ctypes.Array) and fieldType._type_ is ctypes.c_char:
+            fmt += f'{fieldType._length_}s'
+            fields.append((baseOffset + fieldOffset, fieldType._length_))
+         elif fieldType is ctypes.c_char:
+            fmt += '1s'
+            fields.append((baseOffset + fieldOffset, 1))
+         elif fieldType is ctypes.c_uint16:
+            fmt += 'H'
+            fields.append((baseOffset + fieldOffset, None))
+         else:
+            raise TypeError(f"{ctypesStruct.__name__}.{name}: unsupported field type")
+         offset = fieldOffset + ctypes.sizeof(fieldType)
+      if ctypes.sizeof(ctypesStruct) > offset:
+         fmt += f'{ctypes.sizeof(ctypesStruct) - offset}x'
+      return fmt, fields
+
+   def encode(self, values):
+      values = list(values)
+      for i, size in self.strFields:
+         values[i] = values[i].encode()
+         if len(values[i]) > size:
+            raise ValueError(f"bytes too long ({len(values[i])}, maximum length {size})")
+      return values
+
+   def decode(self, values):
+      values = list(values)
+      for i in self.strIndexes:
+         value = values[i]
+         end = value.find(0)
+         values[i] = (value if end < 0 else value[:end]).decode()
+      return tuple(values)
+
+   def pack(self, *values):
+      return self.struct.pack(*self.encode(values))
+
+   def packInto(self, buffer, offset, *values):
+      self.struct.pack_into(buffer, offset, *self.encode(values))
+      return offset + self.size
+
+   # packs the list of tuples one after the other, returns the offset after the last one
+   def packArrayInto(self, buffer, offset, rows):
+      if numpy is not None and len(rows) >= POLL_BULK_CODEC_MIN_ROWS:
+         packed = self.packArrayNumpy(rows)
+         if packed is not None:
+            buffer[offset:offset + len(packed)] = packed
+            return offset + len(packed)
+
+      for row in rows:
+         self.struct.pack_into(buffer, offset, *self.encode(row))
+         offset += self.size
+      return offset
+
+   # packs the rows with numpy, one column at a time. Returns None when numpy cannot pack
+   # them (a string holding a NUL, an integer out of range), they are packed row by row then
+   def packArrayNumpy(self, rows):
+      count = len(rows)
+      packed = numpy.zeros((count, self.size), numpy.uint8)
+      rowOffsets = numpy.arange(0, count * self.size, self.size)
+      for column, (offset, size) in zip(zip(*rows), self.fields):
+         if size is None:
+            try:
+               values = numpy.array(column, numpy.uint16)
+            except OverflowError:
+               return None
+            packed[:, offset] = values >> 8
+            packed[:, offset + 1] = values & 0xff
+            continue
+
+         # the strings of the column encoded in one go, NUL separated
+         data = numpy.frombuffer('\0'.join(column).encode(), numpy.uint8)
+         ends = numpy.append(numpy.flatnonzero(data == 0), len(data))
+         if len(ends) != count:
+            return None
+         starts = numpy.append(0, ends[:-1] + 1)
+         lengths = ends - starts
+         if lengths.max() > size:
+            raise ValueError(f"bytes too long ({lengths.max()}, maximum length {size})")
+
+         # copy every byte to its row, at its position in the string
+         chars = numpy.flatnonzero(data)
+         packed.reshape(-1)[numpy.repeat(rowOffsets + offset - starts, lengths) + chars] = data[chars]
+      return packed.tobytes()
+
+   def unpack(self, buffer, offset=0):
+      return self.decode(self.struct.unpack_from(buffer, offset))
+
+   # unpacks count structs stored one after the other, returns the list of tuples
+   def unpackArray(self, buffer, count, offset=0):
+      if numpy is not None and count >= POLL_BULK_CODEC_MIN_ROWS:
+         rows = self.unpackArrayNumpy(buffer, count, offset)
+         if rows is not None:
+            return rows
+
+      return [self.decode(row) for row in self.struct.iter_unpack(buffer[offset:offset + count * self.size])]
+
+   # unpacks the rows with numpy, one column at a time. Returns None when numpy cannot unpack
+   # them (invalid UTF-8), they are unpacked row by row then
+   def unpackArrayNumpy(self, buffer, count, offset):
+      packed = numpy.frombuffer(buffer, numpy.uint8, count * self.size, offset).reshape(count, self.size)
+      columns = []
+      for offset, size in self.fields:
+         if size is None:
+            columns.append((packed[:, offset].astype(numpy.uint16) << 8 | packed[:, offset + 1]).tolist())
+            continue
+
+         # the strings end at the first NUL, or at the end of the field. Every string is taken
+         # with the NUL after it (a column of NULs is added for the full fields) and decoded in one go
+         field = numpy.zeros((count, size + 1), numpy.uint8)
+         field[:, :size] = packed[:, offset:offset + size]
+         lengths = (field == 0).argmax(axis=1)
+         try:
+            strings = field[numpy.arange(size + 1) <= lengths[:, None]].tobytes().decode()
+         except UnicodeError:
+            return None
+         columns.append(strings[:-1].split('\0'))
+      return list(zip(*columns))
+
+sendLocal = threading.local()
+
+# Returns a memoryview of size bytes of the send buffer of the calling thread. The message
+# is packed into it and sent before the next call
+def GetSendBuffer(size):
+   buf = getattr(sendLocal, 'buf', None)
+   if buf is None or len(buf) < size:
+      buf = sendLocal.buf = bytearray(max(size, POLL_RECV_BUFFER_SIZE))
+   return memoryview(buf)[:size]
+
+def sendBuffer(sock, msgBuf):
+   if sock.send(msgBuf) == len(msgBuf):
+      return OP_SUCCESS
+   else:
+      return OP_FAILURE
+
 # Message data
 
 # Create user request
@@ -151,6 +620,62 @@ class PollMsgHdr(ctypes.Structure):
     _fields_ = [('msgType', ctypes.c_uint16),
                 ('flags', ctypes.c_uint16)]
     _pack_ = 1
+PollMsgHdrCodec = StructCodec(PollMsgHdr)
+
+# Reads the header of the next request, returns (msgType, flags), (None, None) if the peer
+# closed the connection. The rest of the request is read by the recv*Data function of the request
+def recvMsgHdr(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None:
+         return (None, None)
+      # the response is sent with the request ID of the request
+      sock.requestID = frame.requestID
+      return (frame.msgType, frame.flags)
+
+   msgBuf = sock.recv(PollMsgHdrCodec.size)
+   if not msgBuf:
+      return (None, None)
+   return PollMsgHdrCodec.unpack(msgBuf)
+
+#
+# Returns (msgType, size) of the next request in the buffer of the FramedSocket, without reading
+# it, (None, None) if its header is not all in the buffer. size is the size of the whole request,
+# None for version 1. Used by the server to schedule a request before processing it
+#
+def PeekRequest(sock):
+   data = sock.view[sock.start:sock.end]
+
+   if GetWireVersion(sock) < POLL_WIRE_VERSION_2:
+      if len(data) < PollMsgHdrCodec.size:
+         return (None, None)
+      msgType, flags = PollMsgHdrCodec.unpack(data[:PollMsgHdrCodec.size])
+      return (msgType, None)
+
+   # the frame length and the msgType
+   pos = 0
+   values = []
+   for i in range(2):
+      n = 0
+      shift = 0
+      while True:
+         if pos >= len(data):
+            return (None, None)
+         b = data[pos]
+         pos += 1
+         n |= (b & 0x7f) << shift
+         if b < 0x80:
+            break
+         shift += 7
+         if shift > 28:
+            raise ValueError("malformed frame")
+      values.append(n)
+      if i == 0:
+         hdrSize = pos
+
+   if values[0] > POLL_MAX_FRAME_SIZE:
+      raise ValueError(f"frame too large ({values[0]} bytes)")
+   return (values[1], hdrSize + values[0])
 
 class PollCreateUserData(ctypes.Structure):
     _fields_ = [('userID', ctypes.c_char * USER_ID_SIZE),
@@ -158,34 +683,36 @@ class PollCreateUserData(ctypes.Structure):
                 ('userEmail', ctypes.c_char * USER_EMAIL_SIZE),
                 ('userPwd', ctypes.c_char * USER_PWD_SIZE)]
     _pack_ = 1
+PollCreateUserDataCodec = StructCodec(PollCreateUserData)
 
 class PollCreateUserDataReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', PollCreateUserData)]
     _pack_ = 1
+PollCreateUserDataReqCodec = StructCodec(PollCreateUserDataReq)
 
 def sendCreateUserReqMsg(sock, userID, userName, userEmail, userPwd):
-   createUserDataReq = PollCreateUserDataReq()
-   createUserDataReq.hdr.msgType = socket.htons(CREATE_USER)
-   createUserDataReq.hdr.flags = socket.htons(1)
-   createUserDataReq.data.userID = userID.encode()
-   createUserDataReq.data.userName = userName.encode()
-   createUserDataReq.data.userEmail = userEmail.encode()
-   createUserDataReq.data.userPwd = userPwd.encode()
-   if sock.send(createUserDataReq) == ctypes.sizeof(PollCreateUserDataReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(CREATE_USER, 1).putStr(userID, USER_ID_SIZE).putStr(userName, USER_NAME_SIZE)
+                             .putStr(userEmail, USER_EMAIL_SIZE).putStr(userPwd, USER_PWD_SIZE))
 
+   return sendBuffer(sock, PollCreateUserDataReqCodec.pack(CREATE_USER, 1, userID, userName, userEmail, userPwd))
+
+# the password is returned as bytes, the server hashes it (see poll_passwords)
 def recvCreateUserData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(PollCreateUserData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      userID = frame.getStr(USER_ID_SIZE)
+      userName = frame.getStr(USER_NAME_SIZE)
+      userEmail = frame.getStr(USER_EMAIL_SIZE)
+      userPwd = frame.getBytes(USER_PWD_SIZE)
+      return (userID, userName, userEmail, userPwd)
+
+   msgBuf = sock.recv(PollCreateUserDataCodec.size)
    if  not msgBuf:
       return (None, None, None, None)
-   createUserData = PollCreateUserData.from_buffer(bytearray(msgBuf))
-   userID = createUserData.userID.decode().rstrip('\x00')
-   userName = createUserData.userName.decode().rstrip('\x00')
-   userEmail = createUserData.userEmail.decode().rstrip('\x00')
-   userPwd = hashlib.sha256(createUserData.userPwd).hexdigest()
+   userID, userName, userEmail, userPwd = PollCreateUserDataCodec.unpack(msgBuf)
+   userPwd = userPwd.encode()
 
    return (userID, userName, userEmail, userPwd)
 
@@ -195,24 +722,25 @@ class PollResponseMessage(ctypes.Structure):
                 ('status', ctypes.c_uint16),
                 ('reason', ctypes.c_uint16)]
     _pack_ = 1
+PollResponseMessageCodec = StructCodec(PollResponseMessage)
 
 def sendResponseMessage(sock, msgType, status, reason):
-   msgResp = PollResponseMessage()
-   msgResp.hdr.msgType = socket.htons(msgType)
-   msgResp.hdr.flags = socket.htons(2)
-   msgResp.status = socket.htons(status)
-   msgResp.reason = socket.htons(reason)
-   if sock.send(msgResp) == ctypes.sizeof(PollResponseMessage):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(msgType, 2).putUint(status).putUint(reason))
+
+   return sendBuffer(sock, PollResponseMessageCodec.pack(msgType, 2, status, reason))
 
 def recvResponseMessage(sock):
-   msgBuf = sock.recv(ctypes.sizeof(PollResponseMessage))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None:
+         return (None, None, None, None)
+      return (frame.msgType, frame.flags, frame.getUint(), frame.getUint())
+
+   msgBuf = sock.recv(PollResponseMessageCodec.size)
    if  not msgBuf:
       return (None, None, None, None)
-   msgResp = PollResponseMessage.from_buffer(bytearray(msgBuf))
-   return (socket.ntohs(msgResp.hdr.msgType), socket.ntohs(msgResp.hdr.flags), socket.ntohs(msgResp.status), socket.ntohs(msgResp.reason))
+   return PollResponseMessageCodec.unpack(msgBuf)
 
 # Poll change user
 class PollChangeUserData(ctypes.Structure):
@@ -221,34 +749,35 @@ class PollChangeUserData(ctypes.Structure):
                 ('userEmail', ctypes.c_char * USER_EMAIL_SIZE),
                 ('userPwd', ctypes.c_char * USER_PWD_SIZE)]
     _pack_ = 1
+PollChangeUserDataCodec = StructCodec(PollChangeUserData)
 
 class PollChangeUserDataReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', PollChangeUserData)]
     _pack_ = 1
+PollChangeUserDataReqCodec = StructCodec(PollChangeUserDataReq)
 
 def sendChangeUserReqMsg(sock, userID, userName, userEmail, userPwd):
-   changeUserDataReq = PollChangeUserDataReq()
-   changeUserDataReq.hdr.msgType = socket.htons(CHANGE_USER)
-   changeUserDataReq.hdr.flags = socket.htons(1)
-   changeUserDataReq.data.userID = userID.encode()
-   changeUserDataReq.data.userName = userName.encode()
-   changeUserDataReq.data.userEmail = userEmail.encode()
-   changeUserDataReq.data.userPwd = userPwd.encode()
-   if sock.send(changeUserDataReq) == ctypes.sizeof(PollChangeUserDataReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(CHANGE_USER, 1).putStr(userID, USER_ID_SIZE).putStr(userName, USER_NAME_SIZE)
+                             .putStr(userEmail, USER_EMAIL_SIZE).putStr(userPwd, USER_PWD_SIZE))
+
+   return sendBuffer(sock, PollChangeUserDataReqCodec.pack(CHANGE_USER, 1, userID, userName, userEmail, userPwd))
 
 def recvChangeUserData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(PollChangeUserData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      userID = frame.getStr(USER_ID_SIZE)
+      userName = frame.getStr(USER_NAME_SIZE)
+      userEmail = frame.getStr(USER_EMAIL_SIZE)
+      userPwd = frame.getBytes(USER_PWD_SIZE)
+      return (userID, userName, userEmail, userPwd)
+
+   msgBuf = sock.recv(PollChangeUserDataCodec.size)
    if  not msgBuf:
-      return (None, None, None)
-   changeUserData = PollChangeUserData.from_buffer(bytearray(msgBuf))
-   userID = changeUserData.userID.decode().rstrip('\x00')
-   userName = changeUserData.userName.decode().rstrip('\x00')
-   userEmail = changeUserData.userEmail.decode().rstrip('\x00')
-   userPwd = hashlib.sha256(changeUserData.userPwd).hexdigest()
+      return (None, None, None, None)
+   userID, userName, userEmail, userPwd = PollChangeUserDataCodec.unpack(msgBuf)
+   userPwd = userPwd.encode()
 
    return (userID, userName, userEmail, userPwd)
 
@@ -257,30 +786,32 @@ class PollLoginUserData(ctypes.Structure):
     _fields_ = [('userID', ctypes.c_char * USER_ID_SIZE),
                 ('userPwd', ctypes.c_char * USER_PWD_SIZE)]
     _pack_ = 1
+PollLoginUserDataCodec = StructCodec(PollLoginUserData)
 
 class PollLoginUserDataReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', PollLoginUserData)]
     _pack_ = 1
+PollLoginUserDataReqCodec = StructCodec(PollLoginUserDataReq)
 
 def sendLoginUserReqMsg(sock, userID, userPwd):
-   loginUserDataReq = PollLoginUserDataReq()
-   loginUserDataReq.hdr.msgType = socket.htons(LOGIN_USER)
-   loginUserDataReq.hdr.flags = socket.htons(1)
-   loginUserDataReq.data.userID = userID.encode()
-   loginUserDataReq.data.userPwd = userPwd.encode()
-   if sock.send(loginUserDataReq) == ctypes.sizeof(PollLoginUserDataReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(LOGIN_USER, 1).putStr(userID, USER_ID_SIZE).putStr(userPwd, USER_PWD_SIZE))
+
+   return sendBuffer(sock, PollLoginUserDataReqCodec.pack(LOGIN_USER, 1, userID, userPwd))
 
 def recvLoginUserData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(PollLoginUserData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      userID = frame.getStr(USER_ID_SIZE)
+      userPwd = frame.getBytes(USER_PWD_SIZE)
+      return (userID, userPwd)
+
+   msgBuf = sock.recv(PollLoginUserDataCodec.size)
    if  not msgBuf:
       return (None, None)
-   loginUserData = PollLoginUserData.from_buffer(bytearray(msgBuf))
-   userID = loginUserData.userID.decode().rstrip('\x00')
-   userPwd = hashlib.sha256(loginUserData.userPwd).hexdigest()
+   userID, userPwd = PollLoginUserDataCodec.unpack(msgBuf)
+   userPwd = userPwd.encode()
 
    return (userID, userPwd)
 
@@ -293,16 +824,13 @@ class PollLogoutUserData(ctypes.Structure):
 class PollLogoutUserDataReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr)]
     _pack_ = 1
+PollLogoutUserDataReqCodec = StructCodec(PollLogoutUserDataReq)
 
 def sendLogoutUserReqMsg(sock):
-   logoutUserDataReq = PollLogoutUserDataReq()
-   logoutUserDataReq.hdr.msgType = socket.htons(LOGOUT_USER)
-   logoutUserDataReq.hdr.flags = socket.htons(1)
-   if sock.send(logoutUserDataReq) == ctypes.sizeof(PollLogoutUserDataReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(LOGOUT_USER, 1))
 
+   return sendBuffer(sock, PollLogoutUserDataReqCodec.pack(LOGOUT_USER, 1))
 
 # Create poll
 
@@ -310,6 +838,7 @@ class PollChoiceData(ctypes.Structure):
     _fields_ = [('choiceID', ctypes.c_char * CHOICE_ID_SIZE),
                 ('choiceName', ctypes.c_char * CHOICE_NAME_SIZE)]
     _pack_ = 1
+PollChoiceDataCodec = StructCodec(PollChoiceData)
 
 class CreatePollData(ctypes.Structure):
     _fields_ = [('pollID', ctypes.c_char * POLL_ID_SIZE),
@@ -319,236 +848,310 @@ class CreatePollData(ctypes.Structure):
                 ('pollStatus', ctypes.c_char),
                 ('numChoices', ctypes.c_uint16)]
     _pack_ = 1
+CreatePollDataCodec = StructCodec(CreatePollData)
 
 class CreatePollDataReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', CreatePollData)]
     _pack_ = 1
+CreatePollDataReqCodec = StructCodec(CreatePollDataReq)
 
 def sendCreatePollReqMsg(sock, pollID, pollName, openDateTime, closeDateTime, pollChoices):
-   createPollDataReq = CreatePollDataReq()
-   createPollDataReq.hdr.msgType = socket.htons(CREATE_POLL)
-   createPollDataReq.hdr.flags = socket.htons(1)
-   createPollDataReq.data.pollID = pollID.encode()
-   createPollDataReq.data.pollName = pollName.encode()
-   createPollDataReq.data.openDateTime = openDateTime.encode()
-   createPollDataReq.data.closeDateTime = closeDateTime.encode()
-   createPollDataReq.data.numChoices = socket.htons(len(pollChoices))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(CREATE_POLL, 1).putStr(pollID, POLL_ID_SIZE).putStr(pollName, POLL_NAME_SIZE)
+      frameWriter.putStr(openDateTime, DATE_TIME_SIZE).putStr(closeDateTime, DATE_TIME_SIZE).putUint(len(pollChoices))
+      for choiceID, choiceName in pollChoices:
+         frameWriter.putStr(choiceID, CHOICE_ID_SIZE).putStr(choiceName, CHOICE_NAME_SIZE)
+      return sendFrame(sock, frameWriter)
 
    numChoices = len(pollChoices)
-   pollChoiceData = (PollChoiceData * numChoices)()
-   for i in range(0, numChoices):
-      pollChoiceData[i].choiceID = pollChoices[i][0].encode()
-      pollChoiceData[i].choiceName = pollChoices[i][1].encode()
-      
-   numBytes = sock.send(createPollDataReq)
-   if numBytes == ctypes.sizeof(createPollDataReq):
-      numBytes += sock.send(pollChoiceData)
-
-   if numBytes == ctypes.sizeof(createPollDataReq) + ctypes.sizeof(pollChoiceData):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   msgBuf = GetSendBuffer(CreatePollDataReqCodec.size + PollChoiceDataCodec.size * numChoices)
+   offset = CreatePollDataReqCodec.packInto(msgBuf, 0, CREATE_POLL, 1, pollID, pollName, openDateTime, closeDateTime, "", numChoices)
+   PollChoiceDataCodec.packArrayInto(msgBuf, offset, pollChoices)
+
+   return sendBuffer(sock, msgBuf)
 
 def recvCreatePollData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(CreatePollData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      pollID = frame.getStr(POLL_ID_SIZE)
+      pollName = frame.getStr(POLL_NAME_SIZE)
+      openDateTime = frame.getStr(DATE_TIME_SIZE)
+      closeDateTime = frame.getStr(DATE_TIME_SIZE)
+      pollChoices = [(frame.getStr(CHOICE_ID_SIZE), frame.getStr(CHOICE_NAME_SIZE)) for i in range(frame.getUint())]
+      return (pollID, pollName, openDateTime, closeDateTime, pollChoices)
+
+   msgBuf = sock.recv(CreatePollDataCodec.size)
    if  not msgBuf:
       return (None, None, None, None, None)
-   createPollData = CreatePollData.from_buffer(bytearray(msgBuf))
-   pollID = createPollData.pollID.decode().rstrip('\x00')
-   pollName = createPollData.pollName.decode().rstrip('\x00')
-   openDateTime = createPollData.openDateTime.decode().rstrip('\x00')
-   closeDateTime = createPollData.closeDateTime.decode().rstrip('\x00')
-   pollStatus = createPollData.pollStatus.decode().rstrip('\x00')
-   numChoices = socket.ntohs(createPollData.numChoices)
+   pollID, pollName, openDateTime, closeDateTime, pollStatus, numChoices = CreatePollDataCodec.unpack(msgBuf)
 
    pollChoices = []
    if numChoices:
-      msgBuf = sock.recv(ctypes.sizeof(PollChoiceData) * numChoices)
+      msgBuf = sock.recv(PollChoiceDataCodec.size * numChoices)
       if  not msgBuf:
          return (None, None, None, None, None)
-
-      pollChoiceData = (PollChoiceData * numChoices).from_buffer(bytearray(msgBuf))
-      for i in range(0, numChoices):
-         choiceID = pollChoiceData[i].choiceID.decode().rstrip('\x00')
-         choiceName = pollChoiceData[i].choiceName.decode().rstrip('\x00')
-         pollChoices.append((choiceID, choiceName))
+      pollChoices = PollChoiceDataCodec.unpackArray(msgBuf, numChoices)
 
    return (pollID, pollName, openDateTime, closeDateTime, pollChoices)
 
 class AddPollChoicesData(ctypes.Structure):
     _fields_ = [('pollID', ctypes.c_char * POLL_ID_SIZE),
                 ('numChoices', ctypes.c_uint16)]
+AddPollChoicesDataCodec = StructCodec(AddPollChoicesData)
 
 class AddPollChoicesDataReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', AddPollChoicesData)]
     _pack_ = 1
+AddPollChoicesDataReqCodec = StructCodec(AddPollChoicesDataReq)
 
 def sendAddPollChoicesReqMsg(sock, pollID, pollChoices):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(POLL_ADD_CHOICES, 1).putStr(pollID, POLL_ID_SIZE).putUint(len(pollChoices))
+      for choiceID, choiceName in pollChoices:
+         frameWriter.putStr(choiceID, CHOICE_ID_SIZE).putStr(choiceName, CHOICE_NAME_SIZE)
+      return sendFrame(sock, frameWriter)
+
    numChoices = len(pollChoices)
-   addPollChoicesDataReq = AddPollChoicesDataReq()
-   addPollChoicesDataReq.hdr.msgType = socket.htons(POLL_ADD_CHOICES)
-   addPollChoicesDataReq.hdr.flags = socket.htons(1)
-   addPollChoicesDataReq.data.pollID = pollID.encode()
-   addPollChoicesDataReq.data.numChoices = socket.htons(numChoices)
-
-   pollChoiceData = (PollChoiceData * numChoices)()
-   for i in range(0, numChoices):
-      pollChoiceData[i].choiceID = pollChoices[i][0].encode()
-      pollChoiceData[i].choiceName = pollChoices[i][1].encode()
-
-   numBytes = sock.send(addPollChoicesDataReq)
-   if numBytes == ctypes.sizeof(addPollChoicesDataReq):
-      numBytes += sock.send(pollChoiceData)
-
-   if numBytes == ctypes.sizeof(addPollChoicesDataReq) + ctypes.sizeof(pollChoiceData):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   msgBuf = GetSendBuffer(AddPollChoicesDataReqCodec.size + PollChoiceDataCodec.size * numChoices)
+   offset = AddPollChoicesDataReqCodec.packInto(msgBuf, 0, POLL_ADD_CHOICES, 1, pollID, numChoices)
+   PollChoiceDataCodec.packArrayInto(msgBuf, offset, pollChoices)
+
+   return sendBuffer(sock, msgBuf)
 
 def recvAddPollChoicesData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(AddPollChoicesData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      pollID = frame.getStr(POLL_ID_SIZE)
+      pollChoices = [(frame.getStr(CHOICE_ID_SIZE), frame.getStr(CHOICE_NAME_SIZE)) for i in range(frame.getUint())]
+      return (pollID, pollChoices)
+
+   msgBuf = sock.recv(AddPollChoicesDataCodec.size)
    if  not msgBuf:
       return (None, None)
-   addPollChoicesData = AddPollChoicesData.from_buffer(bytearray(msgBuf))
-   pollID = addPollChoicesData.pollID.decode().rstrip('\x00')
-   numChoices = socket.ntohs(addPollChoicesData.numChoices)
+   pollID, numChoices = AddPollChoicesDataCodec.unpack(msgBuf)
 
-   msgBuf = sock.recv(ctypes.sizeof(PollChoiceData) * numChoices)
+   msgBuf = sock.recv(PollChoiceDataCodec.size * numChoices)
    if  not msgBuf:
       return (None, None)
-
-   pollChoiceData = (PollChoiceData * numChoices).from_buffer(bytearray(msgBuf))
-   pollChoices = []
-   for i in range(0, numChoices):
-      choiceID = pollChoiceData[i].choiceID.decode().rstrip('\x00')
-      choiceName = pollChoiceData[i].choiceName.decode().rstrip('\x00')
-      pollChoices.append((choiceID, choiceName))
+   pollChoices = PollChoiceDataCodec.unpackArray(msgBuf, numChoices)
 
    return (pollID, pollChoices)
 
 class RemovePollChoicesData(ctypes.Structure):
     _fields_ = [('pollID', ctypes.c_char * POLL_ID_SIZE),
                 ('numChoices', ctypes.c_uint16)]
+RemovePollChoicesDataCodec = StructCodec(RemovePollChoicesData)
 
 class RemovePollChoicesDataReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', RemovePollChoicesData)]
     _pack_ = 1
+RemovePollChoicesDataReqCodec = StructCodec(RemovePollChoicesDataReq)
 
 def sendRemovePollChoicesReqMsg(sock, pollID, pollChoices):
-   numChoices = len(pollChoices)
-   removePollChoicesDataReq = RemovePollChoicesDataReq()
-   removePollChoicesDataReq.hdr.msgType = socket.htons(POLL_REMOVE_CHOICES)
-   removePollChoicesDataReq.hdr.flags = socket.htons(1)
-   removePollChoicesDataReq.data.pollID = pollID.encode()
-   removePollChoicesDataReq.data.numChoices = socket.htons(numChoices)
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(POLL_REMOVE_CHOICES, 1).putStr(pollID, POLL_ID_SIZE).putUint(len(pollChoices))
+      for choiceID in pollChoices:
+         frameWriter.putStr(choiceID, CHOICE_ID_SIZE)
+      return sendFrame(sock, frameWriter)
 
-   pollChoiceData = (PollChoiceData * numChoices)()
-   for i in range(0, numChoices):
-      pollChoiceData[i].choiceID = pollChoices[i].encode()
+   numChoices = len(pollChoices)
+   msgBuf = GetSendBuffer(RemovePollChoicesDataReqCodec.size + PollChoiceDataCodec.size * numChoices)
+   offset = RemovePollChoicesDataReqCodec.packInto(msgBuf, 0, POLL_REMOVE_CHOICES, 1, pollID, numChoices)
+   PollChoiceDataCodec.packArrayInto(msgBuf, offset, [(choiceID, "") for choiceID in pollChoices])
 
-   numBytes = sock.send(removePollChoicesDataReq)
-   if numBytes == ctypes.sizeof(removePollChoicesDataReq):
-      numBytes += sock.send(pollChoiceData)
-
-   if numBytes == ctypes.sizeof(removePollChoicesDataReq) + ctypes.sizeof(pollChoiceData):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   return sendBuffer(sock, msgBuf)
 
 def recvRemovePollChoicesData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(RemovePollChoicesData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      pollID = frame.getStr(POLL_ID_SIZE)
+      pollChoices = [frame.getStr(CHOICE_ID_SIZE) for i in range(frame.getUint())]
+      return (pollID, pollChoices)
+
+   msgBuf = sock.recv(RemovePollChoicesDataCodec.size)
    if  not msgBuf:
       return (None, None)
-   removePollChoicesData = RemovePollChoicesData.from_buffer(bytearray(msgBuf))
-   pollID = removePollChoicesData.pollID.decode().rstrip('\x00')
-   numChoices = socket.ntohs(removePollChoicesData.numChoices)
+   pollID, numChoices = RemovePollChoicesDataCodec.unpack(msgBuf)
 
-   msgBuf = sock.recv(ctypes.sizeof(PollChoiceData) * numChoices)
+   msgBuf = sock.recv(PollChoiceDataCodec.size * numChoices)
    if  not msgBuf:
       return (None, None)
-
-   pollChoiceData = (PollChoiceData * numChoices).from_buffer(bytearray(msgBuf))
-   pollChoices = []
-   for i in range(0, numChoices):
-      choiceID = pollChoiceData[i].choiceID.decode().rstrip('\x00')
-      pollChoices.append(choiceID)
+   pollChoices = [choiceID for (choiceID, choiceName) in PollChoiceDataCodec.unpackArray(msgBuf, numChoices)]
 
    return (pollID, pollChoices)
 
 class SetPollStatusData(ctypes.Structure):
     _fields_ = [('pollID', ctypes.c_char * POLL_ID_SIZE),
                 ('status', ctypes.c_char)]
+SetPollStatusDataCodec = StructCodec(SetPollStatusData)
 
 class SetPollStatusDataReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', SetPollStatusData)]
     _pack_ = 1
+SetPollStatusDataReqCodec = StructCodec(SetPollStatusDataReq)
 
 def sendSetPollStatusDataReq(sock, pollID, pollStatus):
-   setPollStatusDataReq = SetPollStatusDataReq()
-   setPollStatusDataReq.hdr.msgType = socket.htons(POLL_SET_STATUS)
-   setPollStatusDataReq.hdr.flags = socket.htons(1)
-   setPollStatusDataReq.data.pollID = pollID.encode()
-   setPollStatusDataReq.data.status = pollStatus.encode()
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(POLL_SET_STATUS, 1).putStr(pollID, POLL_ID_SIZE).putStr(pollStatus, 1))
 
-   if sock.send(setPollStatusDataReq) == ctypes.sizeof(setPollStatusDataReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   return sendBuffer(sock, SetPollStatusDataReqCodec.pack(POLL_SET_STATUS, 1, pollID, pollStatus))
 
 def recvSetPollStatusData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(SetPollStatusData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      return (frame.getStr(POLL_ID_SIZE), frame.getStr(1))
+
+   msgBuf = sock.recv(SetPollStatusDataCodec.size)
    if  not msgBuf:
       return (None, None)
-   setPollStatusData = SetPollStatusData.from_buffer(bytearray(msgBuf))
-   pollID = setPollStatusData.pollID.decode().rstrip('\x00')
-   status = setPollStatusData.status.decode()
-
-   return (pollID, status)
+   return SetPollStatusDataCodec.unpack(msgBuf)
 
 class PollMakeSelectionReqData(ctypes.Structure):
     _fields_ = [('pollID', ctypes.c_char * CHOICE_ID_SIZE),
                 ('choiceID', ctypes.c_char * POLL_ID_SIZE)]
+PollMakeSelectionReqDataCodec = StructCodec(PollMakeSelectionReqData)
 
 class PollMakeSelectionReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', PollMakeSelectionReqData)]
     _pack_ = 1
+PollMakeSelectionReqCodec = StructCodec(PollMakeSelectionReq)
 
 def sendPollMakeSelectionReq(sock, pollID, choiceID):
-   pollMakeSelectionReq = PollMakeSelectionReq()
-   pollMakeSelectionReq.hdr.msgType = socket.htons(USER_POLL_MAKE_SELECTION)
-   pollMakeSelectionReq.hdr.flags = socket.htons(1)
-   pollMakeSelectionReq.data.pollID = pollID.encode()
-   pollMakeSelectionReq.data.choiceID = choiceID.encode()
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(USER_POLL_MAKE_SELECTION, 1).putStr(pollID, POLL_ID_SIZE).putStr(choiceID, CHOICE_ID_SIZE))
 
-   if sock.send(pollMakeSelectionReq) == ctypes.sizeof(pollMakeSelectionReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   return sendBuffer(sock, PollMakeSelectionReqCodec.pack(USER_POLL_MAKE_SELECTION, 1, pollID, choiceID))
 
 def recvPollMakeSelectionReqData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(PollMakeSelectionReqData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      return (frame.getStr(POLL_ID_SIZE), frame.getStr(CHOICE_ID_SIZE))
+
+   msgBuf = sock.recv(PollMakeSelectionReqDataCodec.size)
    if  not msgBuf:
       return (None, None)
-   pollMakeSelectionReqData = PollMakeSelectionReqData.from_buffer(bytearray(msgBuf))
-   pollID = DecodeAndStrip(pollMakeSelectionReqData.pollID)
-   choiceID = DecodeAndStrip(pollMakeSelectionReqData.choiceID)
+   return PollMakeSelectionReqDataCodec.unpack(msgBuf)
+
+# Make many poll selections in one request
+#
+# The request carries an array of PollMakeSelectionReqData (pollID, choiceID). The
+# response carries the status and reason of each selection, in the same order. A failed
+# selection does not undo the others. When a pollID is given more than once, only its first
+# selection is made, the later ones fail with REASON_DUP_POLL_DATA.
+#
+class PollMakeSelectionBatchReqData(ctypes.Structure):
+    _fields_ = [('numSelections', ctypes.c_uint16)]
+    _pack_ = 1
+PollMakeSelectionBatchReqDataCodec = StructCodec(PollMakeSelectionBatchReqData)
+
+class PollMakeSelectionBatchReq(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('data', PollMakeSelectionBatchReqData)]
+    _pack_ = 1
+PollMakeSelectionBatchReqCodec = StructCodec(PollMakeSelectionBatchReq)
+
+class PollSelectionResultData(ctypes.Structure):
+    _fields_ = [('status', ctypes.c_uint16),
+                ('reason', ctypes.c_uint16)]
+    _pack_ = 1
+PollSelectionResultDataCodec = StructCodec(PollSelectionResultData)
+
+class PollMakeSelectionBatchResponse(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('status', ctypes.c_uint16),
+                ('reason', ctypes.c_uint16),
+                ('numDataElems', ctypes.c_uint16)]
+    _pack_ = 1
+PollMakeSelectionBatchResponseCodec = StructCodec(PollMakeSelectionBatchResponse)
+
+def sendPollMakeSelectionBatchReq(sock, selections):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(USER_POLL_MAKE_SELECTION_BATCH, 1).putUint(len(selections))
+      for pollID, choiceID in selections:
+         frameWriter.putStr(pollID, POLL_ID_SIZE).putStr(choiceID, CHOICE_ID_SIZE)
+      return sendFrame(sock, frameWriter)
+
+   numSelections = len(selections)
+   msgBuf = GetSendBuffer(PollMakeSelectionBatchReqCodec.size + PollMakeSelectionReqDataCodec.size * numSelections)
+   offset = PollMakeSelectionBatchReqCodec.packInto(msgBuf, 0, USER_POLL_MAKE_SELECTION_BATCH, 1, numSelections)
+   PollMakeSelectionReqDataCodec.packArrayInto(msgBuf, offset, selections)
+
+   return sendBuffer(sock, msgBuf)
 
-   return (pollID, choiceID)
+def recvPollMakeSelectionBatchReqData(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      return [(frame.getStr(POLL_ID_SIZE), frame.getStr(CHOICE_ID_SIZE)) for i in range(frame.getUint())]
+
+   msgBuf = sock.recv(PollMakeSelectionBatchReqDataCodec.size)
+   if  not msgBuf:
+      return None
+   numSelections, = PollMakeSelectionBatchReqDataCodec.unpack(msgBuf)
+
+   selections = []
+   if numSelections:
+      msgBuf = sock.recv(PollMakeSelectionReqDataCodec.size * numSelections)
+      if  not msgBuf:
+         return None
+      selections = PollMakeSelectionReqDataCodec.unpackArray(msgBuf, numSelections)
+
+   return selections
+
+def sendPollMakeSelectionBatchResponse(sock, status, reason, results):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(USER_POLL_MAKE_SELECTION_BATCH, 2).putUint(status).putUint(reason).putUint(len(results))
+      for selectionStatus, selectionReason in results:
+         frameWriter.putUint(selectionStatus).putUint(selectionReason)
+      return sendFrame(sock, frameWriter)
+
+   msgBuf = GetSendBuffer(PollMakeSelectionBatchResponseCodec.size + PollSelectionResultDataCodec.size * len(results))
+   offset = PollMakeSelectionBatchResponseCodec.packInto(msgBuf, 0, USER_POLL_MAKE_SELECTION_BATCH, 2, status, reason, len(results))
+   PollSelectionResultDataCodec.packArrayInto(msgBuf, offset, results)
+
+   return sendBuffer(sock, msgBuf)
+
+def recvPollMakeSelectionBatchResponse(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None or frame.msgType != USER_POLL_MAKE_SELECTION_BATCH or frame.flags != 2:
+         return None, None, None, None, None
+      status, reason = frame.getUint(), frame.getUint()
+      results = [(frame.getUint(), frame.getUint()) for i in range(frame.getUint())]
+      return frame.msgType, frame.flags, status, reason, results
+
+   msgBuf = sock.recv(PollMakeSelectionBatchResponseCodec.size)
+   if  not msgBuf:
+      return None, None, None, None, None
+   msgType, flags, status, reason, numDataElems = PollMakeSelectionBatchResponseCodec.unpack(msgBuf)
+
+   if msgType != USER_POLL_MAKE_SELECTION_BATCH or flags != 2:
+      return None, None, None, None, None
+
+   results = []
+   if numDataElems > 0:
+      msgBuf = sock.recv(PollSelectionResultDataCodec.size * numDataElems)
+      if  not msgBuf:
+         return None, None, None, None, None
+      results = PollSelectionResultDataCodec.unpackArray(msgBuf, numDataElems)
+
+   return msgType, flags, status, reason, results
 
 class ListUsersResponseData(ctypes.Structure):
     _fields_ = [('userID', ctypes.c_char * USER_ID_SIZE),
                 ('userName', ctypes.c_char * USER_NAME_SIZE),
                 ('userEmail', ctypes.c_char * USER_EMAIL_SIZE)]
     _pack_ = 1
+ListUsersResponseDataCodec = StructCodec(ListUsersResponseData)
 
 class ListUsersReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr)]
     _pack_ = 1
+ListUsersReqCodec = StructCodec(ListUsersReq)
 
 class ListUsersResponse(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
@@ -556,54 +1159,44 @@ class ListUsersResponse(ctypes.Structure):
                 ('reason', ctypes.c_uint16),
                 ('numDataElems', ctypes.c_uint16)]
     _pack_ = 1
+ListUsersResponseCodec = StructCodec(ListUsersResponse)
 
 def sendListUsersReq(sock):
-   listUsersReq = ListUsersReq()
-   listUsersReq.hdr.msgType = socket.htons(LIST_USERS)
-   listUsersReq.hdr.flags = socket.htons(1)
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(LIST_USERS, 1))
 
-   if sock.send(listUsersReq) == ctypes.sizeof(listUsersReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   return sendBuffer(sock, ListUsersReqCodec.pack(LIST_USERS, 1))
 
 def sendListUsersResponse(sock, status, reason, userList):
-   listUsersResponse = ListUsersResponse()
-   listUsersResponse.hdr.msgType = socket.htons(LIST_USERS)
-   listUsersResponse.hdr.flags = socket.htons(2)
-   listUsersResponse.status = socket.htons(status)
-   listUsersResponse.reason = socket.htons(reason)
-   listUsersResponse.numDataElems = socket.htons(len(userList))
-
-   listUsersResponseData = (ListUsersResponseData * len(userList))()
-
-   for i in range(0, len(userList)):
-      listUsersResponseData[i].userID = userList[i]['userID'].encode()
-      listUsersResponseData[i].userName = userList[i]['userName'].encode()
-      listUsersResponseData[i].userEmail = userList[i]['userEmail'].encode()
-
-   expectedNumBytes = ctypes.sizeof(listUsersResponse)
-   numBytes = sock.send(listUsersResponse)
-   if numBytes == ctypes.sizeof(listUsersResponse) and len(userList) > 0:
-      expectedNumBytes += ctypes.sizeof(listUsersResponseData)
-      numBytes += sock.send(listUsersResponseData)
-
-   if numBytes == expectedNumBytes:
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(LIST_USERS, 2).putUint(status).putUint(reason).putUint(len(userList))
+      for user in userList:
+         frameWriter.putStr(user['userID']).putStr(user['userName']).putStr(user['userEmail'])
+      return sendFrame(sock, frameWriter)
+
+   msgBuf = GetSendBuffer(ListUsersResponseCodec.size + ListUsersResponseDataCodec.size * len(userList))
+   offset = ListUsersResponseCodec.packInto(msgBuf, 0, LIST_USERS, 2, status, reason, len(userList))
+   rows = list(map(operator.itemgetter('userID', 'userName', 'userEmail'), userList))
+   ListUsersResponseDataCodec.packArrayInto(msgBuf, offset, rows)
+
+   return sendBuffer(sock, msgBuf)
 
 def recvListUsersResponse(sock):
-   msgBuf = sock.recv(ctypes.sizeof(ListUsersResponse))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None or frame.msgType != LIST_USERS or frame.flags != 2:
+         return None, None, None, None, None
+      status, reason = frame.getUint(), frame.getUint()
+      if status != 0:
+         return frame.msgType, frame.flags, status, reason, None
+      userList = [{'userID': frame.getStr(), 'userName': frame.getStr(), 'userEmail': frame.getStr()}
+                  for i in range(frame.getUint())]
+      return frame.msgType, frame.flags, status, reason, userList
+
+   msgBuf = sock.recv(ListUsersResponseCodec.size)
    if  not msgBuf:
       return (None, None, None, None, None)
-
-   listUsersResponse = ListUsersResponse.from_buffer(bytearray(msgBuf))
-   msgType = socket.ntohs(listUsersResponse.hdr.msgType)
-   flags = socket.ntohs(listUsersResponse.hdr.flags)
-   status = socket.ntohs(listUsersResponse.status)
-   reason = socket.ntohs(listUsersResponse.reason)
-   numDataElems = socket.ntohs(listUsersResponse.numDataElems)
+   msgType, flags, status, reason, numDataElems = ListUsersResponseCodec.unpack(msgBuf)
 
    if msgType != LIST_USERS or flags != 2:
       return None, None, None, None, None
@@ -611,36 +1204,125 @@ def recvListUsersResponse(sock):
    if status != 0:
       return msgType, flags, status, reason, None
 
-   msgBuf = sock.recv(ctypes.sizeof(ListUsersResponseData) * numDataElems)
+   msgBuf = sock.recv(ListUsersResponseDataCodec.size * numDataElems)
    if  not msgBuf:
       return (None, None, None, None, None)
 
-   listUsersResponseData = (ListUsersResponseData * numDataElems).from_buffer(bytearray(msgBuf))
+   userList = [{'userID': userID, 'userName': userName, 'userEmail': userEmail}
+               for (userID, userName, userEmail) in ListUsersResponseDataCodec.unpackArray(msgBuf, numDataElems)]
+
+   return msgType, flags, status,reason, userList
 
-   userList = []
+#
+# List the users a page at a time
+#
+# The request selects the users whose userID starts with userIDPrefix and whose userName starts
+# with userNamePrefix ("" for any), and asks for at most pageSize of them (0: the server's default
+# page size) ordered by userID, after the user afterUserID ("" for the first page). The page is
+# sent in one or more LIST_USERS_PAGE responses as LIST_POLLS_PAGE, the last one with endOfPage
+# set and nextUserID, the afterUserID of the next page ("" when there are no more users). The
+# users are given and returned as tuples (userID, userName, userEmail).
+#
+class ListUsersPageReqData(ctypes.Structure):
+    _fields_ = [('userIDPrefix', ctypes.c_char * USER_ID_SIZE),
+                ('userNamePrefix', ctypes.c_char * USER_NAME_SIZE),
+                ('afterUserID', ctypes.c_char * USER_ID_SIZE),
+                ('pageSize', ctypes.c_uint16)]
+    _pack_ = 1
+ListUsersPageReqDataCodec = StructCodec(ListUsersPageReqData)
 
-   for i in range(0, numDataElems):
-      userList.append({
-          'userID': DecodeAndStrip(listUsersResponseData[i].userID),
-          'userName': DecodeAndStrip(listUsersResponseData[i].userName),
-          'userEmail': DecodeAndStrip(listUsersResponseData[i].userEmail)
-      })
+class ListUsersPageReq(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('data', ListUsersPageReqData)]
+    _pack_ = 1
+ListUsersPageReqCodec = StructCodec(ListUsersPageReq)
 
-   return msgType, flags, status,reason, userList
+class ListUsersPageResponse(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('status', ctypes.c_uint16),
+                ('reason', ctypes.c_uint16),
+                ('endOfPage', ctypes.c_uint16),
+                ('nextUserID', ctypes.c_char * USER_ID_SIZE),
+                ('numDataElems', ctypes.c_uint16)]
+    _pack_ = 1
+ListUsersPageResponseCodec = StructCodec(ListUsersPageResponse)
+
+def sendListUsersPageReq(sock, userIDPrefix="", userNamePrefix="", afterUserID="", pageSize=0):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(LIST_USERS_PAGE, 1).putStr(userIDPrefix, USER_ID_SIZE).putStr(userNamePrefix, USER_NAME_SIZE)
+      frameWriter.putStr(afterUserID, USER_ID_SIZE).putUint(pageSize)
+      return sendFrame(sock, frameWriter)
+
+   return sendBuffer(sock, ListUsersPageReqCodec.pack(LIST_USERS_PAGE, 1, userIDPrefix, userNamePrefix, afterUserID, pageSize))
+
+def recvListUsersPageReqData(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      return (frame.getStr(USER_ID_SIZE), frame.getStr(USER_NAME_SIZE), frame.getStr(USER_ID_SIZE), frame.getUint())
+
+   msgBuf = sock.recv(ListUsersPageReqDataCodec.size)
+   if  not msgBuf:
+      return (None, None, None, None)
+   return ListUsersPageReqDataCodec.unpack(msgBuf)
+
+def sendListUsersPageResponse(sock, status, reason, users, endOfPage=1, nextUserID=""):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(LIST_USERS_PAGE, 2).putUint(status).putUint(reason).putUint(endOfPage)
+      frameWriter.putStr(nextUserID).putUint(len(users))
+      for (userID, userName, userEmail) in users:
+         frameWriter.putStr(userID).putStr(userName).putStr(userEmail)
+      return sendFrame(sock, frameWriter)
+
+   msgBuf = GetSendBuffer(ListUsersPageResponseCodec.size + ListUsersResponseDataCodec.size * len(users))
+   offset = ListUsersPageResponseCodec.packInto(msgBuf, 0, LIST_USERS_PAGE, 2, status, reason, endOfPage, nextUserID, len(users))
+   ListUsersResponseDataCodec.packArrayInto(msgBuf, offset, users)
+
+   return sendBuffer(sock, msgBuf)
+
+# Returns the users of one LIST_USERS_PAGE response: (msgType, flags, status, reason,
+# (users, endOfPage, nextUserID))
+def recvListUsersPageResponse(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None or frame.msgType != LIST_USERS_PAGE or frame.flags != 2:
+         return None, None, None, None, (None, None, None)
+      status, reason, endOfPage, nextUserID = frame.getUint(), frame.getUint(), frame.getUint(), frame.getStr()
+      users = [(frame.getStr(), frame.getStr(), frame.getStr()) for i in range(frame.getUint())]
+      return frame.msgType, frame.flags, status, reason, (users, endOfPage, nextUserID)
+
+   msgBuf = sock.recv(ListUsersPageResponseCodec.size)
+   if  not msgBuf:
+      return None, None, None, None, (None, None, None)
+   msgType, flags, status, reason, endOfPage, nextUserID, numDataElems = ListUsersPageResponseCodec.unpack(msgBuf)
+
+   if msgType != LIST_USERS_PAGE or flags != 2:
+      return None, None, None, None, (None, None, None)
+
+   users = []
+   if numDataElems > 0:
+      msgBuf = sock.recv(ListUsersResponseDataCodec.size * numDataElems)
+      if  not msgBuf:
+         return None, None, None, None, (None, None, None)
+      users = ListUsersResponseDataCodec.unpackArray(msgBuf, numDataElems)
+
+   return msgType, flags, status, reason, (users, endOfPage, nextUserID)
 
 class PollResultsReqData(ctypes.Structure):
     _fields_ = [('pollID', ctypes.c_char * POLL_ID_SIZE)]
     _pack_ = 1
+PollResultsReqDataCodec = StructCodec(PollResultsReqData)
 
 class PollResultsReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', PollResultsReqData)]
     _pack_ = 1
+PollResultsReqCodec = StructCodec(PollResultsReq)
 
 class PollResultsResponseData(ctypes.Structure):
     _fields_ = [('choiceName', ctypes.c_char * CHOICE_NAME_SIZE),
                 ('count', ctypes.c_uint16)]
     _pack_ = 1
+PollResultsResponseDataCodec = StructCodec(PollResultsResponseData)
 
 class PollResultsResponse(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
@@ -649,65 +1331,71 @@ class PollResultsResponse(ctypes.Structure):
                 ('pollName', ctypes.c_char * POLL_NAME_SIZE),
                 ('numDataElems', ctypes.c_uint16)]
     _pack_ = 1
+PollResultsResponseCodec = StructCodec(PollResultsResponse)
 
 def sendPollGetResultsReq(sock, pollID):
-   pollResultsReq = PollResultsReq()
-   pollResultsReq.hdr.msgType = socket.htons(USER_POLL_GET_RESULTS)
-   pollResultsReq.hdr.flags = socket.htons(1)
-   pollResultsReq.data.pollID = pollID.encode()
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(USER_POLL_GET_RESULTS, 1).putStr(pollID, POLL_ID_SIZE))
 
-   if sock.send(pollResultsReq) == ctypes.sizeof(pollResultsReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   return sendBuffer(sock, PollResultsReqCodec.pack(USER_POLL_GET_RESULTS, 1, pollID))
 
 def recvPollGetResultsReqData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(PollResultsReqData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sock.frame.getStr(POLL_ID_SIZE)
+
+   msgBuf = sock.recv(PollResultsReqDataCodec.size)
    if  not msgBuf:
-      return (None, None)
-   pollResultsReqData = PollResultsReqData.from_buffer(bytearray(msgBuf))
-   pollID = DecodeAndStrip(pollResultsReqData.pollID)
+      return None
+   pollID, = PollResultsReqDataCodec.unpack(msgBuf)
 
-   return (pollID)
+   return pollID
 
-def sendPollGetResultsResponse(sock, status, reason, pollName, pollResults):
-   pollResultsResponse = PollResultsResponse()
-   pollResultsResponse.hdr.msgType = socket.htons(USER_POLL_GET_RESULTS)
-   pollResultsResponse.hdr.flags = socket.htons(2)
-   pollResultsResponse.status = socket.htons(status)
-   pollResultsResponse.reason = socket.htons(reason)
-   pollResultsResponse.pollName = pollName.encode()
-   pollResultsResponse.numDataElems = socket.htons(len(pollResults))
-
-   pollResultsResponseData = (PollResultsResponseData * len(pollResults))()
-
-   for i in range(0, len(pollResults)):
-      pollResultsResponseData[i].choiceName = pollResults[i]['choiceName'].encode()
-      pollResultsResponseData[i].count = socket.htons(pollResults[i]['count'])
-
-   expectedNumBytes = ctypes.sizeof(pollResultsResponse)
-   numBytes = sock.send(pollResultsResponse)
-   if numBytes == expectedNumBytes and len(pollResults) > 0:
-      expectedNumBytes +=  ctypes.sizeof(pollResultsResponseData)
-      numBytes += sock.send(pollResultsResponseData)
-
-   if numBytes == expectedNumBytes:
+# Returns the USER_POLL_GET_RESULTS response ready to be sent (see poll_resultscache): bytes for
+# version 1, the FrameWriter for the later versions as the request ID is added when it is sent
+def encodePollGetResultsResponse(status, reason, pollName, pollResults, wireVersion=POLL_WIRE_VERSION_1):
+   if wireVersion >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(USER_POLL_GET_RESULTS, 2).putUint(status).putUint(reason).putStr(pollName or "")
+      frameWriter.putUint(len(pollResults))
+      for result in pollResults:
+         frameWriter.putStr(result['choiceName']).putUint(result['count'])
+      return frameWriter
+
+   msgBuf = bytearray(PollResultsResponseCodec.size + PollResultsResponseDataCodec.size * len(pollResults))
+   offset = PollResultsResponseCodec.packInto(msgBuf, 0, USER_POLL_GET_RESULTS, 2, status, reason, pollName or "", len(pollResults))
+   rows = list(map(operator.itemgetter('choiceName', 'count'), pollResults))
+   PollResultsResponseDataCodec.packArrayInto(msgBuf, offset, rows)
+
+   return bytes(msgBuf)
+
+# Sends a response encoded by encodePollGetResultsResponse()
+def sendEncodedResponse(sock, msgBuf):
+   if isinstance(msgBuf, FrameWriter):
+      return sendFrame(sock, msgBuf)
+
+   numBytes = sock.send(msgBuf)
+   if numBytes == len(msgBuf):
       return OP_SUCCESS
    else:
       return OP_FAILURE
 
+def sendPollGetResultsResponse(sock, status, reason, pollName, pollResults):
+   return sendEncodedResponse(sock, encodePollGetResultsResponse(status, reason, pollName, pollResults, GetWireVersion(sock)))
+
 def recvPollGetResultsResponse(sock):
-   msgBuf = sock.recv(ctypes.sizeof(PollResultsResponse))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None or frame.msgType != USER_POLL_GET_RESULTS or frame.flags != 2:
+         return None, None, None, None, (None, None)
+      status, reason, pollName = frame.getUint(), frame.getUint(), frame.getStr()
+      if status != 0:
+         return frame.msgType, frame.flags, status, reason, (None, None)
+      pollResults = [{'choiceName': frame.getStr(), 'count': frame.getUint()} for i in range(frame.getUint())]
+      return frame.msgType, frame.flags, status, reason, (pollName, pollResults)
+
+   msgBuf = sock.recv(PollResultsResponseCodec.size)
    if  not msgBuf:
       return None, None, None, None, (None, None)
-
-   pollResultsResponse = PollResultsResponse.from_buffer(bytearray(msgBuf))
-   msgType = socket.ntohs(pollResultsResponse.hdr.msgType)
-   flags = socket.ntohs(pollResultsResponse.hdr.flags)
-   status = socket.ntohs(pollResultsResponse.status)
-   reason = socket.ntohs(pollResultsResponse.reason)
-   numDataElems = socket.ntohs(pollResultsResponse.numDataElems)
-   pollName = DecodeAndStrip(pollResultsResponse.pollName)
+   msgType, flags, status, reason, pollName, numDataElems = PollResultsResponseCodec.unpack(msgBuf)
 
    if msgType != USER_POLL_GET_RESULTS or flags != 2:
       return None, None, None, None, (None, None)
@@ -718,17 +1406,12 @@ def recvPollGetResultsResponse(sock):
    pollResults = []
 
    if numDataElems > 0:
-      msgBuf = sock.recv(ctypes.sizeof(ListUsersResponseData) * numDataElems)
+      msgBuf = sock.recv(PollResultsResponseDataCodec.size * numDataElems)
       if  not msgBuf:
          return (None, None, None, None, None)
 
-      pollResultsResponseData = (PollResultsResponseData * numDataElems).from_buffer(bytearray(msgBuf))
-
-      for i in range(0, numDataElems):
-         pollResults.append({
-             'choiceName': DecodeAndStrip(pollResultsResponseData[i].choiceName),
-             'count': socket.htons(pollResultsResponseData[i].count)
-         })
+      pollResults = [{'choiceName': choiceName, 'count': count}
+                     for (choiceName, count) in PollResultsResponseDataCodec.unpackArray(msgBuf, numDataElems)]
 
    return msgType, flags, status, reason, (pollName, pollResults)
 
@@ -739,14 +1422,17 @@ class ListPollsResponseData(ctypes.Structure):
                 ('endDate', ctypes.c_char * DATE_TIME_SIZE),
                 ('pollStatus', ctypes.c_char)]
     _pack_ = 1
+ListPollsResponseDataCodec = StructCodec(ListPollsResponseData)
 
 class ListPollsReqData(ctypes.Structure):
     _fields_ = [('pollID', ctypes.c_char * POLL_ID_SIZE)]
+ListPollsReqDataCodec = StructCodec(ListPollsReqData)
 
 class ListPollsReq(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
                 ('data', ListPollsReqData)]
     _pack_ = 1
+ListPollsReqCodec = StructCodec(ListPollsReq)
 
 class ListPollsResponse(ctypes.Structure):
     _fields_ = [('hdr', PollMsgHdr),
@@ -754,67 +1440,57 @@ class ListPollsResponse(ctypes.Structure):
                 ('reason', ctypes.c_uint16),
                 ('numDataElems', ctypes.c_uint16)]
     _pack_ = 1
+ListPollsResponseCodec = StructCodec(ListPollsResponse)
 
 def sendListPollsReq(sock, pollID = ""):
-   listPollReq = ListPollsReq()
-   listPollReq.hdr.msgType = socket.htons(LIST_POLLS)
-   listPollReq.hdr.flags = socket.htons(1)
-   listPollReq.data.pollID = pollID.encode()
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(LIST_POLLS, 1).putStr(pollID, POLL_ID_SIZE))
 
-   if sock.send(listPollReq) == ctypes.sizeof(listPollReq):
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   return sendBuffer(sock, ListPollsReqCodec.pack(LIST_POLLS, 1, pollID))
 
 def recvListPollsReqData(sock):
-   msgBuf = sock.recv(ctypes.sizeof(ListPollsReqData))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sock.frame.getStr(POLL_ID_SIZE)
+
+   msgBuf = sock.recv(ListPollsReqDataCodec.size)
    if  not msgBuf:
       return None
-   listPollsReqData = ListPollsReqData.from_buffer(bytearray(msgBuf))
-   pollID = DecodeAndStrip(listPollsReqData.pollID)
+   pollID, = ListPollsReqDataCodec.unpack(msgBuf)
 
    return pollID
 
 def sendListPollsResponse(sock, status, reason, pollList):
-   listPollResponse = ListPollsResponse()
-   listPollResponse.hdr.msgType = socket.htons(LIST_POLLS)
-   listPollResponse.hdr.flags = socket.htons(2)
-   listPollResponse.status = socket.htons(status)
-   listPollResponse.reason = socket.htons(reason)
-   listPollResponse.numDataElems = socket.htons(len(pollList))
-
-   listPollResponseData = (ListPollsResponseData * len(pollList))()
-
-   for i in range(0, len(pollList)):
-      listPollResponseData[i].pollID = pollList[i]['pollId'].encode()
-      listPollResponseData[i].pollName = pollList[i]['pollName'].encode()
-      listPollResponseData[i].startDate = pollList[i]['startDate'].encode()
-      listPollResponseData[i].endDate = pollList[i]['endDate'].encode()
-      listPollResponseData[i].pollStatus = pollList[i]['pollStatus'].encode()
-
-   expectedNumBytes = ctypes.sizeof(listPollResponse)
-   numBytes = sock.send(listPollResponse)
-   if numBytes == ctypes.sizeof(listPollResponse) and len(pollList) > 0:
-      expectedNumBytes += ctypes.sizeof(listPollResponseData)
-      numBytes += sock.send(listPollResponseData)
-
-   print(numBytes)
-   if numBytes == expectedNumBytes:
-      return OP_SUCCESS
-   else:
-      return OP_FAILURE
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(LIST_POLLS, 2).putUint(status).putUint(reason).putUint(len(pollList))
+      for poll in pollList:
+         frameWriter.putStr(poll['pollId']).putStr(poll['pollName']).putStr(poll['startDate'])
+         frameWriter.putStr(poll['endDate']).putStr(poll['pollStatus'])
+      return sendFrame(sock, frameWriter)
+
+   msgBuf = GetSendBuffer(ListPollsResponseCodec.size + ListPollsResponseDataCodec.size * len(pollList))
+   offset = ListPollsResponseCodec.packInto(msgBuf, 0, LIST_POLLS, 2, status, reason, len(pollList))
+   rows = list(map(operator.itemgetter('pollId', 'pollName', 'startDate', 'endDate', 'pollStatus'), pollList))
+   ListPollsResponseDataCodec.packArrayInto(msgBuf, offset, rows)
+
+   return sendBuffer(sock, msgBuf)
 
 def recvListPollsResponse(sock):
-   msgBuf = sock.recv(ctypes.sizeof(ListPollsResponse))
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None or frame.msgType != LIST_POLLS or frame.flags != 2:
+         return None, None, None, None, None
+      status, reason = frame.getUint(), frame.getUint()
+      if status != 0:
+         return frame.msgType, frame.flags, status, reason, None
+      pollList = [{'pollID': frame.getStr(), 'pollName': frame.getStr(), 'startDate': frame.getStr(),
+                   'endDate': frame.getStr(), 'pollStatus': frame.getStr(), 'choices': []}
+                  for i in range(frame.getUint())]
+      return frame.msgType, frame.flags, status, reason, pollList
+
+   msgBuf = sock.recv(ListPollsResponseCodec.size)
    if  not msgBuf:
       return (None, None, None, None, None)
-
-   listPollResponse = ListPollsResponse.from_buffer(bytearray(msgBuf))
-   msgType = socket.ntohs(listPollResponse.hdr.msgType)
-   flags = socket.ntohs(listPollResponse.hdr.flags)
-   status = socket.ntohs(listPollResponse.status)
-   reason = socket.ntohs(listPollResponse.reason)
-   numDataElems = socket.ntohs(listPollResponse.numDataElems)
+   msgType, flags, status, reason, numDataElems = ListPollsResponseCodec.unpack(msgBuf)
 
    if msgType != LIST_POLLS or flags != 2:
       return None, None, None, None, None
@@ -822,22 +1498,376 @@ def recvListPollsResponse(sock):
    if status != 0:
       return msgType, flags, status, reason, None
 
-   msgBuf = sock.recv(ctypes.sizeof(ListPollsResponseData) * numDataElems)
+   msgBuf = sock.recv(ListPollsResponseDataCodec.size * numDataElems)
    if  not msgBuf:
       return (None, None, None, None, None)
 
-   listPollResponseData = (ListPollsResponseData * numDataElems).from_buffer(bytearray(msgBuf))
+   pollList = [{'pollID': pollID, 'pollName': pollName, 'startDate': startDate, 'endDate': endDate,
+                'pollStatus': pollStatus, 'choices': []}
+               for (pollID, pollName, startDate, endDate, pollStatus) in ListPollsResponseDataCodec.unpackArray(msgBuf, numDataElems)]
 
-   pollList = []
+   return msgType, flags, status, reason, pollList
 
-   for i in range(0, numDataElems):
-      pollList.append({
-          'pollID': DecodeAndStrip(listPollResponseData[i].pollID),
-          'pollName': DecodeAndStrip(listPollResponseData[i].pollName),
-          'startDate': DecodeAndStrip(listPollResponseData[i].startDate),
-          'endDate': DecodeAndStrip(listPollResponseData[i].endDate),
-          'pollStatus': DecodeAndStrip(listPollResponseData[i].pollStatus),
-          'choices': []
-      })
+#
+# List the polls a page at a time
+#
+# The request selects the polls whose pollID starts with pollIDPrefix, owned by ownerID and with
+# the status pollStatus ("" for any), and asks for at most pageSize of them (0: the server's
+# default page size) ordered by pollID, after the poll afterPollID ("" for the first page).
+#
+# The server sends the page as it reads it from the database, in one or more LIST_POLLS_PAGE
+# responses of up to a few hundred polls. The last response of the page has endOfPage set and
+# nextPollID, the afterPollID of the next page ("" when there are no more polls). The polls are
+# given and returned as tuples (pollID, pollName, startDate, endDate, pollStatus).
+#
+class ListPollsPageReqData(ctypes.Structure):
+    _fields_ = [('pollIDPrefix', ctypes.c_char * POLL_ID_SIZE),
+                ('ownerID', ctypes.c_char * USER_ID_SIZE),
+                ('pollStatus', ctypes.c_char),
+                ('afterPollID', ctypes.c_char * POLL_ID_SIZE),
+                ('pageSize', ctypes.c_uint16)]
+    _pack_ = 1
+ListPollsPageReqDataCodec = StructCodec(ListPollsPageReqData)
 
-   return msgType, flags, status, reason, pollList
+class ListPollsPageReq(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('data', ListPollsPageReqData)]
+    _pack_ = 1
+ListPollsPageReqCodec = StructCodec(ListPollsPageReq)
+
+class ListPollsPageResponse(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('status', ctypes.c_uint16),
+                ('reason', ctypes.c_uint16),
+                ('endOfPage', ctypes.c_uint16),
+                ('nextPollID', ctypes.c_char * POLL_ID_SIZE),
+                ('numDataElems', ctypes.c_uint16)]
+    _pack_ = 1
+ListPollsPageResponseCodec = StructCodec(ListPollsPageResponse)
+
+def sendListPollsPageReq(sock, pollIDPrefix="", ownerID="", pollStatus="", afterPollID="", pageSize=0):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(LIST_POLLS_PAGE, 1).putStr(pollIDPrefix, POLL_ID_SIZE).putStr(ownerID, USER_ID_SIZE)
+      frameWriter.putStr(pollStatus, 1).putStr(afterPollID, POLL_ID_SIZE).putUint(pageSize)
+      return sendFrame(sock, frameWriter)
+
+   return sendBuffer(sock, ListPollsPageReqCodec.pack(LIST_POLLS_PAGE, 1, pollIDPrefix, ownerID, pollStatus, afterPollID, pageSize))
+
+def recvListPollsPageReqData(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      return (frame.getStr(POLL_ID_SIZE), frame.getStr(USER_ID_SIZE), frame.getStr(1),
+              frame.getStr(POLL_ID_SIZE), frame.getUint())
+
+   msgBuf = sock.recv(ListPollsPageReqDataCodec.size)
+   if  not msgBuf:
+      return (None, None, None, None, None)
+   return ListPollsPageReqDataCodec.unpack(msgBuf)
+
+def sendListPollsPageResponse(sock, status, reason, polls, endOfPage=1, nextPollID=""):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(LIST_POLLS_PAGE, 2).putUint(status).putUint(reason).putUint(endOfPage)
+      frameWriter.putStr(nextPollID).putUint(len(polls))
+      for poll in polls:
+         for field in poll:
+            frameWriter.putStr(field)
+      return sendFrame(sock, frameWriter)
+
+   msgBuf = GetSendBuffer(ListPollsPageResponseCodec.size + ListPollsResponseDataCodec.size * len(polls))
+   offset = ListPollsPageResponseCodec.packInto(msgBuf, 0, LIST_POLLS_PAGE, 2, status, reason, endOfPage, nextPollID, len(polls))
+   ListPollsResponseDataCodec.packArrayInto(msgBuf, offset, polls)
+
+   return sendBuffer(sock, msgBuf)
+
+# Returns the polls of one LIST_POLLS_PAGE response: (msgType, flags, status, reason,
+# (polls, endOfPage, nextPollID))
+def recvListPollsPageResponse(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None or frame.msgType != LIST_POLLS_PAGE or frame.flags != 2:
+         return None, None, None, None, (None, None, None)
+      status, reason, endOfPage, nextPollID = frame.getUint(), frame.getUint(), frame.getUint(), frame.getStr()
+      polls = [(frame.getStr(), frame.getStr(), frame.getStr(), frame.getStr(), frame.getStr())
+               for i in range(frame.getUint())]
+      return frame.msgType, frame.flags, status, reason, (polls, endOfPage, nextPollID)
+
+   msgBuf = sock.recv(ListPollsPageResponseCodec.size)
+   if  not msgBuf:
+      return None, None, None, None, (None, None, None)
+   msgType, flags, status, reason, endOfPage, nextPollID, numDataElems = ListPollsPageResponseCodec.unpack(msgBuf)
+
+   if msgType != LIST_POLLS_PAGE or flags != 2:
+      return None, None, None, None, (None, None, None)
+
+   polls = []
+   if numDataElems > 0:
+      msgBuf = sock.recv(ListPollsResponseDataCodec.size * numDataElems)
+      if  not msgBuf:
+         return None, None, None, None, (None, None, None)
+      polls = ListPollsResponseDataCodec.unpackArray(msgBuf, numDataElems)
+
+   return msgType, flags, status, reason, (polls, endOfPage, nextPollID)
+
+# Negotiate the wire format version of the connection
+#
+# The client asks for the highest version it supports, the server replies with the version
+# both support and both switch to it after the response. A server not knowing the request
+# closes the connection (see poll_invalidmsgimpl), the client reconnects and uses version 1.
+#
+class NegotiateVersionReqData(ctypes.Structure):
+    _fields_ = [('version', ctypes.c_uint16)]
+    _pack_ = 1
+NegotiateVersionReqDataCodec = StructCodec(NegotiateVersionReqData)
+
+class NegotiateVersionReq(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('data', NegotiateVersionReqData)]
+    _pack_ = 1
+NegotiateVersionReqCodec = StructCodec(NegotiateVersionReq)
+
+class NegotiateVersionResponse(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('status', ctypes.c_uint16),
+                ('reason', ctypes.c_uint16),
+                ('version', ctypes.c_uint16)]
+    _pack_ = 1
+NegotiateVersionResponseCodec = StructCodec(NegotiateVersionResponse)
+
+def sendNegotiateVersionReq(sock, version):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(NEGOTIATE_VERSION, 1).putUint(version))
+
+   return sendBuffer(sock, NegotiateVersionReqCodec.pack(NEGOTIATE_VERSION, 1, version))
+
+def recvNegotiateVersionReqData(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sock.frame.getUint()
+
+   msgBuf = sock.recv(NegotiateVersionReqDataCodec.size)
+   if  not msgBuf:
+      return None
+   version, = NegotiateVersionReqDataCodec.unpack(msgBuf)
+   return version
+
+def sendNegotiateVersionResponse(sock, status, reason, version):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(NEGOTIATE_VERSION, 2).putUint(status).putUint(reason).putUint(version))
+
+   return sendBuffer(sock, NegotiateVersionResponseCodec.pack(NEGOTIATE_VERSION, 2, status, reason, version))
+
+def recvNegotiateVersionResponse(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = recvFrame(sock)
+      if frame is None or frame.msgType != NEGOTIATE_VERSION or frame.flags != 2:
+         return None, None, None, None, None
+      return frame.msgType, frame.flags, frame.getUint(), frame.getUint(), frame.getUint()
+
+   msgBuf = sock.recv(NegotiateVersionResponseCodec.size)
+   if  not msgBuf:
+      return None, None, None, None, None
+
+   msgType, flags, status, reason, version = NegotiateVersionResponseCodec.unpack(msgBuf)
+   if msgType != NEGOTIATE_VERSION or flags != 2:
+      return None, None, None, None, None
+
+   return msgType, flags, status, reason, version
+
+#
+# Negotiates the wire format of a FramedSocket from the client side
+#
+# Returns the version agreed on, the socket is switched to it. Returns None if the server
+# closed the connection (it does not support NEGOTIATE_VERSION).
+#
+def NegotiateWireVersion(sock, version=POLL_WIRE_VERSION_MAX):
+   sendNegotiateVersionReq(sock, version)
+   msgType, flags, status, reason, version = recvNegotiateVersionResponse(sock)
+   if status is None:
+      return None
+   if status == OP_SUCCESS:
+      sock.wireVersion = version
+   return sock.wireVersion
+
+#
+# Subscription to the results of a poll
+#
+# SUBSCRIBE_POLL_RESULTS (subscribe = 1) asks the server to push the results of the poll to the
+# connection, subscribe = 0 stops it. The response is a PollResponseMessage. After a successful
+# subscription, the server sends POLL_RESULTS_UPDATE messages at any time, the first one with the
+# count of every choice, then only the choices whose count changed (a removed choice has count 0).
+# In the wire format version 3, the updates carry the request ID of the subscription request.
+#
+# Every message on a subscribed connection is read with recvMsgHdr() followed by
+# recvPollResultsUpdateData() or recvResponseMessageData(), depending on the msgType.
+#
+class SubscribePollResultsReqData(ctypes.Structure):
+    _fields_ = [('pollID', ctypes.c_char * POLL_ID_SIZE),
+                ('subscribe', ctypes.c_uint16)]
+    _pack_ = 1
+SubscribePollResultsReqDataCodec = StructCodec(SubscribePollResultsReqData)
+
+class SubscribePollResultsReq(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('data', SubscribePollResultsReqData)]
+    _pack_ = 1
+SubscribePollResultsReqCodec = StructCodec(SubscribePollResultsReq)
+
+class PollResultsUpdateData(ctypes.Structure):
+    _fields_ = [('choiceID', ctypes.c_char * CHOICE_ID_SIZE),
+                ('count', ctypes.c_uint16)]
+    _pack_ = 1
+PollResultsUpdateDataCodec = StructCodec(PollResultsUpdateData)
+
+class PollResultsUpdateHdrData(ctypes.Structure):
+    _fields_ = [('pollID', ctypes.c_char * POLL_ID_SIZE),
+                ('numDataElems', ctypes.c_uint16)]
+    _pack_ = 1
+PollResultsUpdateHdrDataCodec = StructCodec(PollResultsUpdateHdrData)
+
+class PollResultsUpdate(ctypes.Structure):
+    _fields_ = [('hdr', PollMsgHdr),
+                ('data', PollResultsUpdateHdrData)]
+    _pack_ = 1
+PollResultsUpdateCodec = StructCodec(PollResultsUpdate)
+
+def sendSubscribePollResultsReq(sock, pollID, subscribe=1):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      return sendFrame(sock, FrameWriter(SUBSCRIBE_POLL_RESULTS, 1).putStr(pollID, POLL_ID_SIZE).putUint(subscribe))
+
+   return sendBuffer(sock, SubscribePollResultsReqCodec.pack(SUBSCRIBE_POLL_RESULTS, 1, pollID, subscribe))
+
+def recvSubscribePollResultsReqData(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      return (frame.getStr(POLL_ID_SIZE), frame.getUint())
+
+   msgBuf = sock.recv(SubscribePollResultsReqDataCodec.size)
+   if  not msgBuf:
+      return (None, None)
+   return SubscribePollResultsReqDataCodec.unpack(msgBuf)
+
+# Returns the POLL_RESULTS_UPDATE message ready to be sent with sendEncodedResponse(), as
+# encodePollGetResultsResponse(). updates is the list of (choiceID, count)
+def encodePollResultsUpdate(pollID, updates, wireVersion=POLL_WIRE_VERSION_1):
+   if wireVersion >= POLL_WIRE_VERSION_2:
+      frameWriter = FrameWriter(POLL_RESULTS_UPDATE, 2).putStr(pollID).putUint(len(updates))
+      for choiceID, count in updates:
+         frameWriter.putStr(choiceID).putUint(count)
+      return frameWriter
+
+   msgBuf = bytearray(PollResultsUpdateCodec.size + PollResultsUpdateDataCodec.size * len(updates))
+   offset = PollResultsUpdateCodec.packInto(msgBuf, 0, POLL_RESULTS_UPDATE, 2, pollID, len(updates))
+   PollResultsUpdateDataCodec.packArrayInto(msgBuf, offset, updates)
+
+   return bytes(msgBuf)
+
+# Reads the rest of a POLL_RESULTS_UPDATE message after recvMsgHdr(), returns (pollID, updates)
+def recvPollResultsUpdateData(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      pollID = frame.getStr()
+      return (pollID, [(frame.getStr(), frame.getUint()) for i in range(frame.getUint())])
+
+   msgBuf = sock.recv(PollResultsUpdateHdrDataCodec.size)
+   if  not msgBuf:
+      return (None, None)
+   pollID, numDataElems = PollResultsUpdateHdrDataCodec.unpack(msgBuf)
+
+   updates = []
+   if numDataElems > 0:
+      msgBuf = sock.recv(PollResultsUpdateDataCodec.size * numDataElems)
+      if  not msgBuf:
+         return (None, None)
+      updates = PollResultsUpdateDataCodec.unpackArray(msgBuf, numDataElems)
+
+   return (pollID, updates)
+
+# PollResponseMessage without the header
+class PollResponseMessageData(ctypes.Structure):
+    _fields_ = [('status', ctypes.c_uint16),
+                ('reason', ctypes.c_uint16)]
+    _pack_ = 1
+PollResponseMessageDataCodec = StructCodec(PollResponseMessageData)
+
+# Reads the rest of a PollResponseMessage after recvMsgHdr(), returns (status, reason)
+def recvResponseMessageData(sock):
+   if GetWireVersion(sock) >= POLL_WIRE_VERSION_2:
+      frame = sock.frame
+      return (frame.getUint(), frame.getUint())
+
+   msgBuf = sock.recv(PollResponseMessageDataCodec.size)
+   if  not msgBuf:
+      return (None, None)
+   return PollResponseMessageDataCodec.unpack(msgBuf)
+
+#
+# Keeps many requests in flight on a FramedSocket in the wire format version 3, client side
+#
+# send() sends a request with the next request ID without waiting for the response and recv()
+# returns the next response to arrive, whichever request it answers. The server answers the
+# read-only requests (LIST_USERS, LIST_POLLS, USER_POLL_GET_RESULTS) in any order, the other
+# requests after all the requests sent before them.
+#
+#   pipeline = RequestPipeline(sock)
+#   pipeline.send(sendListUsersReq, recvListUsersResponse)
+#   pipeline.send(sendPollGetResultsReq, recvPollGetResultsResponse, pollID)
+#   while pipeline.pending:
+#      requestID, response = pipeline.recv()
+#
+class RequestPipeline:
+   def __init__(self, sock):
+      if GetWireVersion(sock) < POLL_WIRE_VERSION_3:
+         raise ValueError(f"pipelining needs the wire format version {POLL_WIRE_VERSION_3}")
+      self.sock = sock
+      self.nextRequestID = 1
+      # recv function of the response of every request in flight
+      self.pending = {}
+
+   # Sends the request via sendFunc(sock, *args), returns its request ID. The response is
+   # read with recvFunc(sock)
+   def send(self, sendFunc, recvFunc, *args):
+      requestID = self.nextRequestID
+      self.nextRequestID += 1
+
+      self.sock.requestID = requestID
+      try:
+         r = sendFunc(self.sock, *args)
+      finally:
+         self.sock.requestID = 0
+      if r != OP_SUCCESS:
+         raise ConnectionError("failed to send the request")
+      self.pending[requestID] = recvFunc
+      return requestID
+
+   # Returns (requestID, response) of the next response, response as returned by the recv
+   # function of the request
+   def recv(self):
+      frame = recvFrame(self.sock)
+      if frame is None:
+         raise ConnectionResetError("connection closed with requests in flight")
+      recvFunc = self.pending.pop(frame.requestID, None)
+      if recvFunc is None:
+         raise ValueError(f"response to unknown request {frame.requestID}")
+
+      # the recv function reads the frame again
+      self.sock.pushedFrame = frame
+      return frame.requestID, recvFunc(self.sock)
+
+#
+# Sends the failure response to the request msgType, in the format of its response and without
+# data. Used by the server to reject a request without processing it (REASON_SERVER_OVERLOADED,
+# see poll_poolserver)
+#
+failureResponses = {
+   USER_POLL_MAKE_SELECTION_BATCH : lambda sock, reason: sendPollMakeSelectionBatchResponse(sock, OP_FAILURE, reason, []),
+   LIST_USERS                     : lambda sock, reason: sendListUsersResponse(sock, OP_FAILURE, reason, []),
+   LIST_USERS_PAGE                : lambda sock, reason: sendListUsersPageResponse(sock, OP_FAILURE, reason, []),
+   USER_POLL_GET_RESULTS          : lambda sock, reason: sendPollGetResultsResponse(sock, OP_FAILURE, reason, "", []),
+   LIST_POLLS                     : lambda sock, reason: sendListPollsResponse(sock, OP_FAILURE, reason, []),
+   LIST_POLLS_PAGE                : lambda sock, reason: sendListPollsPageResponse(sock, OP_FAILURE, reason, []),
+   NEGOTIATE_VERSION              : lambda sock, reason: sendNegotiateVersionResponse(sock, OP_FAILURE, reason, GetWireVersion(sock)),
+}
+
+def sendFailureResponse(sock, msgType, reason):
+   if msgType in failureResponses:
+      return failureResponses[msgType](sock, reason)
+   return sendResponseMessage(sock, msgType, OP_FAILURE, reason)
@@ -0,0 +1,126 @@
+import os
+import hmac
+import hashlib
+import threading
+import multiprocessing
+import concurrent.futures
+
+#
+# Implements the hashing and the verification of the passwords of the users
+#
+# The passwords are stored in user_table hashed with a slow key derivation function (KDF) and a
+# random salt of their own, in the format
+#
+#    kdf$param=value,...$salt$key        e.g. scrypt$n=16384,r=8,p=1$<salt hex>$<key hex>
+#
+# so the parameters of every hash are known when it is verified, and POLLSERVER_KDF and its
+# parameters can be changed at any time. The passwords of the older versions of the server were
+# stored as the plain SHA-256 of the password, without salt. Such a hash, or a hash made with
+# other parameters than the current ones, is replaced by a hash with the current parameters at
+# the next successful login of the user (see VerifyPassword).
+#
+# A KDF costs tens of milliseconds of CPU on purpose. It is computed in a pool of
+# POLLSERVER_KDF_NUM_WORKERS processes, so it does not hold the GIL of the server: the thread of
+# the request waits for the result without using the CPU, and the votes of the other connections
+# are processed meanwhile. The pool is created on first use, so every worker process of the
+# pre-fork mode has its own. The processes are started by a fork server, not forked from the
+# server process and its threads.
+#
+# The KDF and its parameters are passed along with every password, so the processes of the pool
+# use the ones of the server (see poll_server.py --kdf).
+#
+
+# kdf -> parameters of the hashes made with it
+POLLSERVER_KDF_PARAMS = {
+   'scrypt'        : {'n': 2 ** 14, 'r': 8, 'p': 1},
+   'pbkdf2_sha256' : {'iterations': 600000},
+}
+
+# KDF of the new hashes
+POLLSERVER_KDF = 'scrypt'
+
+# number of bytes of the salt and of the derived key
+POLLSERVER_KDF_SALT_SIZE = 16
+POLLSERVER_KDF_KEY_SIZE = 32
+
+# number of processes computing the KDF, more than the cores only queue in the OS
+POLLSERVER_KDF_NUM_WORKERS = os.cpu_count() or 1
+
+def DeriveKey(password, kdf, params, salt):
+   if kdf == 'scrypt':
+      n, r, p = params['n'], params['r'], params['p']
+      return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p,
+                            dklen=POLLSERVER_KDF_KEY_SIZE)
+   if kdf == 'pbkdf2_sha256':
+      return hashlib.pbkdf2_hmac('sha256', password, salt, params['iterations'], POLLSERVER_KDF_KEY_SIZE)
+   raise ValueError(f"unknown KDF {kdf}")
+
+def EncodeHash(kdf, params, salt, key):
+   return '$'.join((kdf, ','.join(f"{name}={value}" for (name, value) in params.items()), salt.hex(), key.hex()))
+
+# returns (kdf, params, salt, key) of an encoded hash, None for a legacy SHA-256 hash
+def DecodeHash(pwdHash):
+   if '$' not in pwdHash:
+      return None
+   kdf, params, salt, key = pwdHash.split('$')
+   params = {name: int(value) for (name, value) in (param.split('=') for param in params.split(','))}
+   return (kdf, params, bytes.fromhex(salt), bytes.fromhex(key))
+
+#
+# The next two run in the processes of the pool
+#
+def HashPasswordWorker(password, kdf, params):
+   salt = os.urandom(POLLSERVER_KDF_SALT_SIZE)
+   return EncodeHash(kdf, params, salt, DeriveKey(password, kdf, params, salt))
+
+def VerifyPasswordWorker(password, pwdHash, kdf, params):
+   decoded = DecodeHash(pwdHash)
+   if decoded is None:
+      valid = hmac.compare_digest(hashlib.sha256(password).hexdigest(), pwdHash)
+   else:
+      hashKdf, hashParams, salt, key = decoded
+      valid = hmac.compare_digest(DeriveKey(password, hashKdf, hashParams, salt), key)
+      if valid and hashKdf == kdf and hashParams == params:
+         return (True, None)
+
+   if not valid:
+      return (False, None)
+   # the hash is upgraded while the password is known
+   return (True, HashPasswordWorker(password, kdf, params))
+
+kdfPool = None
+kdfPoolLock = threading.Lock()
+
+# Returns the process pool computing the KDF, starting it on first use
+def GetKdfPool():
+   global kdfPool
+
+   if kdfPool is None:
+      with kdfPoolLock:
+         if kdfPool is None:
+            kdfPool = concurrent.futures.ProcessPoolExecutor(max_workers=POLLSERVER_KDF_NUM_WORKERS,
+                                                             mp_context=multiprocessing.get_context('forkserver'))
+   return kdfPool
+
+def RunInKdfPool(func, *args):
+   global kdfPool
+
+   pool = GetKdfPool()
+   try:
+      return pool.submit(func, *args).result()
+   except concurrent.futures.process.BrokenProcessPool:
+      # a process of the pool died (e.g. killed), the next password gets a new pool
+      with kdfPoolLock:
+         if kdfPool is pool:
+            kdfPool = None
+      raise
+
+# Returns the hash of the password (bytes) to store, with a new salt
+def HashPassword(password):
+   return RunInKdfPool(HashPasswordWorker, password, POLLSERVER_KDF, POLLSERVER_KDF_PARAMS[POLLSERVER_KDF])
+
+# Checks the password (bytes) against the stored hash, returns (valid, newHash). newHash is not
+# None when the stored hash should be replaced by it: a legacy SHA-256 hash, or a hash made with
+# other parameters than the current ones
+def VerifyPassword(password, pwdHash):
+   return RunInKdfPool(VerifyPasswordWorker, password, pwdHash, POLLSERVER_KDF, POLLSERVER_KDF_PARAMS[POLLSERVER_KDF])
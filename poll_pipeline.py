@@ -0,0 +1,181 @@
+import queue
+import threading
+import concurrent.futures
+import poll_dbopsimpl
+import poll_logging
+import poll_scheduler
+from poll_message_api import *
+
+#
+# Implements the out of order processing of the pipelined requests
+#
+# A client using the wire format version 3 tags every request with a request ID and may send
+# many requests without waiting for the responses (see RequestPipeline). The requests only
+# reading the database (POLLSERVER_PIPELINE_READ_REQS) are independent of each other, so the
+# server processes them concurrently on a pool of threads and sends the responses, tagged with
+# the request IDs, in the order they are ready.
+#
+# Every other request is a barrier: it is processed by the thread of the connection after all
+# the requests received before it are answered, so a vote or a logout is never overtaken by the
+# reads sent before it, and the reads sent after it see it.
+#
+# The pipelined requests are counted by poll_scheduler like the other ones, and wait for their turn
+# (POLLSERVER_SCHED_MAX_RUNNING) in all the server modes, so a client can not run more bulk
+# listings at a time by pipelining them. They wait before they are handed over to the pool, in
+# the queue of their class, so a waiting listing never holds a thread of the pool: one admission
+# thread per limited class takes the requests of its queue in order, waits for their turn and
+# hands them over (see Admission).
+#
+# The socket is only used by the thread of the connection. The handler classes run on the pool
+# with a RequestSocket, which keeps the response till the thread of the connection sends it. The
+# thread of the connection sends the responses when it has no more buffered requests to read
+# (see FramedSocket.hasPending), before waiting for the next ones, and before a barrier.
+#
+
+# number of threads processing the pipelined read requests
+POLLSERVER_PIPELINE_NUM_WORKERS = 8
+
+# requests processed concurrently and answered out of order
+POLLSERVER_PIPELINE_READ_REQS = {LIST_USERS, LIST_POLLS, USER_POLL_GET_RESULTS}
+
+#
+# Socket like object of one pipelined request
+#
+# The handler class reads the request from the frame and the request ID read with it, and the
+# response sent is kept in sent. All the other attributes go to the socket of the connection.
+#
+class RequestSocket:
+   def __init__(self, sock):
+      self.sock = sock
+      # the frame refers to the receive buffer of the connection, which is reused for the next
+      # requests while this one is processed
+      self.frame = sock.frame
+      self.frame.data = bytes(self.frame.data)
+      self.requestID = sock.requestID
+      self.sent = []
+
+   def __getattr__(self, name):
+      return getattr(self.sock, name)
+
+   def __repr__(self):
+      return f"<RequestSocket {self.requestID} {self.sock!r}>"
+
+   def send(self, data):
+      self.sent.append(bytes(data))
+      return len(data)
+
+#
+# Hands the pipelined requests over to the pool, after their turn for the ones of a limited class
+#
+class Admission:
+   def __init__(self, executor):
+      self.executor = executor
+      # class -> queue of (future, handlerClass, msgType, reqSock, cntxt) waiting for their turn
+      self.queues = {}
+      self.lock = threading.Lock()
+
+   # runs on the pool, returns the socket of the request and the return value of invoke()
+   @staticmethod
+   def process(handlerClass, msgType, reqSock, cntxt):
+      poll_logging.BeginRequest(msgType)
+      poll_logging.TraceRequest("pipelined request %s id %s from %s", msgType, reqSock.requestID, cntxt['address'])
+      try:
+         return reqSock, handlerClass(reqSock, cntxt, poll_dbopsimpl.GetConnection()).invoke()
+      finally:
+         poll_scheduler.EndRequest(msgType)
+
+   # runs on the pool, processes a request admitted by the admission thread of its class
+   @staticmethod
+   def processAdmitted(future, handlerClass, msgType, reqSock, cntxt):
+      try:
+         future.set_result(Admission.process(handlerClass, msgType, reqSock, cntxt))
+      except BaseException as ex:
+         future.set_exception(ex)
+
+   # admission thread of a limited class
+   def admit(self, requests):
+      while True:
+         future, handlerClass, msgType, reqSock, cntxt = requests.get()
+         poll_scheduler.BeginRequest(msgType, limited=True)
+         self.executor.submit(self.processAdmitted, future, handlerClass, msgType, reqSock, cntxt)
+
+   def getQueue(self, schedClass):
+      with self.lock:
+         requests = self.queues.get(schedClass)
+         if requests is None:
+            requests = self.queues[schedClass] = queue.SimpleQueue()
+            threading.Thread(target=self.admit, args=(requests,), name=f'poll-pipeline-admit-{schedClass}',
+                             daemon=True).start()
+      return requests
+
+   # processes the request on the pool, returns the future of process()
+   def submit(self, handlerClass, msgType, reqSock, cntxt):
+      schedClass = poll_scheduler.GetSchedClass(msgType)
+      if schedClass not in poll_scheduler.POLLSERVER_SCHED_MAX_RUNNING:
+         # never waits
+         poll_scheduler.BeginRequest(msgType)
+         return self.executor.submit(self.process, handlerClass, msgType, reqSock, cntxt)
+
+      future = concurrent.futures.Future()
+      self.getQueue(schedClass).put((future, handlerClass, msgType, reqSock, cntxt))
+      return future
+
+#
+# Requests of one connection being processed on the pool
+#
+class ConnectionPipeline:
+   def __init__(self, admission):
+      self.admission = admission
+      self.inFlight = []
+
+   # processes the request just read from the socket on the pool
+   def submit(self, handlerClass, msgType, sock, cntxt):
+      self.inFlight.append(self.admission.submit(handlerClass, msgType, RequestSocket(sock), cntxt))
+
+   # Sends the responses of the requests in flight as they are ready, returns True if the
+   # connection must be terminated
+   def flush(self, sock):
+      terminate = False
+      for future in concurrent.futures.as_completed(self.inFlight):
+         reqSock, r = future.result()
+         for data in reqSock.sent:
+            sock.send(data)
+         terminate = terminate or bool(r)
+      self.inFlight = []
+      return terminate
+
+admission = None
+admissionLock = threading.Lock()
+
+# Returns the admission of the pipelined requests, starting the pool processing them on first use
+def GetAdmission():
+   global admission
+
+   if admission is None:
+      with admissionLock:
+         if admission is None:
+            admission = Admission(concurrent.futures.ThreadPoolExecutor(max_workers=POLLSERVER_PIPELINE_NUM_WORKERS,
+                                                                        thread_name_prefix='poll-pipeline'))
+   return admission
+
+def GetPipeline(cntxt):
+   pipeline = cntxt.get('pipeline')
+   if pipeline is None:
+      pipeline = cntxt['pipeline'] = ConnectionPipeline(GetAdmission())
+   return pipeline
+
+# True if the request just read from the socket may be processed out of order
+def IsPipelined(sock, msgType):
+   return GetWireVersion(sock) >= POLL_WIRE_VERSION_3 and msgType in POLLSERVER_PIPELINE_READ_REQS
+
+# Processes the request just read from the socket on the pool, the response is sent by Flush()
+def Submit(handlerClass, msgType, sock, cntxt):
+   GetPipeline(cntxt).submit(handlerClass, msgType, sock, cntxt)
+
+# Sends the responses of the pipelined requests of the connection, waiting for them. Returns
+# True if the connection must be terminated
+def Flush(sock, cntxt):
+   pipeline = cntxt.get('pipeline')
+   if pipeline is None or not pipeline.inFlight:
+      return False
+   return pipeline.flush(sock)
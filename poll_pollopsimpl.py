@@ -1,7 +1,10 @@
 import sys
-import threading
 from poll_message_api import *
+from poll_logging import TraceRequest
 import poll_dbopsimpl
+import poll_votewriter
+import poll_resultscache
+import poll_publisher
 
 # Server side message handling implementations
 #
@@ -28,173 +31,216 @@ class CreatePollImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.userID = self.cntxt['userID']
       self.op = CREATE_POLL
 
    def invoke(self):
-      print("ENTER CreatePollImpl", self.cntxt)
+      TraceRequest("ENTER CreatePollImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       pollID, pollName, openDateTime, closeDateTime, pollChoices = recvCreatePollData(self.sock)
-      print(pollID, pollName, openDateTime, closeDateTime, pollChoices)
+      TraceRequest("pollID %s pollName %s open %s close %s choices %s", pollID, pollName, openDateTime, closeDateTime, pollChoices)
 
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
          status, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
       else:
-         ### LOCK POLL TABLE
-         self.lock.acquire()
          status, reason = poll_dbopsimpl.AddPoll(self.conn, self.userID, pollID, pollName, openDateTime, closeDateTime, pollChoices)
-         ### UNLOCK POLL TABLE
-         self.lock.release()
 
       r = sendResponseMessage(self.sock, self.op, status, reason)
-      print(r)
-      print("EXIT CreatePollImpl", self.cntxt)
+      TraceRequest("EXIT CreatePollImpl status %s reason %s", status, reason)
       return 0
 
 class AddPollChoicesImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = POLL_ADD_CHOICES
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER AddPollChoicesImpl", self.cntxt)
+      TraceRequest("ENTER AddPollChoicesImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       pollID, pollChoices = recvAddPollChoicesData(self.sock)
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
          status, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
       else:
-         ### LOCK POLL TABLE
-         self.lock.acquire()
          status, reason = poll_dbopsimpl.AddPollChoices(self.conn, pollID, self.userID, pollChoices)
-         ### UNLOCK POLL TABLE
-         self.lock.release()
+         if status == OP_SUCCESS:
+            poll_resultscache.InvalidatePollResults(pollID)
 
       r = sendResponseMessage(self.sock, self.op, status, reason)
-      print(r)
-      print("EXIT AddPollChoicesImpl", self.cntxt)
+      TraceRequest("EXIT AddPollChoicesImpl status %s reason %s", status, reason)
       return 0
 
 class RemovePollChoicesImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = POLL_REMOVE_CHOICES
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER RemovePollChoicesImpl", self.cntxt)
+      TraceRequest("ENTER RemovePollChoicesImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       pollID, pollChoices = recvRemovePollChoicesData(self.sock)
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
          status, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
       else:
-         ### LOCK POLL TABLE
-         self.lock.acquire()
          status, reason = poll_dbopsimpl.RemovePollChoices(self.conn, pollID, self.userID, pollChoices)
-         ### UNLOCK POLL TABLE
-         self.lock.release()
+         if status == OP_SUCCESS:
+            poll_resultscache.InvalidatePollResults(pollID)
 
       r = sendResponseMessage(self.sock, self.op, status, reason)
-      print(r)
-      print("EXIT RemovePollChoicesImpl", self.cntxt)
+      TraceRequest("EXIT RemovePollChoicesImpl status %s reason %s", status, reason)
       return 0
 
 class SetPollStatusImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = POLL_SET_STATUS
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER SetPollStatusImpl", self.cntxt)
+      TraceRequest("ENTER SetPollStatusImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       pollID, pollStatus = recvSetPollStatusData(self.sock)
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
          status, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
       else:
-         ### LOCK POLL TABLE
-         self.lock.acquire()
          status, reason = poll_dbopsimpl.SetPollStatus(self.conn, pollID, self.userID, pollStatus)
-         ### UNLOCK POLL TABLE
-         self.lock.release()
+         if status == OP_SUCCESS:
+            poll_resultscache.InvalidatePollResults(pollID)
 
       r = sendResponseMessage(self.sock, self.op, status, reason)
-      print(r)
-      print("EXIT SetPollStatusImpl", self.cntxt)
+      TraceRequest("EXIT SetPollStatusImpl status %s reason %s", status, reason)
       return 0
 
 class PollMakeSelectionImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = USER_POLL_MAKE_SELECTION
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER PollMakeSelectionImpl", self.cntxt)
+      TraceRequest("ENTER PollMakeSelectionImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       pollID, choiceID = recvPollMakeSelectionReqData(self.sock)
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
          status, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
       else:
-         ### LOCK POLL TABLE
-         self.lock.acquire()
-         status, reason = poll_dbopsimpl.PollMakeSelection(self.conn, pollID, self.userID, choiceID)
-         ### UNLOCK POLL TABLE
-         self.lock.release()
+         # the vote is written by the vote writer together with the votes of other sessions
+         status, reason = poll_votewriter.SubmitVote(pollID, self.userID, choiceID)
 
       r = sendResponseMessage(self.sock, self.op, status, reason)
-      print(r)
-      print("EXIT PollMakeSelectionImpl", self.cntxt)
+      TraceRequest("EXIT PollMakeSelectionImpl status %s reason %s", status, reason)
+      return 0
+
+class PollMakeSelectionBatchImpl:
+   def __init__(self, cl_sock, cl_cntxt, conn):
+      self.sock = cl_sock
+      self.cntxt = cl_cntxt
+      self.conn = conn
+      self.op = USER_POLL_MAKE_SELECTION_BATCH
+      self.userID = self.cntxt['userID']
+
+   def invoke(self):
+      TraceRequest("ENTER PollMakeSelectionBatchImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
+      selections = recvPollMakeSelectionBatchReqData(self.sock)
+      if selections is None:
+         return OP_FAILURE
+
+      if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
+         status, reason, results = OP_FAILURE, REASON_NOT_LOGGED_IN, []
+      else:
+         # a poll is voted once per batch: the first selection of a poll is written, the later
+         # ones fail with REASON_DUP_POLL_DATA
+         votes = []
+         results = []
+         pollIDs = set()
+         for (pollID, choiceID) in selections:
+            if pollID in pollIDs:
+               results.append((OP_FAILURE, REASON_DUP_POLL_DATA))
+            else:
+               pollIDs.add(pollID)
+               votes.append((pollID, self.userID, choiceID))
+               results.append(None)
+
+         # all the selections are written in the same transaction, the result is per selection
+         voted = iter(poll_votewriter.SubmitVotes(votes))
+         results = [next(voted) if r is None else r for r in results]
+         status, reason = OP_SUCCESS, REASON_SUCCESS
+
+      r = sendPollMakeSelectionBatchResponse(self.sock, status, reason, results)
+      TraceRequest("EXIT PollMakeSelectionBatchImpl status %s reason %s results %s", status, reason, results)
       return 0
 
 class PollGetResultsImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = USER_POLL_GET_RESULTS
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER PollGetResultsImpl", self.cntxt)
+      TraceRequest("ENTER PollGetResultsImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       pollID = recvPollGetResultsReqData(self.sock)
       if pollID is None:
          return OP_FAILURE
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
-         status, reason, pollResults = OP_FAILURE, REASON_NOT_LOGGED_IN, []
+         msgBuf = encodePollGetResultsResponse(OP_FAILURE, REASON_NOT_LOGGED_IN, None, [], GetWireVersion(self.sock))
       else:
-         ### LOCK POLL TABLE
-         self.lock.acquire()
-         status, reason, pollName, pollResults = poll_dbopsimpl.PollGetResults(self.conn, pollID)
-         ### UNLOCK POLL TABLE
-         self.lock.release()
-
-      print(status, reason, pollName, pollResults)
-      r = sendPollGetResultsResponse(self.sock, status, reason, pollName, pollResults)
-      print("EXIT PollGetResultsImpl", self.cntxt)
+         # the response is read from the results cache, already encoded
+         msgBuf = poll_resultscache.GetPollResults(self.conn, pollID, GetWireVersion(self.sock))
+
+      r = sendEncodedResponse(self.sock, msgBuf)
+      TraceRequest("EXIT PollGetResultsImpl pollID %s sent %s", pollID, r)
+      return OP_SUCCESS
+
+class SubscribePollResultsImpl:
+   def __init__(self, cl_sock, cl_cntxt, conn):
+      self.sock = cl_sock
+      self.cntxt = cl_cntxt
+      self.conn = conn
+      self.op = SUBSCRIBE_POLL_RESULTS
+      self.userID = self.cntxt['userID']
+
+   def invoke(self):
+      TraceRequest("ENTER SubscribePollResultsImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
+      pollID, subscribe = recvSubscribePollResultsReqData(self.sock)
+      if pollID is None:
+         return OP_FAILURE
+
+      if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
+         status, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
+      elif not subscribe:
+         # no update is sent after the response
+         poll_publisher.Unsubscribe(self.sock, pollID)
+         status, reason = OP_SUCCESS, REASON_SUCCESS
+      elif poll_dbopsimpl.pollCache.get(self.conn, pollID) is None:
+         status, reason = OP_FAILURE, REASON_NOSUCH_POLL_ID
+      else:
+         status, reason = OP_SUCCESS, REASON_SUCCESS
+
+      r = sendResponseMessage(self.sock, self.op, status, reason)
+
+      # the first update, with the counts of all the choices, is sent after the response
+      if subscribe and status == OP_SUCCESS:
+         poll_publisher.Subscribe(self.sock, pollID)
+      TraceRequest("EXIT SubscribePollResultsImpl pollID %s subscribe %s status %s reason %s", pollID, subscribe, status, reason)
       return OP_SUCCESS
 
 class ListPollsImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = LIST_POLLS
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER ListPollsImpl", self.cntxt)
+      TraceRequest("ENTER ListPollsImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       pollID = recvListPollsReqData(self.sock)
       if pollID is None:
          return OP_FAILURE
@@ -202,13 +248,43 @@ class ListPollsImpl:
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
          res, reason, pollList = OP_FAILURE, REASON_NOT_LOGGED_IN, []
       else:
-         ### LOCK USER TABLE
-         self.lock.acquire()
-         res, reason, pollList = poll_dbopsimpl.ListPolls(self.cntxt, pollID)
-         ### UNLOCK USER TABLE
-         self.lock.release()
+         # the count of the version 1 response limits the number of polls
+         maxRows = poll_dbopsimpl.POLLSERVER_LIST_MAX_ROWS if GetWireVersion(self.sock) < POLL_WIRE_VERSION_2 else None
+         res, reason, pollList = poll_dbopsimpl.ListPolls(self.conn, pollID, maxRows)
 
       r = sendListPollsResponse(self.sock, res, reason, pollList)
-      print(r)
-      print("EXIT ListPollsImpl", self.cntxt)
+      TraceRequest("EXIT ListPollsImpl status %s reason %s", res, reason)
+      return OP_SUCCESS
+
+class ListPollsPageImpl:
+   def __init__(self, cl_sock, cl_cntxt, conn):
+      self.sock = cl_sock
+      self.cntxt = cl_cntxt
+      self.conn = conn
+      self.op = LIST_POLLS_PAGE
+      self.userID = self.cntxt['userID']
+
+   def invoke(self):
+      TraceRequest("ENTER ListPollsPageImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
+      pollIDPrefix, ownerID, pollStatus, afterPollID, pageSize = recvListPollsPageReqData(self.sock)
+      if pollIDPrefix is None:
+         return OP_FAILURE
+
+      numPolls = 0
+      if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
+         status, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
+         r = sendListPollsPageResponse(self.sock, status, reason, [])
+      elif pollStatus not in ['', 'C', 'O']:
+         status, reason = OP_FAILURE, REASON_INVALID_POLL_STATUS
+         r = sendListPollsPageResponse(self.sock, status, reason, [])
+      else:
+         status, reason = OP_SUCCESS, REASON_SUCCESS
+         # every chunk of the page is sent as soon as it is read
+         for polls, nextPollID in poll_dbopsimpl.ListPollsPage(self.conn, pollIDPrefix, ownerID, pollStatus, afterPollID,
+                                                               pageSize or poll_dbopsimpl.POLLSERVER_LIST_PAGE_SIZE,
+                                                               poll_dbopsimpl.POLLSERVER_LIST_CHUNK_SIZE):
+            r = sendListPollsPageResponse(self.sock, status, reason, polls, nextPollID is not None, nextPollID or "")
+            numPolls += len(polls)
+
+      TraceRequest("EXIT ListPollsPageImpl status %s reason %s polls %s", status, reason, numPolls)
       return OP_SUCCESS
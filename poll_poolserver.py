@@ -0,0 +1,346 @@
+import ssl
+import select
+import socket
+import selectors
+import threading
+import collections
+import concurrent.futures
+import poll_dbopsimpl
+import poll_publisher
+import poll_scheduler
+from poll_message_api import *
+from poll_logging import log
+
+#
+# Implements the pool server mode
+#
+# In the threaded mode every connection gets its own thread, so a flood of connections creates
+# threads without limit. In the pool mode, a fixed number of worker threads process the requests
+# of all the connections and the server sheds the load it can not take:
+#
+#    - the I/O thread owns the idle connections. It waits for them with a selector, reads the
+#      data that arrives and, once the header of a request is read, queues the connection for
+#      the workers. A worker processes that one request and hands the connection back. The
+#      workers take the queued requests by priority class (writes, reads, bulk listings) in
+#      weighted fair order (see poll_scheduler).
+#    - at most POLLSERVER_POOL_QUEUE_SIZE requests of a priority class wait for a worker, and at
+#      most the limit of POLLSERVER_POOL_TYPE_LIMITS of a message type are queued or processed at
+#      a time. A request beyond the limits is rejected with REASON_SERVER_OVERLOADED, in the
+#      format of its response, without being processed. A version 1 request can not be skipped
+#      without reading it, so the connection is closed after the rejection. A version 2 frame is
+#      skipped.
+#    - at most POLLSERVER_POOL_MAX_CONNECTIONS connections are open (or in the TLS handshake),
+#      the server stops accepting beyond it, the new connections wait in the listen backlog.
+#
+# The connection is non-blocking while it is owned by the I/O thread and has a timeout of
+# POLLSERVER_POOL_IO_TIMEOUT seconds while owned by a worker, so a client sending half a request
+# holds up a worker for that long at most. The publisher may push to a connection at any time,
+# PoolSocket.send() waits for the non-blocking socket.
+#
+
+# number of threads processing the requests
+POLLSERVER_POOL_NUM_WORKERS = 32
+
+# max number of requests of a priority class waiting for a worker
+POLLSERVER_POOL_QUEUE_SIZE = 256
+
+# message type -> max number of requests of that type waiting for or being processed by a worker.
+# The bulk listings read whole tables
+POLLSERVER_POOL_TYPE_LIMITS = {
+   LIST_USERS      : 4,
+   LIST_POLLS      : 4,
+   LIST_USERS_PAGE : 8,
+   LIST_POLLS_PAGE : 8,
+}
+
+# max number of open connections
+POLLSERVER_POOL_MAX_CONNECTIONS = 10000
+
+# max number of pending connections not yet accepted
+POLLSERVER_POOL_NUM_WAIT_REQS = 1024
+
+# number of threads doing the TLS handshakes
+POLLSERVER_POOL_HANDSHAKE_NUM_WORKERS = 16
+
+# time allowed to a worker for reading the rest of a request or sending a response
+POLLSERVER_POOL_IO_TIMEOUT = 10
+
+# number of bytes read from a connection in one go by the I/O thread
+POLLSERVER_POOL_READ_SIZE = 16384
+
+#
+# Client socket of the pool mode, send() waits for the socket when it is non-blocking
+#
+class PoolSocket:
+   def __init__(self, sock):
+      self.sock = sock
+      self.sendTimeout = POLLSERVER_POOL_IO_TIMEOUT
+
+   def __getattr__(self, name):
+      return getattr(self.sock, name)
+
+   def __repr__(self):
+      return f"<PoolSocket {self.sock!r}>"
+
+   def send(self, data):
+      while True:
+         try:
+            return self.sock.send(data)
+         except (ssl.SSLWantWriteError, BlockingIOError):
+            poller = select.poll()
+            poller.register(self.sock, select.POLLOUT)
+            if not poller.poll(self.sendTimeout * 1000):
+               raise TimeoutError("timed out sending to the client")
+
+class PoolConnection:
+   def __init__(self, sock, address):
+      self.rawSock = PoolSocket(sock)
+      self.sock = FramedSocket(self.rawSock)
+      self.address = address
+      self.cntxt = None
+      self.registered = False
+
+class PoolServer:
+   def __init__(self, handshake, serveRequest, typeLimits=None):
+      self.handshake = handshake
+      self.serveRequest = serveRequest
+      self.typeLimits = dict(POLLSERVER_POOL_TYPE_LIMITS if typeLimits is None else typeLimits)
+
+      # connections with a request waiting for a worker
+      self.requests = poll_scheduler.RequestScheduler(POLLSERVER_POOL_QUEUE_SIZE)
+      # msgType -> number of requests queued or being processed
+      self.inFlight = collections.Counter()
+      self.numRejected = 0
+      self.lock = threading.Lock()
+
+      # (connection, closed) handed back to the I/O thread by the other threads
+      self.released = collections.deque()
+      self.wakeupRecv, self.wakeupSend = socket.socketpair()
+      self.wakeupRecv.setblocking(False)
+      self.wakeupSend.setblocking(False)
+
+      self.selector = selectors.DefaultSelector()
+      self.listenSock = None
+      self.accepting = False
+      self.numConnections = 0
+
+      self.handshakePool = concurrent.futures.ThreadPoolExecutor(max_workers=POLLSERVER_POOL_HANDSHAKE_NUM_WORKERS,
+                                                                 thread_name_prefix='poll-handshake')
+      for i in range(POLLSERVER_POOL_NUM_WORKERS):
+         threading.Thread(target=self.work, name=f'poll-handler-{i}', daemon=True).start()
+
+   # runs in the worker threads
+   def work(self):
+      # database connection of the worker thread
+      conn = poll_dbopsimpl.GetConnection()
+
+      while True:
+         connection, msgType = self.requests.get()
+         closed = True
+         try:
+            closed = self.serveRequest(connection.sock, connection.cntxt, conn)
+         except (ConnectionError, OSError) as ex:
+            log.info("%s %s", connection.address, ex)
+         except Exception:
+            log.exception("%s error processing request", connection.address)
+
+         self.requests.done(msgType)
+         with self.lock:
+            self.inFlight[msgType] -= 1
+         self.release(connection, closed)
+
+   # runs in the handshake pool
+   def startConnection(self, cl_sock, cl_address):
+      ssl_cl_sock = self.handshake(cl_sock, cl_address)
+      if ssl_cl_sock is None:
+         self.release(None, True)
+         return
+
+      connection = PoolConnection(ssl_cl_sock, cl_address)
+      poll_dbopsimpl.AddThreadContext(connection.sock, cl_address)
+      connection.cntxt = poll_dbopsimpl.GetThreadContext(connection.sock)
+      log.debug("%s connected", cl_address)
+      self.release(connection, False)
+
+   # runs in the handshake pool, drops the session and the subscriptions of a closed connection
+   def closeSession(self, connection):
+      try:
+         try:
+            poll_dbopsimpl.RemoveThreadContext(connection.sock)
+         finally:
+            poll_publisher.UnsubscribeAll(connection.sock)
+      except Exception:
+         log.exception("%s error closing the session", connection.address)
+      finally:
+         connection.sock.close()
+
+   # hands the connection (back) to the I/O thread, called by the other threads
+   def release(self, connection, closed):
+      self.released.append((connection, closed))
+      try:
+         self.wakeupSend.send(b'\0')
+      except BlockingIOError:
+         # the I/O thread has not read the previous wakeups yet
+         pass
+
+   #
+   # The rest runs in the I/O thread
+   #
+   def wokenUp(self, sock):
+      try:
+         while self.wakeupRecv.recv(4096):
+            pass
+      except BlockingIOError:
+         pass
+
+      while self.released:
+         connection, closed = self.released.popleft()
+         if closed:
+            self.close(connection)
+         else:
+            with connection.sock.sendLock:
+               connection.rawSock.setblocking(False)
+            self.readable(connection)
+
+   def accept(self, sock):
+      while self.numConnections < POLLSERVER_POOL_MAX_CONNECTIONS:
+         try:
+            (cl_sock, cl_address) = sock.accept()
+         except BlockingIOError:
+            return
+         except OSError as ex:
+            log.warning("accept: %s", ex)
+            return
+         self.numConnections += 1
+
+         # TLS handshake and certificate validation are done in the handshake pool
+         self.handshakePool.submit(self.startConnection, cl_sock, cl_address)
+
+      log.warning("%d connections open, not accepting more", self.numConnections)
+      self.selector.unregister(self.listenSock)
+      self.accepting = False
+
+   def close(self, connection):
+      self.numConnections -= 1
+      if not self.accepting and self.numConnections < POLLSERVER_POOL_MAX_CONNECTIONS:
+         self.selector.register(self.listenSock, selectors.EVENT_READ, (self.accept, self.listenSock))
+         self.accepting = True
+
+      if connection is None:
+         return
+      if connection.registered:
+         self.selector.unregister(connection.rawSock.sock)
+      # dropping a login commits to user_session_table in the pre-fork mode, not in the I/O thread
+      self.handshakePool.submit(self.closeSession, connection)
+
+   # reads the data available on the connection, returns False if the client closed it
+   def read(self, connection):
+      sock = connection.rawSock.sock
+      while True:
+         try:
+            data = sock.recv(POLLSERVER_POOL_READ_SIZE)
+         except (ssl.SSLWantReadError, BlockingIOError):
+            return True
+         if not data:
+            return False
+         connection.sock.feed(data)
+
+         # the SSL object may hold data already read from the socket
+         if len(data) < POLLSERVER_POOL_READ_SIZE and not (hasattr(sock, 'pending') and sock.pending()):
+            return True
+
+   def readable(self, connection):
+      try:
+         if not self.read(connection):
+            self.close(connection)
+            return
+         self.dispatch(connection)
+      except (ConnectionError, OSError, ValueError) as ex:
+         log.info("%s %s", connection.address, ex)
+         self.close(connection)
+
+   # queues the next request of the connection, or rejects it, or waits for the rest of it
+   def dispatch(self, connection):
+      cl_sock = connection.sock
+      while True:
+         msgType, size = PeekRequest(cl_sock)
+         if msgType is None:
+            break
+         if self.admit(connection, msgType):
+            return
+
+         if size is None:
+            # a version 1 request can not be skipped
+            self.reject(connection, msgType)
+            self.close(connection)
+            return
+         if cl_sock.end - cl_sock.start < size:
+            break
+
+         # skip the frame, the response is sent with its request ID
+         recvMsgHdr(cl_sock)
+         self.reject(connection, msgType)
+
+      if not connection.registered:
+         self.selector.register(connection.rawSock.sock, selectors.EVENT_READ, (self.readable, connection))
+         connection.registered = True
+
+   # queues the request for the workers, returns False if the server can not take it
+   def admit(self, connection, msgType):
+      limit = self.typeLimits.get(msgType)
+      with self.lock:
+         if self.requests.full(msgType) or (limit is not None and self.inFlight[msgType] >= limit):
+            return False
+         self.inFlight[msgType] += 1
+
+      if connection.registered:
+         self.selector.unregister(connection.rawSock.sock)
+         connection.registered = False
+      with connection.sock.sendLock:
+         connection.rawSock.settimeout(POLLSERVER_POOL_IO_TIMEOUT)
+
+      # only the I/O thread adds to the queues, so it is not full
+      self.requests.put(connection, msgType)
+      return True
+
+   def reject(self, connection, msgType):
+      self.numRejected += 1
+      log.debug("%s %s rejected, server overloaded (%d rejected)", connection.address,
+                msgtype2stringMap.get(msgType, msgType), self.numRejected)
+
+      # the I/O thread does not wait for a client not reading its responses
+      with connection.sock.sendLock:
+         connection.rawSock.sendTimeout = 0
+         try:
+            sendFailureResponse(connection.sock, msgType, REASON_SERVER_OVERLOADED)
+         finally:
+            connection.rawSock.sendTimeout = POLLSERVER_POOL_IO_TIMEOUT
+
+   def serve(self, hostPort, reusePort):
+      self.listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      if reusePort:
+         self.listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      self.listenSock.bind(hostPort)
+      self.listenSock.listen(POLLSERVER_POOL_NUM_WAIT_REQS)
+      self.listenSock.setblocking(False)
+
+      self.selector.register(self.wakeupRecv, selectors.EVENT_READ, (self.wokenUp, self.wakeupRecv))
+      self.selector.register(self.listenSock, selectors.EVENT_READ, (self.accept, self.listenSock))
+      self.accepting = True
+
+      while True:
+         for key, events in self.selector.select():
+            callback, arg = key.data
+            callback(arg)
+
+#
+# Starts the pool server, never returns
+#
+#   hostPort     : address to listen on
+#   handshake    : function doing the TLS handshake of an accepted socket (see poll_server.Handshake)
+#   serveRequest : function processing one request from the client (see poll_server.ServeRequest)
+#   reusePort    : listen with SO_REUSEPORT, set by the worker processes of the pre-fork mode
+#
+def RunPoolServer(hostPort, handshake, serveRequest, reusePort=False):
+   PoolServer(handshake, serveRequest).serve(hostPort, reusePort)
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import signal
+import socket
+import poll_dbopsimpl
+import poll_generations
+import poll_logging
+from poll_logging import log
+
+#
+# Implements the pre-fork mode of the poll server
+#
+# A single server process runs the request handlers on one core at a time (GIL). In the pre-fork
+# mode the parent process sets up the server (logging, database schema, SSL context) and forks
+# numProcesses worker processes. Every worker opens its own listening socket on the server address
+# with SO_REUSEPORT, so the kernel spreads the new connections over the workers, and runs its own
+# accept loop (thread or asyncio mode), handler threads and database connections. The SSL context
+# is created before the fork, so a TLS session ticket issued by one worker is accepted by all.
+#
+# The state shared by the workers:
+#    - the logins, in user_session_table, so a user is logged in only once across the workers
+#      (see SessionRegistry in poll_dbopsimpl.py)
+#    - the generations of the polls, in shared memory, so the caches and the publisher of a
+#      worker see the changes committed by the other workers (see poll_generations.py)
+#
+# The parent only watches the workers. A worker that exits is started again, after its logins
+# are dropped. On SIGTERM or SIGINT, the parent stops the workers and exits.
+#
+
+# min time between two starts of a worker, so a worker failing at start does not spin
+POLLSERVER_PREFORK_RESTART_DELAY = 1
+
+class PreforkServer:
+   def __init__(self, numProcesses, runWorker):
+      self.numProcesses = numProcesses
+      self.runWorker = runWorker
+      # pid -> start time
+      self.workers = {}
+      self.stopping = False
+
+   def startWorker(self):
+      pid = os.fork()
+      if pid == 0:
+         status = 1
+         try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            poll_logging.RestartLogging()
+            log.info("worker %d started", os.getpid())
+            self.runWorker()
+            status = 0
+         except KeyboardInterrupt:
+            status = 0
+         except BaseException:
+            log.exception("worker %d failed", os.getpid())
+         finally:
+            poll_logging.StopLogging()
+            os._exit(status)
+
+      self.workers[pid] = time.monotonic()
+
+   def stop(self, signum, frame):
+      self.stopping = True
+      for pid in self.workers:
+         try:
+            os.kill(pid, signal.SIGTERM)
+         except ProcessLookupError:
+            pass
+
+   # drops the logins of the worker pid, of all the workers if pid is None. The connection is
+   # not kept open across the forks
+   def removeSessions(self, pid=None):
+      conn = poll_dbopsimpl.ConnectDatabase()
+      try:
+         poll_dbopsimpl.RemoveProcessSessions(conn, pid)
+      finally:
+         conn.close()
+
+   def run(self):
+      # the logins of the previous run
+      self.removeSessions()
+
+      poll_dbopsimpl.EnableSharedSessions()
+      poll_generations.EnableSharedGenerations()
+
+      signal.signal(signal.SIGTERM, self.stop)
+      signal.signal(signal.SIGINT, self.stop)
+
+      for i in range(self.numProcesses):
+         self.startWorker()
+      log.info("pre-fork server started %d workers", self.numProcesses)
+
+      while self.workers:
+         try:
+            (pid, status) = os.wait()
+         except ChildProcessError:
+            break
+         startTime = self.workers.pop(pid, None)
+         if startTime is None:
+            continue
+
+         self.removeSessions(pid)
+         if self.stopping:
+            continue
+
+         log.warning("worker %d exited with status %d, restarting it", pid, os.waitstatus_to_exitcode(status))
+         time.sleep(max(0, startTime + POLLSERVER_PREFORK_RESTART_DELAY - time.monotonic()))
+         self.startWorker()
+
+      log.info("pre-fork server stopped")
+
+#
+# Runs the server in numProcesses worker processes, returns when they are all stopped
+#
+#   numProcesses : number of worker processes
+#   runWorker    : function running the server in a worker, listening with SO_REUSEPORT
+#
+def RunPreforkServer(numProcesses, runWorker):
+   if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+      log.error("the pre-fork mode needs fork() and SO_REUSEPORT")
+      sys.exit(1)
+   PreforkServer(numProcesses, runWorker).run()
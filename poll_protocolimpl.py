@@ -0,0 +1,29 @@
+import sys
+from poll_message_api import *
+from poll_logging import TraceRequest
+
+#
+# Server side handling of the connection level requests (see poll_pollopsimpl for the
+# structure of the classes)
+#
+
+class NegotiateVersionImpl:
+   def __init__(self, cl_sock, cl_cntxt, conn):
+      self.sock = cl_sock
+      self.cntxt = cl_cntxt
+      self.conn = conn
+      self.op = NEGOTIATE_VERSION
+
+   def invoke(self):
+      TraceRequest("ENTER NegotiateVersionImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
+      version = recvNegotiateVersionReqData(self.sock)
+      if version is None:
+         return OP_FAILURE
+
+      # the highest version supported by both, the response is sent in the current version
+      version = max(min(version, POLL_WIRE_VERSION_MAX), POLL_WIRE_VERSION_1)
+      r = sendNegotiateVersionResponse(self.sock, OP_SUCCESS, REASON_SUCCESS, version)
+      self.sock.wireVersion = version
+
+      TraceRequest("EXIT NegotiateVersionImpl version %s", version)
+      return 0
@@ -0,0 +1,252 @@
+import time
+import socket
+import threading
+import collections
+import concurrent.futures
+import poll_dbopsimpl
+import poll_generations
+from poll_message_api import *
+from poll_logging import log
+
+#
+# Implements the push of the poll results to the subscribed connections
+#
+# A dashboard asking USER_POLL_GET_RESULTS in a loop costs a request, and often a query, per
+# refresh and per client. A client may instead send SUBSCRIBE_POLL_RESULTS once and the server
+# pushes the changes of the results to it (POLL_RESULTS_UPDATE).
+#
+# The operations changing the results (the vote writer, AddPollChoices, RemovePollChoices) tell
+# the publisher which polls changed (see PublishPollResults). The publisher thread reads the
+# counts of every changed poll with one query, compares them with the counts it pushed before,
+# and pushes the choices whose count changed to all the subscribers of the poll. It then waits
+# POLLSERVER_PUBLISH_INTERVAL seconds, so the votes of that time are pushed together, in at
+# most one update per poll and interval, however many votes and subscribers there are.
+#
+# A new subscriber gets the counts of all the choices in its first update.
+#
+# In the pre-fork mode, the votes are also committed by the other worker processes. Every
+# POLLSERVER_PUBLISH_INTERVAL seconds, the publisher also pushes the subscribed polls whose
+# generation changed (see poll_generations).
+#
+# The publisher thread never writes to the sockets itself, so a subscriber not reading its updates
+# does not hold up the others. The updates are queued per connection and sent by a pool of
+# POLLSERVER_PUBLISH_NUM_SENDERS threads, one connection at a time per thread, holding the send
+# lock of the FramedSocket so an update is never mixed with a response sent by the thread of the
+# connection, and no update follows the response to the unsubscription. A connection whose socket
+# fails is dropped. A connection with POLLSERVER_PUBLISH_QUEUE_SIZE updates waiting is not reading
+# them: its subscriptions are dropped and its connection is shut down, which also frees the sender
+# thread waiting to write to it.
+#
+
+# min time between two updates of a poll
+POLLSERVER_PUBLISH_INTERVAL = 0.5
+
+# max number of updates waiting to be sent to a connection
+POLLSERVER_PUBLISH_QUEUE_SIZE = 16
+
+# number of threads sending the updates
+POLLSERVER_PUBLISH_NUM_SENDERS = 4
+
+#
+# Subscription of one connection to one poll, sent to as a socket: the wire format version and
+# all the other attributes go to the socket of the connection, the request ID is the one of the
+# subscription request
+#
+class Subscriber:
+   def __init__(self, sock, requestID):
+      self.sock = sock
+      self.requestID = requestID
+
+   def __getattr__(self, name):
+      return getattr(self.sock, name)
+
+   def __repr__(self):
+      return f"<Subscriber {self.requestID} {self.sock!r}>"
+
+class Publisher:
+   def __init__(self, interval=POLLSERVER_PUBLISH_INTERVAL):
+      self.interval = interval
+      # pollID -> {sock: Subscriber}
+      self.subscribers = {}
+      # pollID -> {choiceID: count} last pushed, and the generation of the poll when it was read
+      self.counts = {}
+      self.generations = {}
+      # polls changed and (pollID, Subscriber) subscribed since the last push
+      self.changed = set()
+      self.joined = []
+      # sock -> deque of (pollID, Subscriber, msgBuf) to be sent, the first one being sent
+      self.outboxes = {}
+      self.numUpdates = 0
+      self.senders = concurrent.futures.ThreadPoolExecutor(max_workers=POLLSERVER_PUBLISH_NUM_SENDERS,
+                                                           thread_name_prefix='poll-publisher-send')
+      self.lock = threading.Lock()
+      self.wakeup = threading.Condition(self.lock)
+      self.thread = threading.Thread(target=self.run, name='poll-publisher', daemon=True)
+      self.thread.start()
+
+   def subscribe(self, sock, pollID, requestID):
+      with self.lock:
+         subscriber = Subscriber(sock, requestID)
+         self.subscribers.setdefault(pollID, {})[sock] = subscriber
+         self.joined.append((pollID, subscriber))
+         self.wakeup.notify()
+
+   def unsubscribe(self, sock, pollIDs=None):
+      with self.lock:
+         if pollIDs is None:
+            self.outboxes.pop(sock, None)
+         for pollID in list(self.subscribers) if pollIDs is None else pollIDs:
+            subscribers = self.subscribers.get(pollID, {})
+            subscribers.pop(sock, None)
+            if not subscribers:
+               self.subscribers.pop(pollID, None)
+               self.counts.pop(pollID, None)
+               self.generations.pop(pollID, None)
+
+   def isSubscribed(self, pollID, subscriber):
+      with self.lock:
+         return self.subscribers.get(pollID, {}).get(subscriber.sock) is subscriber
+
+   def publish(self, pollIDs):
+      with self.lock:
+         pollIDs = [pollID for pollID in pollIDs if pollID in self.subscribers]
+         if pollIDs:
+            self.changed.update(pollIDs)
+            self.wakeup.notify()
+
+   def run(self):
+      conn = poll_dbopsimpl.GetConnection()
+
+      while True:
+         with self.lock:
+            while not self.changed and not self.joined:
+               # the changes committed by the other processes are only seen in the generations
+               if not self.wakeup.wait(self.interval if poll_generations.IsShared() else None):
+                  self.changed.update(pollID for pollID in self.subscribers
+                                      if poll_generations.GetGeneration(pollID) != self.generations.get(pollID))
+            changed, self.changed = self.changed, set()
+            joined, self.joined = self.joined, []
+
+         try:
+            self.push(conn, changed, joined)
+         except Exception:
+            log.exception("publisher failed to push the results of %s", changed)
+
+         # the changes of the next interval are pushed together
+         time.sleep(self.interval)
+
+   # queues the update for the subscribers, dropping the ones not reading their updates
+   def send(self, pollID, updates, subscribers):
+      msgBufs = {}
+      for subscriber in subscribers:
+         wireVersion = GetWireVersion(subscriber)
+         if wireVersion not in msgBufs:
+            msgBufs[wireVersion] = encodePollResultsUpdate(pollID, updates, wireVersion)
+         if not self.queue(pollID, subscriber, msgBufs[wireVersion]):
+            self.dropSlow(subscriber)
+
+   # returns False if the queue of the connection is full
+   def queue(self, pollID, subscriber, msgBuf):
+      with self.lock:
+         outbox = self.outboxes.get(subscriber.sock)
+         if outbox is None:
+            outbox = self.outboxes[subscriber.sock] = collections.deque()
+         if len(outbox) >= POLLSERVER_PUBLISH_QUEUE_SIZE:
+            return False
+         outbox.append((pollID, subscriber, msgBuf))
+         if len(outbox) == 1:
+            # no sender is sending to the connection
+            self.senders.submit(self.drain, subscriber.sock, outbox)
+      return True
+
+   def dropSlow(self, subscriber):
+      log.warning("%r not reading its poll results updates, dropped", subscriber)
+      self.unsubscribe(subscriber.sock)
+      try:
+         subscriber.sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+         pass
+
+   # runs in the sender pool, sends the queued updates of the connection. The update being sent
+   # stays in the queue, so the queue is empty only when no sender is sending to the connection
+   def drain(self, sock, outbox):
+      while True:
+         with self.lock:
+            if not outbox or self.outboxes.get(sock) is not outbox:
+               if self.outboxes.get(sock) is outbox:
+                  del self.outboxes[sock]
+               return
+            pollID, subscriber, msgBuf = outbox[0]
+
+         try:
+            with subscriber.sendLock:
+               sent = self.isSubscribed(pollID, subscriber) and sendEncodedResponse(subscriber, msgBuf) == OP_SUCCESS
+         except (ConnectionError, OSError) as ex:
+            log.info("%r %s", subscriber, ex)
+            self.unsubscribe(sock)
+            return
+         except Exception:
+            log.exception("publisher failed to send to %r", subscriber)
+            self.unsubscribe(sock)
+            return
+
+         with self.lock:
+            if outbox:
+               outbox.popleft()
+            if sent:
+               self.numUpdates += 1
+
+   def push(self, conn, changed, joined):
+      for pollID in changed | {pollID for (pollID, subscriber) in joined}:
+         generation = poll_generations.GetGeneration(pollID)
+         counts = poll_dbopsimpl.PollGetCounts(conn, pollID)
+
+         with self.lock:
+            subscribers = list(self.subscribers.get(pollID, {}).values())
+            lastCounts = self.counts.get(pollID, {})
+            if subscribers:
+               self.counts[pollID] = counts
+               self.generations[pollID] = generation
+
+         # the choices whose count changed, the removed ones with count 0
+         updates = [(choiceID, count) for (choiceID, count) in counts.items() if lastCounts.get(choiceID) != count]
+         updates += [(choiceID, 0) for choiceID in lastCounts if choiceID not in counts]
+         joinedSubscribers = [subscriber for (p, subscriber) in joined if p == pollID and subscriber in subscribers]
+
+         if updates:
+            self.send(pollID, updates, [s for s in subscribers if s not in joinedSubscribers])
+         if joinedSubscribers:
+            self.send(pollID, sorted(counts.items()), joinedSubscribers)
+
+      log.debug("publisher pushed %d polls, %d updates sent", len(changed), self.numUpdates)
+
+publisher = None
+publisherLock = threading.Lock()
+
+# Returns the publisher of the server, starting it on first use
+def GetPublisher():
+   global publisher
+
+   if publisher is None:
+      with publisherLock:
+         if publisher is None:
+            publisher = Publisher()
+   return publisher
+
+# Pushes the results of the poll to the connection, till it unsubscribes or is closed
+def Subscribe(sock, pollID):
+   GetPublisher().subscribe(sock, pollID, GetRequestID(sock))
+
+def Unsubscribe(sock, pollID):
+   if publisher is not None:
+      publisher.unsubscribe(sock, [pollID])
+
+# Drops all the subscriptions of the connection, called when it is closed
+def UnsubscribeAll(sock):
+   if publisher is not None:
+      publisher.unsubscribe(sock)
+
+# Tells the publisher the results of the polls changed, called after the change is committed
+def PublishPollResults(*pollIDs):
+   if publisher is not None:
+      publisher.publish(pollIDs)
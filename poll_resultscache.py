@@ -0,0 +1,106 @@
+import threading
+import collections
+import poll_dbopsimpl
+import poll_publisher
+import poll_generations
+from poll_message_api import *
+from poll_logging import log
+
+#
+# Implements the cache of the poll results
+#
+# The USER_POLL_GET_RESULTS response of a poll is kept encoded (see encodePollGetResultsResponse),
+# once for every wire format version asked for, so a cached response is sent without reading the
+# database or encoding it again. The entries are dropped by the operations changing the results:
+# the vote writer after a batch of votes is committed, and AddPollChoices, RemovePollChoices and
+# SetPollStatus after they succeed.
+#
+# When a poll is not in the cache, only one thread reads it from the database. The other threads
+# asking for the same poll wait for it, so a thousand clients refreshing one poll cost one query.
+# A response read while the poll was being changed is not kept. The changes committed by the
+# other worker processes are seen via the generation of the poll (see poll_generations).
+#
+# The cache holds up to POLLSERVER_RESULTS_CACHE_SIZE responses, the least recently used one is
+# dropped when it is full.
+#
+
+# max number of responses in the cache
+POLLSERVER_RESULTS_CACHE_SIZE = 1024
+
+class ResultsCache:
+   def __init__(self, maxSize=POLLSERVER_RESULTS_CACHE_SIZE):
+      self.maxSize = maxSize
+      # (pollID, wireVersion) -> (response, generation of the poll when it was read)
+      self.entries = collections.OrderedDict()
+      self.loading = {}
+      self.version = 0
+      self.hits = 0
+      self.misses = 0
+      self.lock = threading.Lock()
+
+   # returns the encoded USER_POLL_GET_RESULTS response of the poll
+   def get(self, conn, pollID, wireVersion):
+      key = (pollID, wireVersion)
+      while True:
+         generation = poll_generations.GetGeneration(pollID)
+         with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == generation:
+               self.entries.move_to_end(key)
+               self.hits += 1
+               return entry[0]
+
+            loading = self.loading.get(key)
+            if loading is None:
+               # this thread reads the poll, the others wait for it
+               loading = self.loading[key] = threading.Event()
+               version = self.version
+               self.misses += 1
+               break
+         loading.wait()
+
+      try:
+         status, reason, pollName, pollResults = poll_dbopsimpl.PollGetResults(conn, pollID)
+         msgBuf = encodePollGetResultsResponse(status, reason, pollName, pollResults, wireVersion)
+
+         with self.lock:
+            if status == OP_SUCCESS and version == self.version:
+               self.entries[key] = (msgBuf, generation)
+               if len(self.entries) > self.maxSize:
+                  self.entries.popitem(last=False)
+      finally:
+         with self.lock:
+            del self.loading[key]
+         loading.set()
+
+      log.debug("results cache %s", self.stats())
+      return msgBuf
+
+   def invalidate(self, pollIDs):
+      with self.lock:
+         self.version += 1
+         for pollID in pollIDs:
+            for wireVersion in range(POLL_WIRE_VERSION_1, POLL_WIRE_VERSION_MAX + 1):
+               self.entries.pop((pollID, wireVersion), None)
+      poll_generations.BumpGeneration(*pollIDs)
+
+   def stats(self):
+      return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+resultsCache = ResultsCache()
+
+# Returns the USER_POLL_GET_RESULTS response of the poll, encoded in the given wire format version
+def GetPollResults(conn, pollID, wireVersion=POLL_WIRE_VERSION_1):
+   # the frames of version 2 and later differ only in the request ID, added when sent
+   return resultsCache.get(conn, pollID, min(wireVersion, POLL_WIRE_VERSION_2))
+
+# Drops the cached results of the polls, called after a change to the polls is committed.
+# The subscribers of the polls get the change too
+def InvalidatePollResults(*pollIDs):
+   resultsCache.invalidate(pollIDs)
+   poll_publisher.PublishPollResults(*pollIDs)
+
+# Returns the hit/miss counters and the number of responses in the cache
+def GetResultsCacheStats():
+   with resultsCache.lock:
+      return resultsCache.stats()
@@ -0,0 +1,189 @@
+import threading
+import collections
+import poll_passwords
+from poll_message_api import *
+
+#
+# Implements the scheduling of the requests on the workers of the pool mode (see poll_poolserver)
+#
+# The requests are put in one of four classes:
+#
+#    SCHED_WRITE : the votes and the other requests changing the database. Short, and a client
+#                  waits for them
+#    SCHED_AUTH  : the logins and the requests setting a password, which wait for the KDF
+#                  computed in the processes of poll_passwords
+#    SCHED_READ  : the results of a poll, the other reads of a few rows
+#    SCHED_BULK  : the listings, which read whole tables or pages of them
+#
+# Every class has its own queue, bounded by POLLSERVER_POOL_QUEUE_SIZE, so a flood of listings
+# never gets a vote rejected. The free workers take the requests of the classes in weighted fair
+# order (stride scheduling): every class has a pass value, the worker takes the oldest request of
+# the waiting class with the lowest pass, and the pass of that class advances by the inverse of
+# its weight. With the weights 8:4:4:1, out of 17 requests taken while all the classes are
+# waiting, 8 are writes, 4 logins, 4 reads and 1 a listing. A class starting to wait after being
+# idle gets the current pass, not the credit of the time it was idle.
+#
+# At most POLLSERVER_SCHED_MAX_RUNNING requests of a class are processed at a time, so the bulk
+# listings never hold all the workers and a vote always finds one soon. The logins are limited to
+# the number of processes computing the KDF, the ones beyond would only wait for a process while
+# holding a worker, so a login storm does not hold up the votes.
+#
+# In all the modes, every request is counted while it is processed (see BeginRequest, called by
+# poll_server.ServeRequest). In the thread mode, where every connection has its own thread, a
+# bulk request waits there for its turn (see EnableRunningLimits). The asyncio mode limits them
+# before handing them over to its pool (see poll_asyncserver). The pipelined requests wait for
+# their turn before the pipeline pool, in all the modes (see poll_pipeline).
+#
+# The requests of all the threads share one core (GIL), so a listing reading or encoding rows
+# slows down the votes processed at the same time. The listings call YieldToWrites() between two
+# chunks of rows, which waits till no write is processed, for at most
+# POLLSERVER_SCHED_BULK_MAX_YIELD seconds.
+#
+
+SCHED_WRITE = 0
+SCHED_READ = 1
+SCHED_BULK = 2
+SCHED_AUTH = 3
+
+# message type -> class, the message types not in the dict are SCHED_READ
+POLLSERVER_SCHED_CLASSES = {
+   CREATE_USER                    : SCHED_AUTH,
+   CHANGE_USER                    : SCHED_AUTH,
+   LOGIN_USER                     : SCHED_AUTH,
+   LOGOUT_USER                    : SCHED_WRITE,
+   CREATE_POLL                    : SCHED_WRITE,
+   POLL_ADD_CHOICES               : SCHED_WRITE,
+   POLL_REMOVE_CHOICES            : SCHED_WRITE,
+   POLL_SET_STATUS                : SCHED_WRITE,
+   USER_POLL_MAKE_SELECTION       : SCHED_WRITE,
+   USER_POLL_MAKE_SELECTION_BATCH : SCHED_WRITE,
+   SUBSCRIBE_POLL_RESULTS         : SCHED_WRITE,
+   NEGOTIATE_VERSION              : SCHED_WRITE,
+   USER_POLL_GET_RESULTS          : SCHED_READ,
+   LIST_USERS                     : SCHED_BULK,
+   LIST_POLLS                     : SCHED_BULK,
+   LIST_USERS_PAGE                : SCHED_BULK,
+   LIST_POLLS_PAGE                : SCHED_BULK,
+}
+
+# class -> weight
+POLLSERVER_SCHED_WEIGHTS = {
+   SCHED_WRITE : 8,
+   SCHED_AUTH  : 4,
+   SCHED_READ  : 4,
+   SCHED_BULK  : 1,
+}
+
+# class -> max number of requests of the class processed at a time
+POLLSERVER_SCHED_MAX_RUNNING = {
+   SCHED_AUTH : poll_passwords.POLLSERVER_KDF_NUM_WORKERS,
+   SCHED_BULK : 1,
+}
+
+# max time a listing waits for the writes between two chunks of rows
+POLLSERVER_SCHED_BULK_MAX_YIELD = 0.01
+
+def GetSchedClass(msgType):
+   return POLLSERVER_SCHED_CLASSES.get(msgType, SCHED_READ)
+
+class RequestScheduler:
+   def __init__(self, maxSize, weights=None, maxRunning=None):
+      self.maxSize = maxSize
+      self.weights = dict(POLLSERVER_SCHED_WEIGHTS if weights is None else weights)
+      self.maxRunning = dict(POLLSERVER_SCHED_MAX_RUNNING if maxRunning is None else maxRunning)
+      self.queues = {schedClass: collections.deque() for schedClass in self.weights}
+      self.running = collections.Counter()
+      # class -> pass, and the pass of the last request taken
+      self.passes = dict.fromkeys(self.weights, 0.0)
+      self.currentPass = 0.0
+      self.lock = threading.Lock()
+      self.ready = threading.Condition(self.lock)
+
+   def full(self, msgType):
+      return len(self.queues[GetSchedClass(msgType)]) >= self.maxSize
+
+   # queues the item of a request of msgType, returns False if the queue of its class is full
+   def put(self, item, msgType):
+      schedClass = GetSchedClass(msgType)
+      with self.lock:
+         queue = self.queues[schedClass]
+         if len(queue) >= self.maxSize:
+            return False
+         if not queue:
+            self.passes[schedClass] = max(self.passes[schedClass], self.currentPass)
+         queue.append((item, msgType))
+         self.ready.notify()
+      return True
+
+   # returns the class with the lowest pass among the waiting ones not at their limit, None if none
+   def pick(self):
+      schedClass = None
+      for c, queue in self.queues.items():
+         if not queue or self.running[c] >= self.maxRunning.get(c, float('inf')):
+            continue
+         if schedClass is None or self.passes[c] < self.passes[schedClass]:
+            schedClass = c
+      return schedClass
+
+   # waits for the next request, returns (item, msgType). done() must be called after it is processed
+   def get(self):
+      with self.lock:
+         schedClass = self.pick()
+         while schedClass is None:
+            self.ready.wait()
+            schedClass = self.pick()
+         self.currentPass = self.passes[schedClass]
+         self.passes[schedClass] += 1.0 / self.weights[schedClass]
+         self.running[schedClass] += 1
+         return self.queues[schedClass].popleft()
+
+   def done(self, msgType):
+      with self.lock:
+         self.running[GetSchedClass(msgType)] -= 1
+         self.ready.notify()
+
+#
+# Counts of the requests processed, by class, in all the server modes
+#
+class ActiveRequests:
+   def __init__(self, maxRunning=None):
+      self.maxRunning = dict(POLLSERVER_SCHED_MAX_RUNNING if maxRunning is None else maxRunning)
+      self.limited = False
+      self.running = collections.Counter()
+      self.changed = threading.Condition()
+
+   # waits till a request of the class of msgType can be processed, if limited
+   def begin(self, msgType, limited=False):
+      schedClass = GetSchedClass(msgType)
+      limit = self.maxRunning.get(schedClass)
+      with self.changed:
+         if limit is not None and (self.limited or limited):
+            self.changed.wait_for(lambda: self.running[schedClass] < limit)
+         self.running[schedClass] += 1
+
+   def end(self, msgType):
+      with self.changed:
+         self.running[GetSchedClass(msgType)] -= 1
+         self.changed.notify_all()
+
+   def yieldToWrites(self, maxWait):
+      with self.changed:
+         self.changed.wait_for(lambda: self.running[SCHED_WRITE] == 0, maxWait)
+
+activeRequests = ActiveRequests()
+
+# Makes the requests wait for their turn in BeginRequest(), called by the thread mode
+def EnableRunningLimits():
+   activeRequests.limited = True
+
+# Called before and after processing a request. With limited, the request waits for its turn in
+# all the modes (the pipelined requests, see poll_pipeline)
+def BeginRequest(msgType, limited=False):
+   activeRequests.begin(msgType, limited)
+
+def EndRequest(msgType):
+   activeRequests.end(msgType)
+
+# Called by the listings between two chunks of rows
+def YieldToWrites(maxWait=POLLSERVER_SCHED_BULK_MAX_YIELD):
+   activeRequests.yieldToWrites(maxWait)
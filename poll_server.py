@@ -1,17 +1,51 @@
+import os
 import sys
 import time
 import ssl
 import socket
+import argparse
+import resource
 import threading
+import concurrent.futures
 import poll_useropsimpl
 import poll_pollopsimpl
 import poll_invalidmsgimpl
+import poll_protocolimpl
+import poll_pipeline
+import poll_publisher
 import poll_dbopsimpl
+import poll_asyncserver
+import poll_poolserver
+import poll_scheduler
+import poll_prefork
+import poll_passwords
+import poll_logging
+from poll_logging import log
 from poll_message_api import *
 
 POLLSERVER_HOST_PORT = ('127.0.0.1', 10000)
 POLLSERVER_NUM_WAIT_REQS = 25
 
+# Threaded mode: number of threads doing TLS handshakes for the new connections and
+# the time allowed for a client to finish the handshake. A worker waiting on a slow
+# client does not use the CPU, hence more workers than cores
+POLLSERVER_HANDSHAKE_NUM_WORKERS = max(16, 4 * (os.cpu_count() or 1))
+POLLSERVER_HANDSHAKE_TIMEOUT = 10
+
+# Number of TLS 1.3 session tickets sent to the client after the full handshake.
+# The client resumes the TLS session with a ticket when it reconnects (see poll_client)
+POLLSERVER_NUM_SESSION_TICKETS = 4
+
+# Server modes
+#    thread  : one thread per client connection (ThreadMain)
+#    asyncio : all the connections are owned by one event loop, requests are
+#              processed on a fixed pool of threads (see poll_asyncserver)
+POLLSERVER_MODES = ['thread', 'asyncio', 'pool']
+POLLSERVER_MODE = 'thread'
+
+# number of server processes, more than 1 runs the pre-fork mode (see poll_prefork.py)
+POLLSERVER_NUM_PROCESSES = 1
+
 # Following dict maps incoming socket request to the processing class
 #
 # When a message is received via socket, server reads the first 8-bytes of the
@@ -26,21 +60,42 @@ msgType2CBMap = {
    LOGIN_USER               : poll_useropsimpl.LoginUserImpl,
    LOGOUT_USER              : poll_useropsimpl.LogoutUserImpl,
    LIST_USERS               : poll_useropsimpl.ListUsersImpl,
+   LIST_USERS_PAGE          : poll_useropsimpl.ListUsersPageImpl,
    CREATE_POLL              : poll_pollopsimpl.CreatePollImpl,
    POLL_ADD_CHOICES         : poll_pollopsimpl.AddPollChoicesImpl,
    POLL_REMOVE_CHOICES      : poll_pollopsimpl.RemovePollChoicesImpl,
    POLL_SET_STATUS          : poll_pollopsimpl.SetPollStatusImpl,
    USER_POLL_MAKE_SELECTION : poll_pollopsimpl.PollMakeSelectionImpl,
+   USER_POLL_MAKE_SELECTION_BATCH : poll_pollopsimpl.PollMakeSelectionBatchImpl,
    USER_POLL_GET_RESULTS    : poll_pollopsimpl.PollGetResultsImpl,
    LIST_POLLS               : poll_pollopsimpl.ListPollsImpl,
+   LIST_POLLS_PAGE          : poll_pollopsimpl.ListPollsPageImpl,
+   SUBSCRIBE_POLL_RESULTS   : poll_pollopsimpl.SubscribePollResultsImpl,
+   NEGOTIATE_VERSION        : poll_protocolimpl.NegotiateVersionImpl,
 }
 
+# Counters of the full and the resumed (session ticket) TLS handshakes
+tlsHandshakeStats = {'full': 0, 'resumed': 0}
+tlsStatsLock = threading.Lock()
+
+def CountTlsHandshake(ssl_cl_sock):
+   tlsStatsLock.acquire()
+   if ssl_cl_sock.session_reused:
+      tlsHandshakeStats['resumed'] += 1
+   else:
+      tlsHandshakeStats['full'] += 1
+   stats = dict(tlsHandshakeStats)
+   tlsStatsLock.release()
+   log.debug("TLS handshakes %s", stats)
+
 # Validates the client SSL certificate 
 def CheckClientCertificate(ssl_cl_sock):
    # use of ssl can be disabled if desired by setting use_ssl = False
    if not use_ssl:
       return
 
+   CountTlsHandshake(ssl_cl_sock)
+
    # Get certificate from the client
    ssl_client_cert = ssl_cl_sock.getpeercert();
 
@@ -65,6 +120,77 @@ def CheckClientCertificate(ssl_cl_sock):
       if ts > t2:
          raise Exception("Expired client certificate");
 
+#
+# Reads and processes one request from the client socket
+#
+# Returns True if the connection must be terminated, either because the client closed
+# the socket or because something is wrong with the request. This is shared by the
+# threaded mode (ThreadMain) and the asyncio mode (poll_asyncserver)
+#
+def ServeRequest(cl_sock, cntxt, conn):
+   #
+   # read the message header, i.e the PollMsgHdr struct (4-bytes) or the
+   # start of the frame if the connection uses the v2 wire format. The
+   # numbers are converted from network-byte-order to host-byte-order
+   #
+   msgType, msgFlags = recvMsgHdr(cl_sock)
+
+   # If client closed the socket, recv returns None, exit the thread
+   if msgType is None:
+      return True
+
+   # the read-only requests pipelined by a version 3 client are processed on the pipeline
+   # pool, their responses are sent before the next request is waited for (see poll_pipeline)
+   if msgType in msgType2CBMap and poll_pipeline.IsPipelined(cl_sock, msgType):
+      poll_pipeline.Submit(msgType2CBMap[msgType], msgType, cl_sock, cntxt)
+      if cl_sock.hasPending():
+         return False
+      return poll_pipeline.Flush(cl_sock, cntxt)
+
+   # any other request is processed after the pipelined requests received before it
+   if poll_pipeline.Flush(cl_sock, cntxt):
+      return True
+
+   poll_logging.BeginRequest(msgType)
+   poll_logging.TraceRequest("request %s flags %s from %s", msgType, msgFlags, cntxt['address'])
+
+   # check if the message type in the request is supported
+   if msgType in msgType2CBMap:
+      #
+      # if supported, create the instance of the corresponding class
+      # and call the invoke() method of the class.
+      #
+      # invoke() method actually does the rest of the processing
+      # for the request.
+      #
+      # Every class is designed such that is:
+      #     has constructor which stashes the useful params in the object instance
+      #     has invoke() method that processes the request
+      #
+      # Every request has a different format. Only common stuff is 
+      # PollMsgHdr. The rest is dependent on the message type, hence
+      # the thread only reads the PollMsgHdr from socket and leaves the
+      # rest of the request data to be read and interpreted by the
+      # corresponding invoke() method
+      #
+      # A return value of True from invoke() method indicates something is wrong
+      # with the request and connection must be terminated.
+      #
+      # The bulk listings wait for their turn (see poll_scheduler)
+      #
+      poll_scheduler.BeginRequest(msgType)
+      try:
+         if msgType2CBMap[msgType](cl_sock, cntxt, conn).invoke():
+            return True
+      finally:
+         poll_scheduler.EndRequest(msgType)
+   else:
+      # if the message type is not supported, call common handling function
+      poll_invalidmsgimpl.InvalidMsgReqImpl(cl_sock, cntxt, conn).invoke()
+      return True
+
+   return False
+
 #
 # This is the main function for the thread that processes the client request
 #
@@ -73,133 +199,221 @@ def CheckClientCertificate(ssl_cl_sock):
 # inside the newly created thread
 #
 def ThreadMain(cl_sock):
-   print(cl_sock)
 
    #
    # Before starting the thread, the server stashes certain useful info
    # in a dict indexed by the socket object. This is called thread-context.
    # The newly created thread fetches that context info which in turn
-   # contains database connection, lock, logged in info and few other details
+   # contains logged in info and few other details
    #
    cntxt = poll_dbopsimpl.GetThreadContext(cl_sock)
-   conn = cntxt['conn']
-   lock = cntxt['lock']
-   print(cntxt)
+   log.debug("%s connected", cntxt['address'])
 
-   # The thread runs until the socket is closed
-   while True:
-      # read the message header which is 8-bytes
-      msgBuf = cl_sock.recv(ctypes.sizeof(PollMsgHdr))
-
-      # If client closed the socket, recv returns None, exit the thread
-      if not msgBuf:
-         break
+   # every thread has its own database connection
+   conn = poll_dbopsimpl.GetConnection()
 
-      #
-      # The msgBuf is in sequence of bonary bytes. Typecase it to a C-style
-      # struct so we can examine the contents
-      #
-      msgHdr = PollMsgHdr.from_buffer(bytearray(msgBuf))
-
-      # convert from network-byte-order to host-byte-order
-      msgType = socket.ntohs(msgHdr.msgType)
-      msgFlags = socket.ntohs(msgHdr.flags)
-
-      print(msgType, msgFlags)
-      # check if the message type in the request is supported
-      if msgType in msgType2CBMap:
-         #
-         # if supported, create the instance of the corresponding class
-         # and call the invoke() method of the class.
-         #
-         # invoke() method actually does the rest of the processing
-         # for the request.
-         #
-         # Every class is designed such that is:
-         #     has constructor which stashes the useful params in the object instance
-         #     has invoke() method that processes the request
-         #
-         # Every request has a different format. Only common stuff is 
-         # PollMsgHdr. The rest is dependent on the message type, hence
-         # the thread only reads the PollMsgHdr from socket and leaves the
-         # rest of the request data to be read and interpreted by the
-         # corresponding invoke() method
-         #
-         # A return value of True from invoke() method indicates something is wrong
-         # with the request and connection must be terminated.
-         #
-         if msgType2CBMap[msgType](cl_sock, cntxt, conn).invoke():
-            break
-      else:
-         # if the message type is not supported, call common handling function
-         poll_invalidmsgimpl.InvalidMsgReqImpl(cl_sock, cntxt, conn).invoke()
-         break
+   # The thread runs until the socket is closed
+   try:
+      while not ServeRequest(cl_sock, cntxt, conn):
+         pass
+   except (ConnectionError, OSError) as ex:
+      log.info("%s %s", cntxt['address'], ex)
+   except Exception:
+      log.exception("%s error processing request", cntxt['address'])
 
    # Before closing the socket and exiting the thread clean up the thread
-   # context
-   poll_dbopsimpl.RemoveThreadContext(cl_sock)
-
-   # close the socket
-   cl_sock.close()
+   # context and the subscriptions. The socket is closed even if they fail
+   try:
+      try:
+         poll_dbopsimpl.RemoveThreadContext(cl_sock)
+      finally:
+         poll_publisher.UnsubscribeAll(cl_sock)
+   except Exception:
+      log.exception("%s error closing the session", cntxt['address'])
+   finally:
+      # close the socket
+      cl_sock.close()
 
 # start a new thread for serviving the client socket
-def start_new_thread(cl_sock, cl_address, conn, lock):
+def start_new_thread(cl_sock, cl_address):
    # creates the thread
    ct = threading.Thread(target=ThreadMain, args=(cl_sock,))
    if ct:
       # if the thread creation is successful, save the important
       # info so that the new thread can access them
-      poll_dbopsimpl.AddThreadContext(cl_sock, cl_address, conn, lock)
+      poll_dbopsimpl.AddThreadContext(cl_sock, cl_address)
 
       # start the thread -- invokes ThreadMain() function
       ct.start()
 
-# connect to database
-conn = poll_dbopsimpl.ConnectDatabase()
-if not conn:
-   sys.exit(1)
-
-# create tables if needed
-cur = poll_dbopsimpl.CreateTables(conn)
-if not cur:
-   sys.exit(1)
+# Raise the limit on open files so that the server can hold as many
+# client connections as the system allows
+def RaiseOpenFileLimit():
+   soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+   if soft < hard:
+      resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
 
-use_ssl = True
-
-# create a common lock to synchronize access to the database tables
-lock = threading.Lock()
+#
+# Performs the TLS handshake with the client and validates the client's certificate.
+# Returns the SSL socket, None if the handshake failed (the socket is closed)
+#
+# The accept loop only accepts the plain TCP connection and hands it over to the handshake
+# pool, so a slow or malicious client holds up one handshake worker (for at most
+# POLLSERVER_HANDSHAKE_TIMEOUT seconds) instead of every new connection behind it.
+#
+def Handshake(ssl_context, cl_sock, cl_address):
+   ssl_cl_sock = cl_sock
+   try:
+      if use_ssl:
+         cl_sock.settimeout(POLLSERVER_HANDSHAKE_TIMEOUT)
+         ssl_cl_sock = ssl_context.wrap_socket(cl_sock, server_side=True, do_handshake_on_connect=False)
+         ssl_cl_sock.do_handshake()
+
+         # validate the client's certificate
+         CheckClientCertificate(ssl_cl_sock)
+         ssl_cl_sock.settimeout(None)
+   except Exception as ex:
+      log.warning("%s TLS handshake: %s", cl_address, ex)
+      ssl_cl_sock.close()
+      return None
+   return ssl_cl_sock
+
+# Runs in the handshake pool: performs the TLS handshake, then starts the thread for the client
+def HandshakeAndStart(ssl_context, cl_sock, cl_address):
+   ssl_cl_sock = Handshake(ssl_context, cl_sock, cl_address)
+   if ssl_cl_sock is None:
+      return
 
-# create server socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+   # create new thread for the client, the requests are read via the framed reader
+   start_new_thread(FramedSocket(ssl_cl_sock), cl_address)
 
-# setup SSL context
-ssl_context                     = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-ssl_context.verify_mode         = ssl.CERT_REQUIRED;
+# Accept loop of the threaded mode: one thread per client connection
+def RunThreadedServer(ssl_context, reusePort=False):
+   # create server socket
+   sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-# CA certificate
-ssl_context.load_verify_locations("certificates/ca-cert.pem")
+   # allow restarting the server while old connections are still in TIME_WAIT
+   sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-# server certificate and server key
-ssl_context.load_cert_chain(certfile="certificates/server-cert.pem", keyfile="certificates/server-key.pem")
+   # the worker processes of the pre-fork mode listen on the same address
+   if reusePort:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-if use_ssl:
-   # if SSL is enabled, wrap the normal socket with SSL so all send and recv's go via SSL channel
-   ssl_sock = ssl_context.wrap_socket(sock, server_side=True)
-else:
-   ssl_sock = sock
+   sock.bind(POLLSERVER_HOST_PORT)
+   sock.listen(POLLSERVER_NUM_WAIT_REQS)
 
-ssl_sock.bind(POLLSERVER_HOST_PORT)
-ssl_sock.listen(POLLSERVER_NUM_WAIT_REQS)
+   # the bulk listings of the connection threads wait for their turn (see poll_scheduler)
+   poll_scheduler.EnableRunningLimits()
 
-while True:
-   # wait for connection from client
-   (ssl_cl_sock, cl_address) = ssl_sock.accept()
+   # OpenSSL releases the GIL while doing the handshake, so the handshakes
+   # run in parallel on the pool threads
+   handshakePool = concurrent.futures.ThreadPoolExecutor(max_workers=POLLSERVER_HANDSHAKE_NUM_WORKERS,
+                                                         thread_name_prefix='poll-handshake')
 
-   # validate the client's certificate
-   CheckClientCertificate(ssl_cl_sock)
+   while True:
+      # wait for connection from client
+      (cl_sock, cl_address) = sock.accept()
+
+      # TLS handshake and certificate validation are done in the handshake pool
+      handshakePool.submit(HandshakeAndStart, ssl_context, cl_sock, cl_address)
+
+   handshakePool.shutdown()
+   sock.close()
+
+# Runs the server in the mode, never returns
+# Returns the number of database connections of a server process in the mode: one per handler
+# thread, the pipeline pool, the vote writer, the publisher and the main thread. None in the
+# thread mode, which has one per client (see poll_dbopsimpl.POLLSERVER_DB_NUM_CONNECTIONS)
+def NumDbConnections(mode):
+   if mode == 'asyncio':
+      numHandlers = poll_asyncserver.POLLSERVER_ASYNC_NUM_WORKERS
+   elif mode == 'pool':
+      numHandlers = poll_poolserver.POLLSERVER_POOL_NUM_WORKERS + poll_poolserver.POLLSERVER_POOL_HANDSHAKE_NUM_WORKERS
+   else:
+      return None
+   return numHandlers + poll_pipeline.POLLSERVER_PIPELINE_NUM_WORKERS + 3
+
+def RunServer(mode, ssl_context, reusePort=False):
+   if mode == 'asyncio':
+      poll_asyncserver.RunAsyncServer(POLLSERVER_HOST_PORT, ssl_context if use_ssl else None,
+                                      CheckClientCertificate, ServeRequest, reusePort)
+   elif mode == 'pool':
+      poll_poolserver.RunPoolServer(POLLSERVER_HOST_PORT, lambda cl_sock, cl_address: Handshake(ssl_context, cl_sock, cl_address),
+                                    ServeRequest, reusePort)
+   else:
+      RunThreadedServer(ssl_context, reusePort)
 
-   # create new thread for the client
-   start_new_thread(ssl_cl_sock, cl_address, conn, lock)
+use_ssl = True
 
-sock.close()
-ssl_socket.close()
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Poll server')
+   parser.add_argument('--mode', choices=POLLSERVER_MODES, default=POLLSERVER_MODE,
+                       help='thread: one thread per connection, asyncio: event loop with a pool of handler threads, ' +
+                            'pool: I/O thread with a bounded pool of handler threads, rejecting the requests beyond its limits')
+   parser.add_argument('--async-ssl-buffer-size', type=int, default=poll_asyncserver.POLLSERVER_ASYNC_SSL_BUFFER_SIZE,
+                       help='asyncio mode: receive buffer size of the SSL connections, e.g. 4096 (see poll_asyncserver.py)')
+   parser.add_argument('--processes', type=int, default=POLLSERVER_NUM_PROCESSES,
+                       help='number of server processes sharing the address, more than 1 runs the pre-fork mode')
+   parser.add_argument('--db-profile', choices=poll_dbopsimpl.POLLSERVER_DB_PROFILES, default=poll_dbopsimpl.POLLSERVER_DB_PROFILE,
+                       help='durability versus throughput of the database (see POLLSERVER_DB_PROFILES in poll_dbopsimpl.py)')
+   parser.add_argument('--kdf', choices=poll_passwords.POLLSERVER_KDF_PARAMS, default=poll_passwords.POLLSERVER_KDF,
+                       help='key derivation function of the new password hashes, the older ones are upgraded at login')
+   parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                       help='DEBUG turns on tracing of the requests')
+   parser.add_argument('--log-file', help='log to the file instead of the console')
+   parser.add_argument('--log-sample', action='append', default=[], metavar='[MSGTYPE:]N',
+                       help='trace one in N requests (of the message type MSGTYPE), can be repeated')
+   parser.add_argument('--pool-limit', action='append', default=[], metavar='MSGTYPE:N',
+                       help='pool mode: max requests of the message type MSGTYPE queued or processed (0: no limit), can be repeated')
+   args = parser.parse_args()
+
+   sampleRates = dict(map(int, r.split(':')) for r in args.log_sample if ':' in r)
+   defaultRates = [int(r) for r in args.log_sample if ':' not in r]
+   poll_logging.SetupLogging(args.log_level, args.log_file, sampleRates, defaultRates[-1] if defaultRates else 1)
+
+   for msgType, limit in (map(int, r.split(':')) for r in args.pool_limit):
+      if limit > 0:
+         poll_poolserver.POLLSERVER_POOL_TYPE_LIMITS[msgType] = limit
+      else:
+         poll_poolserver.POLLSERVER_POOL_TYPE_LIMITS.pop(msgType, None)
+
+   poll_passwords.POLLSERVER_KDF = args.kdf
+   poll_asyncserver.POLLSERVER_ASYNC_SSL_BUFFER_SIZE = args.async_ssl_buffer_size
+
+   # connect to database, the connections of all the processes share the cache budget
+   poll_dbopsimpl.POLLSERVER_DB_PROFILE = args.db_profile
+   numConnections = NumDbConnections(args.mode)
+   if numConnections is not None:
+      numConnections *= args.processes
+   poll_dbopsimpl.POLLSERVER_DB_NUM_CONNECTIONS = numConnections
+   conn = poll_dbopsimpl.ConnectDatabase()
+   if not conn:
+      sys.exit(1)
+
+   # create tables if needed
+   cur = poll_dbopsimpl.CreateTables(conn)
+   if not cur:
+      sys.exit(1)
+
+   # setup SSL context
+   ssl_context                     = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+   ssl_context.verify_mode         = ssl.CERT_REQUIRED;
+
+   # CA certificate
+   ssl_context.load_verify_locations("certificates/ca-cert.pem")
+
+   # server certificate and server key
+   ssl_context.load_cert_chain(certfile="certificates/server-cert.pem", keyfile="certificates/server-key.pem")
+
+   # issue session tickets so that reconnecting clients can resume the TLS session
+   # instead of doing the full certificate-authenticated handshake again
+   ssl_context.num_tickets = POLLSERVER_NUM_SESSION_TICKETS
+
+   RaiseOpenFileLimit()
+
+   if args.processes > 1:
+      # the workers open their own connections
+      conn.close()
+      poll_prefork.RunPreforkServer(args.processes, lambda: RunServer(args.mode, ssl_context, reusePort=True))
+   else:
+      RunServer(args.mode, ssl_context)
@@ -1,5 +1,6 @@
 import sys
 from poll_message_api import *
+from poll_logging import TraceRequest
 import poll_dbopsimpl
 
 #
@@ -29,78 +30,60 @@ class CreateUserImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
 
    def invoke(self):
-      print("ENTER CreateUserImpl", self.cntxt)
+      TraceRequest("ENTER CreateUserImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
 
       # Read the rest of the data from socket
       userID, userName, userEmail, userPwd = recvCreateUserData(self.sock)
-      print(userID, userName, userEmail, userPwd)
+      TraceRequest("userID %s userName %s userEmail %s", userID, userName, userEmail)
 
       # Validate the input data -- yet to be done
 
-      ### LOCK USER TABLE
-      self.lock.acquire()
-
       # Add the user details in to the database
       # 'res' is either OP_SUCCESS or OP_FAILURE
       # 'reason' indicates the actual FAILURE code inf case of FAILURE (see REASON_*)
       res, reason = poll_dbopsimpl.AddUser(self.conn, userID, userName, userEmail, userPwd)
 
-      ### UNLOCK USER TABLE
-      self.lock.release()
-
       # send the response -- for create-user request, the response is just success or failure
       r = sendResponseMessage(self.sock, CREATE_USER, res, reason)
-      print(r)
-      print("EXIT CreateUserImpl", self.cntxt)
+      TraceRequest("EXIT CreateUserImpl status %s reason %s", res, reason)
       return 0
 
 class ChangeUserImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = CHANGE_USER
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER ChangeUserImpl", self.cntxt)
+      TraceRequest("ENTER ChangeUserImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       userID, userName, userEmail, userPwd = recvChangeUserData(self.sock)
       if not (userID == self.userID and poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt)):
          res = OP_FAILURE
          reason = REASON_NOT_LOGGED_IN
       else:
-         print(self.userID, userName, userEmail, userPwd)
-
-         ### LOCK USER TABLE
-         self.lock.acquire()
+         TraceRequest("userID %s userName %s userEmail %s", self.userID, userName, userEmail)
          res, reason = poll_dbopsimpl.ChangeUser(self.conn, self.userID, userName, userEmail, userPwd)
-         ### UNLOCK USER TABLE
-         self.lock.release()
 
       r = sendResponseMessage(self.sock, self.op, res, reason)
-      print(r)
-      print("EXIT ChangeUserImpl", self.cntxt)
+      TraceRequest("EXIT ChangeUserImpl status %s reason %s", res, reason)
       return 0
 
 class LoginUserImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = LOGIN_USER
 
    def invoke(self):
-      print("ENTER LoginUserImpl", self.cntxt)
+      TraceRequest("ENTER LoginUserImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       userID, userPwd = recvLoginUserData(self.sock)
-      print(userID, userPwd)
-      ### LOCK USER TABLE
-      self.lock.acquire()
+      TraceRequest("userID %s", userID)
 
       # check if the user has already loggedn-in
       if poll_dbopsimpl.IsUserLoggedIn(userID):
@@ -112,64 +95,82 @@ class LoginUserImpl:
          if res == OP_SUCCESS:
             # Mark that the user has logged-in with the userID in the thread-context object
             res, reason = poll_dbopsimpl.SetUserLoggedIn(userID, self.cntxt)
-      ### UNLOCK USER TABLE
-      self.lock.release()
 
       # send the response OP_SUCCESS or OP_FAILURE with reason code
       r = sendResponseMessage(self.sock, self.op, res, reason)
-      print(r)
-      print("EXIT LoginUserImpl", self.cntxt)
+      TraceRequest("EXIT LoginUserImpl status %s reason %s", res, reason)
       return 0
 
 class LogoutUserImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = LOGOUT_USER
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER LogoutUserImpl", self.cntxt)
+      TraceRequest("ENTER LogoutUserImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
          res, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
       else:
-         ### LOCK USER TABLE
-         self.lock.acquire()
          poll_dbopsimpl.SetUserLoggedOut(self.cntxt)
-         ### UNLOCK USER TABLE
-         self.lock.release()
          res, reason = OP_SUCCESS, REASON_SUCCESS
 
       r = sendResponseMessage(self.sock, self.op, res, reason)
-      print("EXIT LogoutUserImpl", self.cntxt)
+      TraceRequest("EXIT LogoutUserImpl status %s reason %s", res, reason)
       return
 
 class ListUsersImpl:
    def __init__(self, cl_sock, cl_cntxt, conn):
       self.sock = cl_sock
       self.cntxt = cl_cntxt
-      self.lock = self.cntxt['lock']
       self.conn = conn
       self.op = LIST_USERS
       self.userID = self.cntxt['userID']
 
    def invoke(self):
-      print("ENTER ListUsersImpl", self.cntxt)
+      TraceRequest("ENTER ListUsersImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
 
       # only logged-in users can get the list of users
       if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
          res, reason, userList = OP_FAILURE, REASON_NOT_LOGGED_IN, []
       else:
-         ### LOCK USER TABLE
-         self.lock.acquire()
-         res, reason, userList = poll_dbopsimpl.ListUsers(self.cntxt)
-         ### UNLOCK USER TABLE
-         self.lock.release()
+         # the count of the version 1 response limits the number of users
+         maxRows = poll_dbopsimpl.POLLSERVER_LIST_MAX_ROWS if GetWireVersion(self.sock) < POLL_WIRE_VERSION_2 else None
+         res, reason, userList = poll_dbopsimpl.ListUsers(self.conn, maxRows)
 
       # the response contains whether the op is success and if yes, will also contain list of user and data
       r = sendListUsersResponse(self.sock, res, reason, userList)
-      print(r)
-      print("EXIT ListUsersImpl", self.cntxt)
+      TraceRequest("EXIT ListUsersImpl status %s reason %s", res, reason)
+      return 0
+
+class ListUsersPageImpl:
+   def __init__(self, cl_sock, cl_cntxt, conn):
+      self.sock = cl_sock
+      self.cntxt = cl_cntxt
+      self.conn = conn
+      self.op = LIST_USERS_PAGE
+      self.userID = self.cntxt['userID']
+
+   def invoke(self):
+      TraceRequest("ENTER ListUsersPageImpl %s %s", self.cntxt['address'], self.cntxt['userID'])
+      userIDPrefix, userNamePrefix, afterUserID, pageSize = recvListUsersPageReqData(self.sock)
+      if userIDPrefix is None:
+         return OP_FAILURE
+
+      numUsers = 0
+      if not poll_dbopsimpl.AmILoggedIn(self.userID, self.cntxt):
+         res, reason = OP_FAILURE, REASON_NOT_LOGGED_IN
+         r = sendListUsersPageResponse(self.sock, res, reason, [])
+      else:
+         res, reason = OP_SUCCESS, REASON_SUCCESS
+         # every chunk of the page is sent as soon as it is read
+         for users, nextUserID in poll_dbopsimpl.ListUsersPage(self.conn, userIDPrefix, userNamePrefix, afterUserID,
+                                                               pageSize or poll_dbopsimpl.POLLSERVER_LIST_PAGE_SIZE,
+                                                               poll_dbopsimpl.POLLSERVER_LIST_CHUNK_SIZE):
+            r = sendListUsersPageResponse(self.sock, res, reason, users, nextUserID is not None, nextUserID or "")
+            numUsers += len(users)
+
+      TraceRequest("EXIT ListUsersPageImpl status %s reason %s users %s", res, reason, numUsers)
       return 0
@@ -0,0 +1,121 @@
+import time
+import queue
+import threading
+import poll_dbopsimpl
+import poll_resultscache
+from poll_message_api import *
+from poll_logging import log
+
+#
+# Implements group commit of the votes
+#
+# Committing every vote in its own transaction costs a disk sync per vote. Instead, the handlers
+# put the votes (USER_POLL_MAKE_SELECTION and USER_POLL_MAKE_SELECTION_BATCH) on the queue of the
+# vote writer and wait. The vote writer thread collects the votes from all the connections for
+# up to POLLSERVER_VOTE_FLUSH_INTERVAL seconds or POLLSERVER_VOTE_FLUSH_MAX votes, whichever comes
+# first, and writes them in one transaction. Every waiting handler gets the result of its votes
+# after that transaction is committed, so a successful response still means the vote is stored.
+#
+
+# max time a vote waits for more votes to be written with it
+POLLSERVER_VOTE_FLUSH_INTERVAL = 0.002
+
+# max number of votes written in one transaction
+POLLSERVER_VOTE_FLUSH_MAX = 512
+
+#
+# Votes submitted by one request, the result of each vote is set by the vote writer
+#
+class VoteTicket:
+   def __init__(self, selections):
+      self.selections = selections
+      self.results = None
+      self.done = threading.Event()
+
+class VoteWriter:
+   def __init__(self, flushInterval=POLLSERVER_VOTE_FLUSH_INTERVAL, flushMax=POLLSERVER_VOTE_FLUSH_MAX):
+      self.flushInterval = flushInterval
+      self.flushMax = flushMax
+      self.queue = queue.SimpleQueue()
+      self.thread = threading.Thread(target=self.run, name='poll-votewriter', daemon=True)
+      self.thread.start()
+
+   #
+   # Writes the votes and waits till they are committed
+   #
+   #   selections : list of (pollID, userID, choiceID)
+   #
+   # Returns the list of (status, reason), one for each vote
+   #
+   def submit(self, selections):
+      ticket = VoteTicket(selections)
+      self.queue.put(ticket)
+      ticket.done.wait()
+      return ticket.results
+
+   # collects the tickets for one transaction
+   def collect(self):
+      # wait for the first vote as long as needed
+      tickets = [self.queue.get()]
+      numVotes = len(tickets[0].selections)
+      deadline = time.monotonic() + self.flushInterval
+
+      while numVotes < self.flushMax:
+         timeout = deadline - time.monotonic()
+         if timeout <= 0:
+            break
+         try:
+            ticket = self.queue.get(timeout=timeout)
+         except queue.Empty:
+            break
+         tickets.append(ticket)
+         numVotes += len(ticket.selections)
+
+      return tickets
+
+   def run(self):
+      conn = poll_dbopsimpl.GetConnection()
+
+      while True:
+         tickets = self.collect()
+         selections = [s for t in tickets for s in t.selections]
+
+         try:
+            results = poll_dbopsimpl.PollMakeSelections(conn, selections)
+         except Exception:
+            log.exception("vote writer failed to write %d votes", len(selections))
+            results = [(OP_FAILURE, REASON_DATABASE_ERROR)] * len(selections)
+
+         log.debug("vote writer committed %d votes from %d requests", len(selections), len(tickets))
+
+         # the results of the polls voted are changed
+         poll_resultscache.InvalidatePollResults(*{s[0] for (s, r) in zip(selections, results) if r[0] == OP_SUCCESS})
+
+         i = 0
+         for t in tickets:
+            t.results = results[i:i + len(t.selections)]
+            i += len(t.selections)
+            t.done.set()
+
+voteWriter = None
+voteWriterLock = threading.Lock()
+
+# Returns the vote writer of the server, starting it on first use
+def GetVoteWriter():
+   global voteWriter
+
+   if voteWriter is None:
+      with voteWriterLock:
+         if voteWriter is None:
+            voteWriter = VoteWriter()
+   return voteWriter
+
+# Writes one vote, returns (status, reason) once it is committed
+def SubmitVote(pollID, userID, choiceID):
+   return GetVoteWriter().submit([(pollID, userID, choiceID)])[0]
+
+# Writes the votes, returns the list of (status, reason) once they are committed
+def SubmitVotes(selections):
+   if not selections:
+      return []
+   return GetVoteWriter().submit(selections)
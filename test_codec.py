@@ -0,0 +1,172 @@
+import ctypes
+import socket
+import unittest
+from unittest import mock
+import poll_message_api
+from poll_message_api import *
+
+#
+# Tests of the version 1 message codecs (StructCodec, see poll_message_api.py)
+#
+# Every struct of the version 1 messages is encoded with its codec and via the ctypes struct, as
+# the send/recv functions did before the codecs, and the bytes and the decoded values are
+# compared, with empty strings, strings of the max length and non-ASCII strings. The arrays of
+# the listings are also packed and unpacked in bulk with numpy, when it is installed.
+#
+# usage: python -m unittest test_codec
+#
+
+CODECS = [(name[:-len('Codec')], codec) for name, codec in vars(poll_message_api).items()
+          if isinstance(codec, StructCodec)]
+
+ARRAY_CODECS = [ListUsersResponseDataCodec, ListPollsResponseDataCodec, PollResultsResponseDataCodec]
+
+# returns a string of size bytes in UTF-8, of 2 and 3 byte characters
+def NonAscii(size):
+   value = ''
+   while len((value + '€').encode()) <= size:
+      value += '€'
+   while len((value + 'é').encode()) <= size:
+      value += 'é'
+   return value + 'x' * (size - len(value.encode()))
+
+# returns the flattened values of the fields of the struct, in the order of StructCodec
+def SampleValues(ctypesStruct, case):
+   values = []
+   for name, fieldType in ctypesStruct._fields_:
+      if issubclass(fieldType, ctypes.Structure):
+         values += SampleValues(fieldType, case)
+      elif issubclass(fieldType, ctypes.Array) or fieldType is ctypes.c_char:
+         size = ctypes.sizeof(fieldType)
+         values.append({'empty': '', 'max': 'x' * size, 'nonascii': NonAscii(size)}[case])
+      else:
+         values.append({'empty': 0, 'max': 65535, 'nonascii': 12345}[case])
+   return values
+
+# sets the fields of the ctypes struct from the values, returns the number of values used
+def CtypesSet(obj, values):
+   i = 0
+   for name, fieldType in obj._fields_:
+      if issubclass(fieldType, ctypes.Structure):
+         i += CtypesSet(getattr(obj, name), values[i:])
+         continue
+      value = values[i]
+      if isinstance(value, str):
+         value = value.encode() or b'\0'
+      else:
+         value = socket.htons(value)
+      setattr(obj, name, value)
+      i += 1
+   return i
+
+def CtypesGet(obj, values):
+   for name, fieldType in obj._fields_:
+      value = getattr(obj, name)
+      if issubclass(fieldType, ctypes.Structure):
+         CtypesGet(value, values)
+      elif isinstance(value, bytes):
+         values.append(value.rstrip(b'\0').decode())
+      else:
+         values.append(socket.ntohs(value))
+   return values
+
+class StructCodecTest(unittest.TestCase):
+   def testSameBytesAsCtypes(self):
+      for name, codec in CODECS:
+         ctypesStruct = getattr(poll_message_api, name)
+         for case in ['empty', 'max', 'nonascii']:
+            with self.subTest(struct=name, case=case):
+               values = SampleValues(ctypesStruct, case)
+               obj = ctypesStruct()
+               CtypesSet(obj, values)
+
+               msgBuf = codec.pack(*values)
+               self.assertEqual(msgBuf, bytes(obj))
+               self.assertEqual(codec.unpack(bytearray(msgBuf)), tuple(values))
+               self.assertEqual(tuple(CtypesGet(ctypesStruct.from_buffer(bytearray(msgBuf)), [])), tuple(values))
+
+   def testStringTooLong(self):
+      for name, codec in CODECS:
+         values = SampleValues(getattr(poll_message_api, name), 'max')
+         for i, size in codec.strFields:
+            with self.subTest(struct=name, field=i):
+               tooLong = list(values)
+               tooLong[i] = 'é' * size
+               self.assertRaises(ValueError, codec.pack, *tooLong)
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class BulkCodecTest(unittest.TestCase):
+   # rows of every case, more than POLL_BULK_CODEC_MIN_ROWS
+   def sampleRows(self, codec, numRows=100):
+      ctypesStruct = getattr(poll_message_api, [name for name, c in CODECS if c is codec][0])
+      cases = ['empty', 'max', 'nonascii']
+      return [tuple(SampleValues(ctypesStruct, cases[i % 3])) for i in range(numRows)]
+
+   # packs and unpacks the rows with numpy, or row by row
+   def packUnpack(self, codec, rows, bulk):
+      with mock.patch.object(poll_message_api, 'numpy', numpy if bulk else None):
+         msgBuf = bytearray(codec.size * len(rows))
+         self.assertEqual(codec.packArrayInto(msgBuf, 0, rows), len(msgBuf))
+         return bytes(msgBuf), codec.unpackArray(msgBuf, len(rows))
+
+   def testBulkSameAsRows(self):
+      for codec in ARRAY_CODECS:
+         with self.subTest(codec=codec.struct.format):
+            rows = self.sampleRows(codec)
+            self.assertIsNotNone(codec.packArrayNumpy(rows))
+            bulkBuf, bulkRows = self.packUnpack(codec, rows, True)
+            rowBuf, rowRows = self.packUnpack(codec, rows, False)
+            self.assertEqual(bulkBuf, rowBuf)
+            self.assertEqual(bulkRows, rows)
+            self.assertEqual(rowRows, rows)
+
+   def testBulkFallsBackToRows(self):
+      codec = PollResultsResponseDataCodec
+      # a NUL inside a string
+      rows = self.sampleRows(codec)
+      rows[5] = ('a\0b', 1)
+      self.assertIsNone(codec.packArrayNumpy(rows))
+      self.assertEqual(self.packUnpack(codec, rows, True)[0], self.packUnpack(codec, rows, False)[0])
+      # invalid UTF-8 read back
+      msgBuf = bytearray(self.packUnpack(codec, self.sampleRows(codec), False)[0])
+      msgBuf[0:2] = b'\xc3\x28'
+      self.assertIsNone(codec.unpackArrayNumpy(msgBuf, 100, 0))
+
+   def testBulkStringTooLong(self):
+      codec = ListUsersResponseDataCodec
+      rows = self.sampleRows(codec)
+      rows[7] = ('é' * USER_ID_SIZE, 'name', 'email')
+      self.assertRaises(ValueError, codec.packArrayNumpy, rows)
+
+#
+# The listing responses sent and received on a socket pair in the version 1 format
+#
+class ListingMessageTest(unittest.TestCase):
+   def setUp(self):
+      serverSock, clientSock = socket.socketpair()
+      self.serverSock = FramedSocket(serverSock)
+      self.clientSock = FramedSocket(clientSock)
+
+   def tearDown(self):
+      self.serverSock.close()
+      self.clientSock.close()
+
+   def testListUsersResponse(self):
+      userList = [{'userID': f"u{i}", 'userName': NonAscii(USER_NAME_SIZE), 'userEmail': 'x' * USER_EMAIL_SIZE}
+                  for i in range(100)] + [{'userID': 'empty', 'userName': '', 'userEmail': ''}]
+      sendListUsersResponse(self.serverSock, OP_SUCCESS, REASON_SUCCESS, userList)
+      self.assertEqual(recvListUsersResponse(self.clientSock), (LIST_USERS, 2, OP_SUCCESS, REASON_SUCCESS, userList))
+
+   def testListPollsResponse(self):
+      pollList = [{'pollId': f"p{i}", 'pollName': NonAscii(POLL_NAME_SIZE), 'startDate': '', 'endDate': 'x' * DATE_TIME_SIZE,
+                   'pollStatus': 'O'} for i in range(100)]
+      sendListPollsResponse(self.serverSock, OP_SUCCESS, REASON_LIST_TRUNCATED, pollList)
+      msgType, flags, status, reason, received = recvListPollsResponse(self.clientSock)
+      self.assertEqual((msgType, flags, status, reason), (LIST_POLLS, 2, OP_SUCCESS, REASON_LIST_TRUNCATED))
+      # the polls are received with the key pollID and without choices
+      self.assertEqual(received, [{'pollID': poll['pollId'], 'pollName': poll['pollName'], 'startDate': poll['startDate'],
+                                   'endDate': poll['endDate'], 'pollStatus': poll['pollStatus'], 'choices': []}
+                                  for poll in pollList])
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,205 @@
+import socket
+import threading
+import unittest
+from poll_message_api import *
+
+#
+# Tests of the receive buffer of FramedSocket (see poll_message_api.py): the messages are read
+# from a socket pair whatever the size of the reads, and PeekRequest() finds the header of the
+# next request in the data fed by the asyncio mode
+#
+# usage: python -m unittest test_framedsocket
+#
+
+#
+# Keeps the bytes of the messages sent, in the wire format wireVersion
+#
+class MessageBytes:
+   def __init__(self, wireVersion):
+      self.wireVersion = wireVersion
+      self.requestID = 7
+      self.data = bytearray()
+
+   def send(self, data):
+      self.data += data
+      return len(data)
+
+# the bytes of a USER_POLL_GET_RESULTS request for each pollID
+def ResultsRequests(wireVersion, pollIDs):
+   msg = MessageBytes(wireVersion)
+   for pollID in pollIDs:
+      sendPollGetResultsReq(msg, pollID)
+   return bytes(msg.data)
+
+#
+# Socket returning at most maxBytes per recv_into()
+#
+class ShortReadSocket:
+   def __init__(self, sock, maxBytes):
+      self.sock = sock
+      self.maxBytes = maxBytes
+      self.numReads = 0
+
+   def recv_into(self, buffer):
+      self.numReads += 1
+      return self.sock.recv_into(buffer[:self.maxBytes])
+
+#
+# Socket failing the test if it is read, the data is fed to the FramedSocket
+#
+class NoReadSocket:
+   def recv_into(self, buffer):
+      raise AssertionError("read from the socket")
+
+class FramedSocketTest(unittest.TestCase):
+   def setUp(self):
+      self.serverSock, self.clientSock = socket.socketpair()
+
+   def tearDown(self):
+      self.serverSock.close()
+      self.clientSock.close()
+
+   def framedSocket(self, wireVersion, sock=None, bufSize=POLL_RECV_BUFFER_SIZE):
+      framedSock = FramedSocket(sock or self.serverSock, bufSize)
+      framedSock.wireVersion = wireVersion
+      return framedSock
+
+   # reads the USER_POLL_GET_RESULTS requests, returns their pollIDs
+   def recvRequests(self, framedSock, count):
+      pollIDs = []
+      for i in range(count):
+         msgType, flags = recvMsgHdr(framedSock)
+         self.assertEqual((msgType, flags), (USER_POLL_GET_RESULTS, 1))
+         pollIDs.append(recvPollGetResultsReqData(framedSock))
+      return pollIDs
+
+   def testShortReads(self):
+      for wireVersion in [POLL_WIRE_VERSION_1, POLL_WIRE_VERSION_2, POLL_WIRE_VERSION_3]:
+         with self.subTest(wireVersion=wireVersion):
+            sock = ShortReadSocket(self.serverSock, 1)
+            framedSock = self.framedSocket(wireVersion, sock)
+            data = ResultsRequests(wireVersion, ['poll1', 'poll2'])
+            self.clientSock.sendall(data)
+
+            self.assertEqual(self.recvRequests(framedSock, 2), ['poll1', 'poll2'])
+            self.assertEqual(sock.numReads, len(data))
+            self.assertFalse(framedSock.hasPending())
+
+   def testFrameSplitAcrossReads(self):
+      data = ResultsRequests(POLL_WIRE_VERSION_3, ['poll1'])
+      framedSock = self.framedSocket(POLL_WIRE_VERSION_3)
+      self.clientSock.sendall(data[:3])
+      # the rest arrives while the frame is being read
+      timer = threading.Timer(0.1, self.clientSock.sendall, (data[3:],))
+      timer.start()
+      try:
+         self.assertEqual(self.recvRequests(framedSock, 1), ['poll1'])
+      finally:
+         timer.join()
+      self.assertEqual(framedSock.requestID, 7)
+
+   def testSeveralFramesInOneRead(self):
+      for wireVersion in [POLL_WIRE_VERSION_1, POLL_WIRE_VERSION_2, POLL_WIRE_VERSION_3]:
+         with self.subTest(wireVersion=wireVersion):
+            sock = ShortReadSocket(self.serverSock, POLL_RECV_BUFFER_SIZE)
+            framedSock = self.framedSocket(wireVersion, sock)
+            self.clientSock.sendall(ResultsRequests(wireVersion, ['poll1', 'poll2', 'poll3']))
+
+            self.assertEqual(self.recvRequests(framedSock, 1), ['poll1'])
+            # the next requests are in the buffer, as pipelined requests
+            self.assertTrue(framedSock.hasPending())
+            self.assertEqual(self.recvRequests(framedSock, 2), ['poll2', 'poll3'])
+            self.assertEqual(sock.numReads, 1)
+            self.assertFalse(framedSock.hasPending())
+
+   def testBufferGrows(self):
+      # a frame larger than the buffer, behind a partly read one
+      data = ResultsRequests(POLL_WIRE_VERSION_2, ['poll1'])
+      msg = MessageBytes(POLL_WIRE_VERSION_2)
+      sendPollMakeSelectionBatchReq(msg, [(f"poll{i}", 'a') for i in range(20)])
+      framedSock = self.framedSocket(POLL_WIRE_VERSION_2, bufSize=16)
+      self.clientSock.sendall(data + msg.data)
+
+      self.assertEqual(self.recvRequests(framedSock, 1), ['poll1'])
+      self.assertEqual(recvMsgHdr(framedSock), (USER_POLL_MAKE_SELECTION_BATCH, 1))
+      self.assertEqual(recvPollMakeSelectionBatchReqData(framedSock), [(f"poll{i}", 'a') for i in range(20)])
+      self.assertGreater(len(framedSock.buf), 16)
+
+   def testConnectionClosed(self):
+      data = ResultsRequests(POLL_WIRE_VERSION_1, ['poll1'])
+      framedSock = self.framedSocket(POLL_WIRE_VERSION_1)
+      # half the header of the next request
+      self.clientSock.sendall(data + data[:2])
+      self.clientSock.shutdown(socket.SHUT_WR)
+
+      self.assertEqual(self.recvRequests(framedSock, 1), ['poll1'])
+      self.assertRaises(ConnectionResetError, recvMsgHdr, framedSock)
+
+   def testClosedBetweenMessages(self):
+      framedSock = self.framedSocket(POLL_WIRE_VERSION_2)
+      self.clientSock.shutdown(socket.SHUT_WR)
+      self.assertEqual(recvMsgHdr(framedSock), (None, None))
+
+class FeedTest(unittest.TestCase):
+   def testPeekVersion1(self):
+      data = ResultsRequests(POLL_WIRE_VERSION_1, ['poll1', 'poll2'])
+      framedSock = FramedSocket(NoReadSocket())
+      self.assertEqual(PeekRequest(framedSock), (None, None))
+      framedSock.feed(data[:3])
+      self.assertEqual(PeekRequest(framedSock), (None, None))
+      framedSock.feed(data[3:])
+      # the size of a version 1 request is not known from its header
+      self.assertEqual(PeekRequest(framedSock), (USER_POLL_GET_RESULTS, None))
+
+      # peeking does not consume the request
+      self.assertEqual(recvMsgHdr(framedSock), (USER_POLL_GET_RESULTS, 1))
+      self.assertEqual(recvPollGetResultsReqData(framedSock), 'poll1')
+      self.assertEqual(PeekRequest(framedSock), (USER_POLL_GET_RESULTS, None))
+
+   def testPeekFrames(self):
+      for wireVersion in [POLL_WIRE_VERSION_2, POLL_WIRE_VERSION_3]:
+         with self.subTest(wireVersion=wireVersion):
+            first = ResultsRequests(wireVersion, ['poll1'])
+            data = first + ResultsRequests(wireVersion, ['poll2'])
+            framedSock = FramedSocket(NoReadSocket())
+            framedSock.wireVersion = wireVersion
+
+            # the header is fed a byte at a time
+            framedSock.feed(data[:1])
+            self.assertEqual(PeekRequest(framedSock), (None, None))
+            framedSock.feed(data[1:2])
+            self.assertEqual(PeekRequest(framedSock), (USER_POLL_GET_RESULTS, len(first)))
+            framedSock.feed(data[2:])
+            self.assertEqual(PeekRequest(framedSock), (USER_POLL_GET_RESULTS, len(first)))
+
+            self.assertEqual(recvMsgHdr(framedSock), (USER_POLL_GET_RESULTS, 1))
+            self.assertEqual(recvPollGetResultsReqData(framedSock), 'poll1')
+            self.assertEqual(PeekRequest(framedSock), (USER_POLL_GET_RESULTS, len(data) - len(first)))
+            self.assertEqual(recvMsgHdr(framedSock), (USER_POLL_GET_RESULTS, 1))
+            self.assertEqual(recvPollGetResultsReqData(framedSock), 'poll2')
+            self.assertFalse(framedSock.hasPending())
+
+   def testPeekFrameTooLarge(self):
+      framedSock = FramedSocket(NoReadSocket())
+      framedSock.wireVersion = POLL_WIRE_VERSION_2
+      msg = bytearray()
+      EncodeVarint(msg, POLL_MAX_FRAME_SIZE + 1)
+      EncodeVarint(msg, USER_POLL_GET_RESULTS)
+      framedSock.feed(msg)
+      self.assertRaises(ValueError, PeekRequest, framedSock)
+
+   def testFeedAfterPartialRead(self):
+      data = ResultsRequests(POLL_WIRE_VERSION_2, ['poll1', 'poll2'])
+      framedSock = FramedSocket(NoReadSocket(), 8)
+      framedSock.wireVersion = POLL_WIRE_VERSION_2
+      framedSock.feed(data[:len(data) // 2 + 2])
+      self.assertEqual(recvMsgHdr(framedSock), (USER_POLL_GET_RESULTS, 1))
+      self.assertEqual(recvPollGetResultsReqData(framedSock), 'poll1')
+      # the rest of the second request is fed after the first one is read
+      self.assertEqual(PeekRequest(framedSock), (USER_POLL_GET_RESULTS, len(data) // 2))
+      framedSock.feed(data[len(data) // 2 + 2:])
+      self.assertEqual(recvMsgHdr(framedSock), (USER_POLL_GET_RESULTS, 1))
+      self.assertEqual(recvPollGetResultsReqData(framedSock), 'poll2')
+
+if __name__ == '__main__':
+   unittest.main()
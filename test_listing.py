@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import poll_dbopsimpl
+from poll_message_api import *
+
+#
+# Tests of the LIST_POLLS and LIST_USERS listings (see ListPolls and ListUsers of
+# poll_dbopsimpl.py), on a database of their own with a small page size
+#
+# usage: python -m unittest test_listing
+#
+
+NUM_ROWS = 7
+
+class ListingTest(unittest.TestCase):
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.dbPatch = mock.patch.object(poll_dbopsimpl, 'POLLSERVER_DB', os.path.join(self.dir, 'poll_database.sqldb'))
+      self.dbPatch.start()
+      # several pages per listing
+      self.pagePatch = mock.patch.object(poll_dbopsimpl, 'POLLSERVER_LIST_MAX_ROWS', 3)
+      self.pagePatch.start()
+      poll_dbopsimpl.pollCache = poll_dbopsimpl.PollCache()
+
+      self.conn = poll_dbopsimpl.ConnectDatabase()
+      poll_dbopsimpl.CreateTables(self.conn)
+      for i in range(NUM_ROWS):
+         poll_dbopsimpl.AddPoll(self.conn, 'owner', f"poll{i}", f"poll {i}", '', '', [('a', 'A'), ('b', 'B')])
+         # inserted directly, the password hash does not matter here
+         self.conn.execute("INSERT INTO user_table VALUES(?, ?, ?, ?)", (f"user{i}", f"user {i}", f"user{i}@test", 'x'))
+      self.conn.commit()
+
+   def tearDown(self):
+      self.conn.close()
+      self.pagePatch.stop()
+      self.dbPatch.stop()
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   def testListPollsEveryPage(self):
+      res, reason, pollList = poll_dbopsimpl.ListPolls(self.conn, "")
+      self.assertEqual((res, reason), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual([p['pollId'] for p in pollList], [f"poll{i}" for i in range(NUM_ROWS)])
+
+   def testListPollsTruncated(self):
+      res, reason, pollList = poll_dbopsimpl.ListPolls(self.conn, "", 5)
+      self.assertEqual((res, reason), (OP_SUCCESS, REASON_LIST_TRUNCATED))
+      self.assertEqual([p['pollId'] for p in pollList], [f"poll{i}" for i in range(5)])
+
+   def testListPollsFitsMaxRows(self):
+      res, reason, pollList = poll_dbopsimpl.ListPolls(self.conn, "", NUM_ROWS)
+      self.assertEqual((res, reason), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual(len(pollList), NUM_ROWS)
+
+   def testListUsersEveryPage(self):
+      res, reason, userList = poll_dbopsimpl.ListUsers(self.conn)
+      self.assertEqual((res, reason), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual([u['userID'] for u in userList], [f"user{i}" for i in range(NUM_ROWS)])
+
+   def testListUsersTruncated(self):
+      res, reason, userList = poll_dbopsimpl.ListUsers(self.conn, 5)
+      self.assertEqual((res, reason), (OP_SUCCESS, REASON_LIST_TRUNCATED))
+      self.assertEqual([u['userID'] for u in userList], [f"user{i}" for i in range(5)])
+
+if __name__ == '__main__':
+   unittest.main()
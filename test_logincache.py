@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import poll_dbopsimpl
+import poll_passwords
+import poll_generations
+from poll_message_api import *
+
+#
+# Tests of the cache of the logins (see LoginCache in poll_dbopsimpl.py)
+#
+# The logins are validated against a database of the test, in a temporary directory. The KDF
+# runs in the calling thread with cheap parameters.
+#
+# usage: python -m unittest test_logincache
+#
+
+class LoginCacheTest(unittest.TestCase):
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.patches = [mock.patch.object(poll_dbopsimpl, 'POLLSERVER_DB', os.path.join(self.dir, 'poll_database.sqldb')),
+                      mock.patch.object(poll_dbopsimpl, 'loginCache', poll_dbopsimpl.LoginCache()),
+                      mock.patch.object(poll_passwords, 'RunInKdfPool', lambda func, *args: func(*args)),
+                      mock.patch.dict(poll_passwords.POLLSERVER_KDF_PARAMS, {'scrypt': {'n': 16, 'r': 1, 'p': 1}})]
+      for patch in self.patches:
+         patch.start()
+
+      self.conn = poll_dbopsimpl.ConnectDatabase()
+      poll_dbopsimpl.CreateTables(self.conn)
+      poll_dbopsimpl.AddUser(self.conn, 'user1', 'User 1', 'u1@x', b'pwd1')
+
+      # the logins validated against the database
+      self.verified = []
+      verifyUser = poll_dbopsimpl.VerifyUser
+
+      def countVerifyUser(conn, userID, userPwd):
+         self.verified.append(userID)
+         return verifyUser(conn, userID, userPwd)
+
+      self.verifyPatch = mock.patch.object(poll_dbopsimpl, 'VerifyUser', countVerifyUser)
+      self.verifyPatch.start()
+
+   def tearDown(self):
+      self.verifyPatch.stop()
+      self.conn.close()
+      for patch in reversed(self.patches):
+         patch.stop()
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   def validate(self, userID, userPwd):
+      return poll_dbopsimpl.ValidateUser(self.conn, userID, userPwd)
+
+   def testSuccessCached(self):
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual(self.verified, ['user1'])
+
+   def testWrongPasswordNotCached(self):
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      # a password other than the cached one is verified every time
+      self.assertEqual(self.validate('user1', b'bad'), (OP_FAILURE, REASON_INCORRECT_PWD))
+      self.assertEqual(self.validate('user1', b'bad'), (OP_FAILURE, REASON_INCORRECT_PWD))
+      self.assertEqual(self.verified, ['user1'] * 3)
+      # the cached login is still valid
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual(len(self.verified), 3)
+
+   def testTtlExpiry(self):
+      with mock.patch.object(poll_dbopsimpl, 'POLLSERVER_LOGIN_CACHE_TTL', 0):
+         self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      # expired as soon as it is cached
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual(self.verified, ['user1'] * 2)
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual(self.verified, ['user1'] * 2)
+
+   def testUnknownUserCached(self):
+      self.assertEqual(self.validate('nobody', b'pwd'), (OP_FAILURE, REASON_USER_ID_NOT_FOUND))
+      self.assertEqual(self.validate('nobody', b'other'), (OP_FAILURE, REASON_USER_ID_NOT_FOUND))
+      self.assertEqual(self.verified, ['nobody'])
+
+      with mock.patch.object(poll_dbopsimpl, 'POLLSERVER_LOGIN_CACHE_UNKNOWN_TTL', 0):
+         self.assertEqual(self.validate('nobody2', b'pwd'), (OP_FAILURE, REASON_USER_ID_NOT_FOUND))
+      self.assertEqual(self.validate('nobody2', b'pwd'), (OP_FAILURE, REASON_USER_ID_NOT_FOUND))
+      self.assertEqual(self.verified, ['nobody', 'nobody2', 'nobody2'])
+
+   def testAddUserDropsUnknownEntry(self):
+      self.assertEqual(self.validate('user2', b'pwd2'), (OP_FAILURE, REASON_USER_ID_NOT_FOUND))
+      poll_dbopsimpl.AddUser(self.conn, 'user2', 'User 2', 'u2@x', b'pwd2')
+      self.assertEqual(self.validate('user2', b'pwd2'), (OP_SUCCESS, REASON_SUCCESS))
+
+   def testChangeUserInvalidates(self):
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      poll_dbopsimpl.ChangeUser(self.conn, 'user1', 'User 1', 'u1@x', b'pwd2')
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_FAILURE, REASON_INCORRECT_PWD))
+      self.assertEqual(self.validate('user1', b'pwd2'), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual(self.verified, ['user1'] * 3)
+
+   def testChangedByAnotherProcess(self):
+      with mock.patch.object(poll_generations, 'generations', None):
+         poll_generations.EnableSharedGenerations()
+         self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+
+         # ChangeUser in another process: the database and the generation of the user change,
+         # not the cache of this process
+         self.conn.execute("UPDATE user_table SET password=? WHERE userID='user1'", (poll_passwords.HashPassword(b'pwd2'),))
+         self.conn.commit()
+         poll_generations.BumpGeneration(poll_dbopsimpl.GetUserGenerationKey('user1'))
+
+         self.assertEqual(self.validate('user1', b'pwd1'), (OP_FAILURE, REASON_INCORRECT_PWD))
+         self.assertEqual(self.verified, ['user1'] * 2)
+
+   def testInvalidatedWhileVerifying(self):
+      verifyUser = poll_dbopsimpl.VerifyUser
+
+      def changedWhileVerifying(conn, userID, userPwd):
+         status = verifyUser(conn, userID, userPwd)
+         poll_dbopsimpl.loginCache.invalidate(userID)
+         return status
+
+      with mock.patch.object(poll_dbopsimpl, 'VerifyUser', changedWhileVerifying):
+         self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      # the login read before the change is not cached
+      self.assertEqual(self.validate('user1', b'pwd1'), (OP_SUCCESS, REASON_SUCCESS))
+      self.assertEqual(self.verified, ['user1'] * 2)
+
+if __name__ == '__main__':
+   unittest.main()
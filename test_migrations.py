@@ -0,0 +1,118 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+import poll_dbopsimpl
+
+#
+# Tests of the schema migrations (see MigrateDatabase in poll_dbopsimpl.py)
+#
+# The database shipped with the server (poll_database.sqldb) has the schema of the servers
+# without migrations, PRAGMA user_version 0. A copy of it, with users, polls and votes, is
+# migrated to the last schema version.
+#
+# usage: python -m unittest test_migrations
+#
+
+BASELINE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poll_database.sqldb')
+
+class MigrationTest(unittest.TestCase):
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.db = os.path.join(self.dir, 'poll_database.sqldb')
+      shutil.copy(BASELINE_DB, self.db)
+      self.dbPatch = mock.patch.object(poll_dbopsimpl, 'POLLSERVER_DB', self.db)
+      self.dbPatch.start()
+
+      # the rows as written by the servers without migrations
+      conn = sqlite3.connect(self.db)
+      conn.execute("DELETE FROM user_table")
+      conn.execute("DELETE FROM poll_master_table")
+      conn.execute("DELETE FROM poll_choices_table")
+      conn.execute("DELETE FROM user_poll_selection_table")
+      conn.executemany("INSERT INTO user_table VALUES(?, ?, ?, ?)",
+                       [('user1', 'User 1', 'u1@x', 'hash1'), ('user2', 'User 2', 'u2@x', 'hash2')])
+      conn.execute("INSERT INTO poll_master_table VALUES('poll1', 'Poll 1', 'O', 'user1', '', '')")
+      conn.executemany("INSERT INTO poll_choices_table VALUES('poll1', ?, ?)", [('a', 'A'), ('b', 'B')])
+      conn.executemany("INSERT INTO user_poll_selection_table VALUES('poll1', ?, ?)", [('user1', 'a'), ('user2', 'a')])
+      conn.commit()
+      conn.close()
+
+   def tearDown(self):
+      self.dbPatch.stop()
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   def migrate(self):
+      conn = poll_dbopsimpl.ConnectDatabase()
+      self.addCleanup(conn.close)
+      poll_dbopsimpl.CreateTables(conn)
+      return conn
+
+   def testBaselineIsVersion0(self):
+      conn = sqlite3.connect(self.db)
+      self.addCleanup(conn.close)
+      self.assertEqual(poll_dbopsimpl.GetSchemaVersion(conn), 0)
+
+   def testMigrateFromBaseline(self):
+      conn = self.migrate()
+      self.assertEqual(poll_dbopsimpl.GetSchemaVersion(conn), len(poll_dbopsimpl.POLL_DB_MIGRATIONS))
+
+      # the rows are kept, in the typed WITHOUT ROWID tables
+      self.assertEqual(conn.execute("SELECT userID, userName from user_table ORDER BY userID").fetchall(),
+                       [('user1', 'User 1'), ('user2', 'User 2')])
+      for tableName in poll_dbopsimpl.POLL_DB_TABLES:
+         sql, = conn.execute("SELECT sql from sqlite_master WHERE (type='table' and name=?)", (tableName,)).fetchone()
+         self.assertIn("WITHOUT ROWID", sql)
+
+      # the tally table counts the votes cast before the migration, the triggers the later ones
+      self.assertEqual(poll_dbopsimpl.PollGetCounts(conn, 'poll1'), {'a': 2, 'b': 0})
+      conn.execute("UPDATE user_poll_selection_table SET choiceID='b' WHERE (pollID='poll1' and userID='user2')")
+      self.assertEqual(poll_dbopsimpl.PollGetCounts(conn, 'poll1'), {'a': 1, 'b': 1})
+      conn.rollback()
+
+      names = {name for (name,) in conn.execute("SELECT name from sqlite_master WHERE type in ('index', 'table')")}
+      self.assertTrue({'poll_master_owner_idx', 'user_poll_selection_choice_idx', 'user_poll_selection_user_idx',
+                       'user_name_idx', 'user_session_table'} <= names)
+
+   def testMigrateTwice(self):
+      conn = self.migrate()
+      schema = conn.execute("SELECT type, name, sql from sqlite_master ORDER BY name").fetchall()
+      poll_dbopsimpl.CreateTables(conn)
+      self.assertEqual(conn.execute("SELECT type, name, sql from sqlite_master ORDER BY name").fetchall(), schema)
+      self.assertEqual(poll_dbopsimpl.PollGetCounts(conn, 'poll1'), {'a': 2, 'b': 0})
+
+   def testNullKeyRowsLoggedAndDropped(self):
+      conn = sqlite3.connect(self.db)
+      conn.execute("INSERT INTO user_table VALUES(NULL, 'No ID', 'none@x', 'hash')")
+      conn.execute("INSERT INTO user_poll_selection_table VALUES('poll1', NULL, 'b')")
+      conn.commit()
+      conn.close()
+
+      with self.assertLogs('poll', 'WARNING') as logs:
+         conn = self.migrate()
+      self.assertEqual(len([line for line in logs.output if 'primary key is NULL' in line]), 2)
+      self.assertEqual(conn.execute("SELECT count(*) from user_table").fetchone()[0], 2)
+      self.assertEqual(conn.execute("SELECT count(*) from user_poll_selection_table").fetchone()[0], 2)
+      # the dropped vote is not counted
+      self.assertEqual(poll_dbopsimpl.PollGetCounts(conn, 'poll1'), {'a': 2, 'b': 0})
+      self.assertEqual(poll_dbopsimpl.GetSchemaVersion(conn), len(poll_dbopsimpl.POLL_DB_MIGRATIONS))
+
+   def testFailedMigrationRolledBack(self):
+      # two keys equal once typed as TEXT can not be copied
+      conn = sqlite3.connect(self.db)
+      conn.execute("INSERT INTO poll_master_table VALUES(1, 'Poll int', 'C', 'user1', '', '')")
+      conn.execute("INSERT INTO poll_master_table VALUES('1', 'Poll text', 'C', 'user1', '', '')")
+      conn.commit()
+      conn.close()
+
+      conn = poll_dbopsimpl.ConnectDatabase()
+      self.addCleanup(conn.close)
+      self.assertRaises(sqlite3.IntegrityError, poll_dbopsimpl.CreateTables, conn)
+      # the migrations before the failed one are kept, the failed one is not half applied
+      self.assertEqual(poll_dbopsimpl.GetSchemaVersion(conn), 1)
+      self.assertEqual(conn.execute("SELECT count(*) from poll_master_table").fetchone()[0], 3)
+
+if __name__ == '__main__':
+   unittest.main()
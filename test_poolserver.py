@@ -0,0 +1,122 @@
+import os
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import poll_dbopsimpl
+import poll_poolserver
+import poll_server
+from poll_message_api import *
+
+#
+# Tests of the load shedding of the pool mode (see poll_poolserver.py)
+#
+# A pool server without TLS runs in a thread of the test, on a database of the test, with at
+# most one USER_POLL_GET_RESULTS request queued or processed at a time. The worker processing
+# the first one is held, so the next ones are rejected.
+#
+# usage: python -m unittest test_poolserver
+#
+
+class PoolOverloadTest(unittest.TestCase):
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.patches = [mock.patch.object(poll_dbopsimpl, 'POLLSERVER_DB', os.path.join(self.dir, 'poll_database.sqldb')),
+                      mock.patch.object(poll_poolserver, 'POLLSERVER_POOL_NUM_WORKERS', 2)]
+      for patch in self.patches:
+         patch.start()
+      conn = poll_dbopsimpl.ConnectDatabase()
+      poll_dbopsimpl.CreateTables(conn)
+      conn.close()
+
+      # set while the results requests may be processed
+      self.running = threading.Event()
+      self.held = threading.Event()
+      self.server = poll_poolserver.PoolServer(lambda cl_sock, cl_address: cl_sock, self.serveRequest,
+                                               {USER_POLL_GET_RESULTS: 1})
+      # the server thread runs till the end of the tests
+      threading.Thread(target=self.server.serve, args=(('127.0.0.1', 0), False), daemon=True).start()
+      while not self.server.accepting:
+         self.running.wait(0.01)
+      self.address = self.server.listenSock.getsockname()
+      self.sockets = []
+
+   def tearDown(self):
+      self.running.set()
+      for sock in self.sockets:
+         sock.close()
+      for patch in reversed(self.patches):
+         patch.stop()
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   def serveRequest(self, cl_sock, cntxt, conn):
+      msgType, size = PeekRequest(cl_sock)
+      if msgType == USER_POLL_GET_RESULTS:
+         self.held.set()
+         self.running.wait()
+      return poll_server.ServeRequest(cl_sock, cntxt, conn)
+
+   def connect(self, wireVersion=POLL_WIRE_VERSION_1):
+      sock = FramedSocket(socket.create_connection(self.address))
+      sock.settimeout(10)
+      self.sockets.append(sock)
+      if wireVersion > POLL_WIRE_VERSION_1:
+         self.assertEqual(NegotiateWireVersion(sock, wireVersion), wireVersion)
+      return sock
+
+   # sends a results request processed by the worker held till self.running is set
+   def holdWorker(self):
+      sock = self.connect()
+      sendPollGetResultsReq(sock, 'poll1')
+      self.assertTrue(self.held.wait(10))
+      return sock
+
+   # waits till the worker is done with the held request, after sending its response
+   def waitIdle(self):
+      while self.server.inFlight[USER_POLL_GET_RESULTS]:
+         self.held.wait(0.01)
+
+   def testVersion1RejectedAndClosed(self):
+      held = self.holdWorker()
+      sock = self.connect()
+      sendPollGetResultsReq(sock, 'poll1')
+
+      self.assertEqual(recvPollGetResultsResponse(sock)[:4], (USER_POLL_GET_RESULTS, 2, OP_FAILURE, REASON_SERVER_OVERLOADED))
+      # the rest of the request can not be skipped, the connection is closed
+      self.assertEqual(len(sock.recv(1)), 0)
+      self.assertEqual(self.server.numRejected, 1)
+
+      # the held request is processed once the worker goes on
+      self.running.set()
+      self.assertEqual(recvPollGetResultsResponse(held)[2:4], (OP_FAILURE, REASON_NOT_LOGGED_IN))
+
+   def testVersion2FrameSkipped(self):
+      for wireVersion in [POLL_WIRE_VERSION_2, POLL_WIRE_VERSION_3]:
+         with self.subTest(wireVersion=wireVersion):
+            self.running.clear()
+            self.held.clear()
+            self.waitIdle()
+            held = self.holdWorker()
+            sock = self.connect(wireVersion)
+            sock.requestID = 5
+            sendPollGetResultsReq(sock, 'poll1')
+
+            msgType, flags, status, reason, results = recvPollGetResultsResponse(sock)
+            self.assertEqual((msgType, flags, status, reason), (USER_POLL_GET_RESULTS, 2, OP_FAILURE, REASON_SERVER_OVERLOADED))
+            if wireVersion >= POLL_WIRE_VERSION_3:
+               self.assertEqual(sock.frame.requestID, 5)
+
+            # the frame is skipped, the connection stays open and the other requests are served
+            sendListPollsReq(sock)
+            self.assertEqual(recvListPollsResponse(sock)[2:4], (OP_FAILURE, REASON_NOT_LOGGED_IN))
+
+            self.running.set()
+            self.assertEqual(recvPollGetResultsResponse(held)[2:4], (OP_FAILURE, REASON_NOT_LOGGED_IN))
+            self.waitIdle()
+            sendPollGetResultsReq(sock, 'poll1')
+            self.assertEqual(recvPollGetResultsResponse(sock)[2:4], (OP_FAILURE, REASON_NOT_LOGGED_IN))
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,81 @@
+import os
+import socket
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import poll_dbopsimpl
+import poll_publisher
+from poll_message_api import *
+
+#
+# Tests of the slow subscribers of the publisher (see poll_publisher.py)
+#
+# Two connections, socket pairs with small buffers, subscribe to the same poll. One reads its
+# updates, the other never does: the updates of the first one are not held up, and the second
+# one is dropped once its queue is full.
+#
+# usage: python -m unittest test_publisher
+#
+
+class SlowSubscriberTest(unittest.TestCase):
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.patches = [mock.patch.object(poll_dbopsimpl, 'POLLSERVER_DB', os.path.join(self.dir, 'poll_database.sqldb')),
+                      mock.patch.object(poll_publisher, 'POLLSERVER_PUBLISH_QUEUE_SIZE', 4)]
+      for patch in self.patches:
+         patch.start()
+      conn = poll_dbopsimpl.ConnectDatabase()
+      poll_dbopsimpl.CreateTables(conn)
+      conn.close()
+
+      self.publisher = poll_publisher.Publisher(0.01)
+      self.sockets = []
+
+   def tearDown(self):
+      for sock in self.sockets:
+         sock.close()
+      for patch in reversed(self.patches):
+         patch.stop()
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   # returns the (server, client) FramedSockets of a connection subscribed to poll1
+   def subscribe(self):
+      socks = socket.socketpair()
+      for sock in socks:
+         sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+         sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+      serverSock, clientSock = FramedSocket(socks[0]), FramedSocket(socks[1])
+      for sock in [serverSock, clientSock]:
+         sock.wireVersion = POLL_WIRE_VERSION_2
+         self.sockets.append(sock)
+      clientSock.settimeout(10)
+      self.publisher.subscribe(serverSock, 'poll1', 0)
+      return serverSock, clientSock
+
+   def recvUpdate(self, clientSock):
+      self.assertEqual(recvMsgHdr(clientSock), (POLL_RESULTS_UPDATE, 2))
+      return recvPollResultsUpdateData(clientSock)
+
+   def testSlowSubscriberDropped(self):
+      fastServer, fastClient = self.subscribe()
+      slowServer, slowClient = self.subscribe()
+      # the first update, of a poll without choices
+      self.assertEqual(self.recvUpdate(fastClient), ('poll1', []))
+
+      # updates larger than the socket buffers, read by the fast subscriber as they come
+      updates = [(f"choice{i}", i) for i in range(500)]
+      with self.assertLogs('poll', 'WARNING') as logs:
+         for i in range(3 * poll_publisher.POLLSERVER_PUBLISH_QUEUE_SIZE):
+            self.publisher.send('poll1', updates, list(self.publisher.subscribers['poll1'].values()))
+            self.assertEqual(self.recvUpdate(fastClient), ('poll1', updates))
+
+      self.assertIn('not reading its poll results updates', logs.output[0])
+      self.assertEqual(list(self.publisher.subscribers['poll1']), [fastServer])
+      self.assertNotIn(slowServer, self.publisher.outboxes)
+
+      # the connection of the slow subscriber is shut down
+      self.assertRaises(OSError, slowServer.sock.send, b'x')
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,188 @@
+import os
+import socket
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import poll_dbopsimpl
+import poll_votewriter
+import poll_pollopsimpl
+from poll_message_api import *
+
+#
+# Tests of the group commit of the votes (see poll_votewriter.py) and of the
+# USER_POLL_MAKE_SELECTION_BATCH request (see PollMakeSelectionBatchImpl)
+#
+# Every test runs on a database of its own, in a temporary directory.
+#
+# usage: python -m unittest test_votewriter
+#
+
+OWNER_ID = 'owner'
+VOTER_ID = 'voter'
+
+#
+# Database of the test with three polls, and a vote writer writing to it
+#
+class VoteDatabase(unittest.TestCase):
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.dbPatch = mock.patch.object(poll_dbopsimpl, 'POLLSERVER_DB', os.path.join(self.dir, 'poll_database.sqldb'))
+      self.dbPatch.start()
+      poll_dbopsimpl.pollCache = poll_dbopsimpl.PollCache()
+
+      self.conn = poll_dbopsimpl.ConnectDatabase()
+      poll_dbopsimpl.CreateTables(self.conn)
+      self.addPoll('open1', 'O')
+      self.addPoll('open2', 'O')
+      self.addPoll('closed', 'C')
+
+      # a new writer thread, with a connection to the database of the test
+      self.writer = poll_votewriter.VoteWriter(flushInterval=0.05)
+      # returns once the writer thread is connected, before the database is removed
+      self.writer.submit([])
+      self.writerPatch = mock.patch.object(poll_votewriter, 'voteWriter', self.writer)
+      self.writerPatch.start()
+
+   def tearDown(self):
+      self.writerPatch.stop()
+      self.conn.close()
+      self.dbPatch.stop()
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   def addPoll(self, pollID, status):
+      poll_dbopsimpl.AddPoll(self.conn, OWNER_ID, pollID, pollID, '', '', [('a', 'A'), ('b', 'B')])
+      if status == 'O':
+         poll_dbopsimpl.SetPollStatus(self.conn, pollID, OWNER_ID, 'O')
+      elif status == 'C':
+         poll_dbopsimpl.SetPollStatus(self.conn, pollID, OWNER_ID, 'O')
+         poll_dbopsimpl.SetPollStatus(self.conn, pollID, OWNER_ID, 'C')
+
+   # the committed vote of the user, read with a connection of its own
+   def committedVote(self, pollID, userID):
+      conn = poll_dbopsimpl.ConnectDatabase()
+      try:
+         rows = conn.execute("SELECT choiceID from user_poll_selection_table WHERE (pollID=? and userID=?)",
+                             (pollID, userID)).fetchall()
+      finally:
+         conn.close()
+      return rows[0][0] if rows else None
+
+class VoteWriterTest(VoteDatabase):
+   def testResponseAfterCommit(self):
+      makeSelections = poll_dbopsimpl.PollMakeSelections
+      transactions = []
+
+      def slowMakeSelections(conn, selections):
+         time.sleep(0.1)
+         results = makeSelections(conn, selections)
+         transactions.append(len(selections))
+         return results
+
+      results = {}
+      seen = {}
+
+      def vote(userID, choiceID):
+         results[userID] = poll_votewriter.SubmitVote('open1', userID, choiceID)
+         # the vote is committed by the time the response is known
+         seen[userID] = (len(transactions), self.committedVote('open1', userID))
+
+      with mock.patch.object(poll_votewriter.poll_dbopsimpl, 'PollMakeSelections', slowMakeSelections):
+         threads = [threading.Thread(target=vote, args=(f"user{i}", 'ab'[i % 2])) for i in range(4)]
+         for t in threads:
+            t.start()
+         for t in threads:
+            t.join()
+
+      self.assertEqual(results, {f"user{i}": (OP_SUCCESS, REASON_SUCCESS) for i in range(4)})
+      for i in range(4):
+         numTransactions, choiceID = seen[f"user{i}"]
+         self.assertGreaterEqual(numTransactions, 1)
+         self.assertEqual(choiceID, 'ab'[i % 2])
+      # the votes of the callers waiting together are written in one transaction
+      self.assertEqual(sum(transactions), 4)
+      self.assertLess(len(transactions), 4)
+
+   def testResultsOfEveryCaller(self):
+      results = {}
+
+      def vote(userID, selections):
+         results[userID] = poll_votewriter.SubmitVotes([(pollID, userID, choiceID) for (pollID, choiceID) in selections])
+
+      threads = [threading.Thread(target=vote, args=('user1', [('open1', 'a'), ('nopoll', 'a')])),
+                 threading.Thread(target=vote, args=('user2', [('closed', 'b'), ('open2', 'b')]))]
+      for t in threads:
+         t.start()
+      for t in threads:
+         t.join()
+
+      self.assertEqual(results['user1'], [(OP_SUCCESS, REASON_SUCCESS), (OP_FAILURE, REASON_NOSUCH_POLL_ID)])
+      self.assertEqual(results['user2'], [(OP_FAILURE, REASON_POLL_NOT_OPENED), (OP_SUCCESS, REASON_SUCCESS)])
+
+#
+# The batch request is sent by a client socket and processed by PollMakeSelectionBatchImpl on the
+# other end of a socket pair
+#
+class PollMakeSelectionBatchTest(VoteDatabase):
+   def setUp(self):
+      super().setUp()
+      serverSock, clientSock = socket.socketpair()
+      self.serverSock = FramedSocket(serverSock)
+      self.clientSock = FramedSocket(clientSock)
+      self.cntxt = {'userID': VOTER_ID, 'logged_in': True, 'address': 'test'}
+
+   def tearDown(self):
+      self.serverSock.close()
+      self.clientSock.close()
+      super().tearDown()
+
+   def makeSelections(self, selections):
+      sendPollMakeSelectionBatchReq(self.clientSock, selections)
+      msgType, flags = recvMsgHdr(self.serverSock)
+      self.assertEqual(msgType, USER_POLL_MAKE_SELECTION_BATCH)
+      poll_pollopsimpl.PollMakeSelectionBatchImpl(self.serverSock, self.cntxt, self.conn).invoke()
+      msgType, flags, status, reason, results = recvPollMakeSelectionBatchResponse(self.clientSock)
+      self.assertEqual((status, reason), (OP_SUCCESS, REASON_SUCCESS))
+      return results
+
+   def testFailedSelectionKeepsTheOthers(self):
+      results = self.makeSelections([('open1', 'a'), ('nopoll', 'a'), ('closed', 'a'), ('open2', 'x'), ('open2', 'b')])
+
+      self.assertEqual(results, [(OP_SUCCESS, REASON_SUCCESS),
+                                 (OP_FAILURE, REASON_NOSUCH_POLL_ID),
+                                 (OP_FAILURE, REASON_POLL_NOT_OPENED),
+                                 (OP_FAILURE, REASON_NOSUCH_POLL_ID),
+                                 (OP_FAILURE, REASON_DUP_POLL_DATA)])
+      self.assertEqual(self.committedVote('open1', VOTER_ID), 'a')
+      self.assertIsNone(self.committedVote('open2', VOTER_ID))
+      self.assertIsNone(self.committedVote('closed', VOTER_ID))
+
+   def testDuplicatePollFirstSelectionWins(self):
+      results = self.makeSelections([('open1', 'a'), ('open2', 'b'), ('open1', 'b'), ('open1', 'a')])
+
+      self.assertEqual(results, [(OP_SUCCESS, REASON_SUCCESS),
+                                 (OP_SUCCESS, REASON_SUCCESS),
+                                 (OP_FAILURE, REASON_DUP_POLL_DATA),
+                                 (OP_FAILURE, REASON_DUP_POLL_DATA)])
+      self.assertEqual(self.committedVote('open1', VOTER_ID), 'a')
+      self.assertEqual(self.committedVote('open2', VOTER_ID), 'b')
+      self.assertEqual(poll_dbopsimpl.PollGetCounts(self.conn, 'open1'), {'a': 1, 'b': 0})
+
+   def testLaterBatchChangesTheVote(self):
+      self.makeSelections([('open1', 'a')])
+      self.assertEqual(self.makeSelections([('open1', 'b')]), [(OP_SUCCESS, REASON_SUCCESS)])
+      self.assertEqual(self.committedVote('open1', VOTER_ID), 'b')
+
+   def testNotLoggedIn(self):
+      self.cntxt['logged_in'] = False
+      sendPollMakeSelectionBatchReq(self.clientSock, [('open1', 'a')])
+      recvMsgHdr(self.serverSock)
+      poll_pollopsimpl.PollMakeSelectionBatchImpl(self.serverSock, self.cntxt, self.conn).invoke()
+      msgType, flags, status, reason, results = recvPollMakeSelectionBatchResponse(self.clientSock)
+      self.assertEqual((status, reason, results), (OP_FAILURE, REASON_NOT_LOGGED_IN, []))
+      self.assertIsNone(self.committedVote('open1', VOTER_ID))
+
+if __name__ == '__main__':
+   unittest.main()